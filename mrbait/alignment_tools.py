@@ -2,6 +2,7 @@
 
 import sys
 import random
+import numpy as np
 from mrbait import misc_utils as utils
 from Bio import AlignIO
 
@@ -40,92 +41,113 @@ def make_consensus(alignment, threshold, mask, maf=0.0):
 	aln_depth = len(alignment)
 	#If only one sequence in alignment, return that seq as consensus
 	if aln_depth == 1:
-		return alignment[:,0]
-	aln_len = alignment.get_alignment_length()
-	consensus="" #consensus string to build
-	#For each column
-	for i in range(aln_len):
-		#For each character in column, grab occurences
-		col_len = len((alignment[:,i]))
-		nuc_count = dict() #dictionary to track occurences
-		nuc_types = 0 #track number of things we found
-		ismask = 0 #Track if we should mask this column
-		#Check number of masked bases
-		nlower = utils.n_lower_chars(alignment[:,i])
-		prop_mask = float(nlower/aln_depth)
-		if prop_mask > mask:
-			ismask = 1
-
-		for c in ((alignment[:,i]).upper()):
-			for nuc in get_iupac(c):
-				nuc_count[nuc] = nuc_count.get(nuc,0)+1
-				#print(nuc, end='', flush=True)
-		nucs= []
-		add = 0
-		#print(nuc_count)
-		bad_count = 0
-		bad_counts = dict()
-		for key_raw in nuc_count:
-			key = key_raw
-			if ismask: #If masked above threshold, set to lower case
-				key = key_raw.lower()
-			#print(key, " is ", nuc_count[key])
-			#If only one nuc type, keep it
-			if nuc_types == 1:
-				consensus+=str(key)
-				add=1
-				break
-			#If N or gap, call consensus N or gap if above threshold
-			elif key in ("N", "n", "-"):
-				temp = key
-				if key == "n":
-					temp = "N"
-				bad_count += nuc_count[temp]
-				bad_counts[temp] = nuc_count[temp]
-				if float((nuc_count[temp])/aln_depth*2) >= threshold:
-					#print("Found ", nuc_count[key], key, "'s in alignment")
-					#print((nuc_count[key])/aln_depth)
-					consensus+=str(key)
-					add=1
-					break
-			else:
-				nucs.append(str(key))
-		if add == 0:
-			if bad_count >= col_len:
-				#print("All bad!")
-				nuc = utils.getMaxKey(bad_counts)
-				#print(nuc)
-				consensus+=nuc
-			else:
-				#call consensus from alleles!
-				temp = utils.listToSortUniqueString(nucs)
-				if len(temp) > 1 and maf > 0.0:
-					#print(temp)
-					#first, remove alleles below MAF filter
-					nucs_clean = filterListByMAF(nucs, nuc_count, aln_depth*2, maf)
-					#recreate unique list
-					temp = utils.listToSortUniqueString(nucs_clean)
-					#print(temp)
-					#print()
-				#print(nucs,":",temp)
-				consensus+=reverse_iupac_case(temp)
-	return(consensus)
-
-
-def filterListByMAF(l, counts, depth, threshold):
-	if threshold <= 0.0:
-		return(l)
-	elif threshold >= 1.0:
-		return(l)
-	else:
-		ret = []
-		for c in utils.listToSortUniqueString(l):
-			#print(c, depth, counts[c], float((float(counts[c]))/float(depth)))
-			if float((float(counts[c]))/float(depth)) >= threshold:
-				ret.append(c)
-		return(ret)
-		#sys.exit(0)
+		return(str(alignment[0].seq))
+	return(make_consensus_array(alignment_to_array(alignment), threshold, mask, maf))
+
+#Function to encode an alignment as a (sequences x columns) uint8 matrix
+def alignment_to_array(alignment):
+	seqs = [str(rec.seq) for rec in alignment]
+	arr = np.frombuffer("".join(seqs).encode("ascii"), dtype=np.uint8)
+	return(arr.reshape(len(seqs), -1))
+
+#Vectorized consensus kernel, operates on all columns of a uint8 alignment matrix
+#Gives the same calls as the old column-by-column loop:
+#	N or gap called when (count/depth*2) >= threshold, first one seen in column wins
+#	N or gap called (upper case) when they make up >= half of the alleles
+#	Otherwise IUPAC code of the remaining alleles, after optional MAF filter
+#	Column is lower case when proportion masked > mask
+def make_consensus_array(aln, threshold, mask, maf=0.0):
+	aln_depth = aln.shape[0]
+	#If only one sequence in alignment, return that seq as consensus
+	if aln_depth == 1:
+		return(aln[0].tobytes().decode("ascii"))
+	cons = _consensus_kernel(aln[np.newaxis], np.array([aln_depth]), threshold, mask, maf)
+	return(cons[0].tobytes().decode("ascii"))
+
+#Function to call consensus for many alignments at once
+#Alignments are padded into a single (locus x sequence x column) array so
+#that a batch of short alignments (e.g. RAD loci) costs one pass of the kernel
+#Returns list of consensus strings, in the same order as alns
+def make_consensus_batch(alns, threshold, mask, maf=0.0):
+	arrays = [a if isinstance(a, np.ndarray) else alignment_to_array(a) for a in alns]
+	if not arrays:
+		return([])
+	depths = np.array([a.shape[0] for a in arrays])
+	lengths = [a.shape[1] for a in arrays]
+	batch = np.zeros((len(arrays), depths.max(), max(lengths)), dtype=np.uint8)
+	for i, a in enumerate(arrays):
+		batch[i, :a.shape[0], :a.shape[1]] = a
+	cons = _consensus_kernel(batch, depths, threshold, mask, maf)
+	ret = list()
+	for i, a in enumerate(arrays):
+		if depths[i] == 1:
+			#Same as make_consensus for single-sequence alignments
+			ret.append(a[0].tobytes().decode("ascii"))
+		else:
+			ret.append(cons[i, :lengths[i]].tobytes().decode("ascii"))
+	return(ret)
+
+#Consensus kernel on a padded (locus x sequence x column) uint8 array
+#Padding must be 0, depths gives the number of real sequences per locus
+#Returns (locus x column) uint8 array of consensus characters
+def _consensus_kernel(aln, depths, threshold, mask, maf=0.0):
+	upper = _UPPER[aln]
+	pad = aln == 0
+	if not (_VALID[upper] | pad).all():
+		#Same failure as get_iupac() on an unknown character
+		raise KeyError(chr(upper[~(_VALID[upper] | pad)][0]))
+	depth = depths[:, np.newaxis]
+	nseq = aln.shape[1]
 
+	#Allele counts per column (A, C, G, T, N, -), each sequence contributing two
+	counts = np.empty((6, aln.shape[0], aln.shape[2]), dtype=np.int32)
+	for i in range(6):
+		counts[i] = _ALLELES[:,i][upper].sum(axis=1, dtype=np.int32)
+	#B, D, H, V contribute two of their three bases, picked at random like get_iupac()
+	locs, rows, cols = np.nonzero(_TRIPLE[upper] >= 0)
+	if len(cols) > 0:
+		drop = _TRIPLE_DROP[_TRIPLE[upper[locs, rows, cols]], np.random.randint(0, 3, len(cols))]
+		np.add.at(counts, (drop, locs, cols), -1)
+
+	ismask = (_LOWER[aln].sum(axis=1) / depth) > mask
+	cN = counts[4]
+	cG = counts[5]
+
+	#N or gap above threshold; ties broken by whichever appeared first in column
+	isN = upper == ord("N")
+	isG = upper == ord("-")
+	firstN = np.where(isN.any(axis=1), isN.argmax(axis=1), nseq)
+	firstG = np.where(isG.any(axis=1), isG.argmax(axis=1), nseq)
+	n_first = firstN < firstG
+	passN = (cN > 0) & ((cN / depth) * 2 >= threshold)
+	passG = (cG > 0) & ((cG / depth) * 2 >= threshold)
+	callN = passN & (n_first | ~passG)
+	callG = passG & ~callN
+
+	#Columns where N/gap alleles are the majority
+	rest = ~(callN | callG)
+	bad = rest & ((cN + cG) >= depth)
+	badN = bad & ((cN > cG) | ((cN == cG) & n_first))
+	badG = bad & ~badN
+
+	#Remaining columns are called from observed alleles
+	present = counts[0:4] > 0
+	if 0.0 < maf < 1.0:
+		multi = present.sum(axis=0) > 1
+		kept = present & ((counts[0:4] / (depth*2)) >= maf)
+		#If MAF filter removes every allele, keep the unfiltered call
+		none = ~kept.any(axis=0)
+		kept[:, none] = present[:, none]
+		present = np.where(multi, kept, present)
+	present = present.astype(np.uint8)
+	bits = present[0] | (present[1] << 1) | (present[2] << 2) | (present[3] << 3)
+
+	cons = np.where(ismask, _IUPAC_LOWER[bits], _IUPAC_UPPER[bits])
+	cons[callN] = np.where(ismask[callN], ord("n"), ord("N"))
+	cons[callG] = ord("-")
+	cons[badN] = ord("N")
+	cons[badG] = ord("-")
+	return(cons)
 
 #Function to get a list of variablePositions
 def get_vars(con):
@@ -243,3 +265,34 @@ def reverse_iupac_case(char):
 		'acgt':'n'
 	}
 	return iupac[char]
+
+#Lookup tables (indexed by ASCII code) used by make_consensus_array
+def _consensus_tables():
+	alleles = "ACGTN-"
+	upper = np.arange(256, dtype=np.uint8)
+	upper[ord("a"):ord("z")+1] -= 32
+	lower = np.zeros(256, dtype=np.uint8)
+	lower[ord("a"):ord("z")+1] = 1
+	valid = np.zeros(256, dtype=bool)
+	counts = np.zeros((256, 6), dtype=np.uint8)
+	triple = np.full(256, -1, dtype=np.int8)
+	triple_drop = np.zeros((4, 3), dtype=np.intp)
+	for c in "AGCTN-RYSWKM":
+		valid[ord(c)] = True
+		for nuc in get_iupac(c):
+			counts[ord(c), alleles.index(nuc)] += 1
+	for i, (c, nucs) in enumerate((("B","CGT"), ("D","AGT"), ("H","ACT"), ("V","ACG"))):
+		valid[ord(c)] = True
+		triple[ord(c)] = i
+		for j, nuc in enumerate(nucs):
+			counts[ord(c), alleles.index(nuc)] = 1
+			triple_drop[i, j] = alleles.index(nuc)
+	iupac_upper = np.full(16, ord("N"), dtype=np.uint8)
+	iupac_lower = np.full(16, ord("n"), dtype=np.uint8)
+	for bits in range(1, 16):
+		key = "".join(nuc for i, nuc in enumerate("ACGT") if bits & (1 << i))
+		iupac_upper[bits] = ord(reverse_iupac_case(key))
+		iupac_lower[bits] = ord(reverse_iupac_case(key.lower()))
+	return(upper, lower, valid, counts, triple, triple_drop, iupac_upper, iupac_lower)
+
+_UPPER, _LOWER, _VALID, _ALLELES, _TRIPLE, _TRIPLE_DROP, _IUPAC_UPPER, _IUPAC_LOWER = _consensus_tables()
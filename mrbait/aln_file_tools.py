@@ -1,17 +1,264 @@
 #!/usr/bin/python
 
 import os
+import re
 import sys
-import Bio
-import vcf
+import mmap
+import struct
+import tempfile
+import numpy as np
 import pandas as pd
 from mrbait import sequence_tools as s
 from mrbait import misc_utils as utils
-from Bio import AlignIO
+from mrbait import parallel_tools
+from mrbait import compress_tools
 
 """Functions for parsing and manipulating sequence alignment files
 Functions by Zach Zbinden and Tyler Chafin"""
 
+#Size of blocks read from disk by the alignment readers
+BLOCKSIZE = 1 << 22
+
+#Patterns marking record boundaries in each alignment format
+#"start" means a record begins at the match, "end" means a record ends with it
+RECORD_BOUNDARY = {
+	"loci" : (re.compile(rb"^//[^\n]*(?:\n|$)", re.M), "end"),
+	"maf" : (re.compile(rb"^a(?=[ \t\r\n]|$)", re.M), "start"),
+	"xmfa" : (re.compile(rb"^=[^\n]*(?:\n|$)", re.M), "end"),
+	"fasta" : (re.compile(rb"^>", re.M), "start")
+}
+
+#Extension of sidecar index files written next to alignment files
+INDEX_EXT = ".mbi"
+
+#Extension of samtools-style FASTA index files
+FAI_EXT = ".fai"
+
+#Signature of UCSC .2bit files, and bases for each byte of packed sequence (2 bits per base, "TCAG")
+TWOBIT_SIGNATURE = 0x1A412743
+TWOBIT_BASES = np.frombuffer(b"TCAG", dtype=np.uint8)[(np.arange(256)[:, None] >> np.array([6, 4, 2, 0])) & 3]
+
+############################# CLASSES ##################################
+
+class alignBlock():
+	'Lightweight alignment: names, (sequence x column) uint8 matrix, and optional coordinates'
+	__slots__ = ["names", "seqs", "coords"]
+	#Default constructor
+	def __init__(self, names, seqs, coords=None):
+		self.names = names
+		self.seqs = seqs
+		self.coords = coords
+
+	#Number of sequences, same as len() of a MultipleSeqAlignment
+	def __len__(self):
+		return(len(self.names))
+
+	def get_alignment_length(self):
+		return(self.seqs.shape[1])
+
+	#Returns sequence i as a string
+	def get_sequence(self, i):
+		return(self.seqs[i].tobytes().decode("ascii"))
+
+#Function to build an alignBlock from lists of names and sequences (as bytes)
+def make_align_block(names, seqs, coords=None):
+	if len(set(len(seq) for seq in seqs)) > 1:
+		raise ValueError("Sequences must all be the same length")
+	mat = np.frombuffer(b"".join(seqs), dtype=np.uint8).reshape(len(seqs), -1)
+	return(alignBlock(names, mat, coords))
+
+class fastaIndex():
+	'Memory-mapped FASTA file with a samtools-style .fai index, for random access by contig'
+	__slots__ = ["fas", "entries", "names", "fh", "mm"]
+	#Default constructor
+	#Uses fas + FAI_EXT if it is up to date and covers the whole file, otherwise indexes the file
+	#(and saves the index if write_fai)
+	#entries can be given to skip reading the index (e.g. a slice of another fastaIndex's entries)
+	#Raises ValueError if lines of a contig differ in length, as samtools faidx does
+	def __init__(self, fas, write_fai=False, entries=None):
+		if not utils.fileCheck(fas):
+			raise FileNotFoundError("Fatal exception, file %s not found."%fas)
+		if compress_tools.is_gzip(fas):
+			raise ValueError("File is compressed, so can't be memory-mapped")
+		self.fas = fas
+		self.fh = open(fas, "rb")
+		self.mm = None
+		try:
+			if os.path.getsize(fas) > 0:
+				self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+			if entries is None:
+				entries = self._load_entries(write_fai)
+		except:
+			self.close()
+			raise
+		self.entries = entries
+		#Lookup of contig name to record number; the last of any duplicate names wins
+		self.names = {entry[0] : i for i, entry in enumerate(entries)}
+
+	def __enter__(self):
+		return(self)
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+		return(False)
+
+	#Number of records, including any duplicate names
+	def __len__(self):
+		return(len(self.entries))
+
+	#Iterates over contig names in file order
+	def __iter__(self):
+		return(iter([entry[0] for entry in self.entries]))
+
+	def __contains__(self, name):
+		return(name in self.names)
+
+	#Returns length of contig
+	def length(self, name):
+		return(self.entries[self.names[name]][1])
+
+	#Returns sequence of contig from start to stop (0-based, stop excluded)
+	#Slices within one line are zero-copy memoryviews of the mapped file, others are bytes
+	def fetch(self, name, start=0, stop=None):
+		return(self.fetch_record(self.names[name], start, stop))
+
+	#Same as fetch, using the record number instead of name
+	def fetch_record(self, i, start=0, stop=None):
+		name, length, offset, linebases, linewidth = self.entries[i]
+		start = max(0, start)
+		stop = length if stop is None else min(stop, length)
+		if start >= stop:
+			return(b"")
+		first_line, last_line = start // linebases, (stop - 1) // linebases
+		first = offset + first_line * linewidth + start % linebases
+		last = offset + last_line * linewidth + (stop - 1) % linebases + 1
+		if first_line == last_line:
+			return(memoryview(self.mm)[first:last])
+		return(self.mm[first:last].translate(None, b"\r\n"))
+
+	#Unmap and close the file
+	#Any memoryviews returned by fetch must be released first
+	def close(self):
+		if self.mm is not None:
+			self.mm.close()
+			self.mm = None
+		self.fh.close()
+
+	#Function to read the .fai if it is current, or to index the file (internal)
+	#A .fai which doesn't reach the end of the file (e.g. cut off by a killed run) is ignored
+	def _load_entries(self, write_fai):
+		fai = self.fas + FAI_EXT
+		if os.path.isfile(fai) and os.path.getmtime(fai) >= os.path.getmtime(self.fas):
+			try:
+				entries = read_fai(fai)
+				if fai_covers(entries, self.mm):
+					return(entries)
+			except (OSError, ValueError, IndexError):
+				pass
+		entries = list() if self.mm is None else index_fasta(self.mm)
+		if write_fai:
+			try:
+				write_fai_file(entries, fai)
+			except OSError as err:
+				print("\t\t\tWarning: Could not write index file %s: %s"%(fai, err))
+		return(entries)
+
+class twoBitFile(fastaIndex):
+	'Memory-mapped UCSC .2bit file, with the same random access interface as fastaIndex'
+	__slots__ = []
+	#Default constructor
+	#Entries are (name, length, offset of record); as for fastaIndex, they can be given to skip the header
+	def __init__(self, fas, entries=None):
+		if not utils.fileCheck(fas):
+			raise FileNotFoundError("Fatal exception, file %s not found."%fas)
+		self.fas = fas
+		self.fh = open(fas, "rb")
+		self.mm = None
+		try:
+			self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+			if entries is None:
+				entries = self._read_header()
+		except:
+			self.close()
+			raise
+		self.entries = entries
+		self.names = {entry[0] : i for i, entry in enumerate(entries)}
+
+	#Returns sequence of record from start to stop (0-based, stop excluded) as bytes
+	#N blocks are returned as N, and soft-masked blocks in lowercase
+	def fetch_record(self, i, start=0, stop=None):
+		name, length, offset = self.entries[i]
+		start = max(0, start)
+		stop = length if stop is None else min(stop, length)
+		if start >= stop:
+			return(b"")
+		order = self._byteorder()
+		nblocks, offset = self._read_blocks(offset + 4, order)
+		masks, offset = self._read_blocks(offset, order)
+		offset += 4 #reserved
+		packed = np.frombuffer(self.mm, dtype=np.uint8, count=(stop+3)//4 - start//4, offset=offset + start//4)
+		seq = TWOBIT_BASES[packed].reshape(-1)[start%4 : start%4 + stop - start]
+		del packed
+		seq[_blocks_overlap(nblocks, start, stop)] = ord("N")
+		seq[_blocks_overlap(masks, start, stop)] |= 0x20
+		return(seq.tobytes())
+
+	#Function to get byte order of the file from its signature (internal)
+	def _byteorder(self):
+		return("<" if struct.unpack_from("<I", self.mm, 0)[0] == TWOBIT_SIGNATURE else ">")
+
+	#Function to read (starts, sizes) block arrays at offset (internal)
+	#Returns the blocks as a (2 x n) array, and the offset after them
+	def _read_blocks(self, offset, order):
+		count = struct.unpack_from(order + "I", self.mm, offset)[0]
+		blocks = np.frombuffer(self.mm, dtype=order + "u4", count=2*count, offset=offset+4).astype(np.int64)
+		return(blocks.reshape(2, count), offset + 4 + 8*count)
+
+	#Function to read names, lengths, and offsets of records (internal)
+	def _read_header(self):
+		if len(self.mm) < 16 or not is_twobit(self.fas):
+			raise ValueError("File %s is not a .2bit file"%self.fas)
+		order = self._byteorder()
+		version, count = struct.unpack_from(order + "II", self.mm, 4)
+		if version not in (0, 1):
+			raise ValueError("Unsupported .2bit version %s in %s"%(version, self.fas))
+		pointer = order + ("I" if version == 0 else "Q")
+		entries = list()
+		position = 16
+		for i in range(count):
+			size = self.mm[position]
+			name = self.mm[position+1:position+1+size].decode()
+			offset = struct.unpack_from(pointer, self.mm, position+1+size)[0]
+			position += 1 + size + struct.calcsize(pointer)
+			length = struct.unpack_from(order + "I", self.mm, offset)[0]
+			entries.append((name, length, offset))
+		return(entries)
+
+######################## STATIC FUNCTIONS ##############################
+
+#Function to make a boolean mask of bases [start, stop) covered by (2 x n) (starts, sizes) blocks (internal)
+def _blocks_overlap(blocks, start, stop):
+	covered = np.zeros(stop - start + 1, dtype=np.int32)
+	lo = np.clip(blocks[0], start, stop) - start
+	hi = np.clip(blocks[0] + blocks[1], start, stop) - start
+	keep = lo < hi
+	np.add.at(covered, lo[keep], 1)
+	np.add.at(covered, hi[keep], -1)
+	return(np.cumsum(covered[:-1]) > 0)
+
+#Function to check whether a file is in UCSC .2bit format, from its signature
+def is_twobit(infile):
+	with open(infile, "rb") as fh:
+		head = fh.read(4)
+	return(len(head) == 4 and TWOBIT_SIGNATURE in struct.unpack("<I", head) + struct.unpack(">I", head))
+
+#Function to open an assembly for random access by contig
+#.2bit files are opened as a twoBitFile, anything else as a fastaIndex (see those for entries)
+def open_reference(fas, entries=None):
+	if is_twobit(fas):
+		return(twoBitFile(fas, entries=entries))
+	return(fastaIndex(fas, entries=entries))
+
 #Write FASTA from pandas df where col1 is index, col2 is sequence
 #seqs must be a pandas df
 def writeFasta(seqs, fas):
@@ -90,69 +337,345 @@ def reverseComplementFasta(infile, outfile):
 #Read genome as FASTA. FASTA header will be used
 #This is a generator function
 #Doesn't matter if sequences are interleaved or not.
-def read_fasta(fas):
-
-	if not utils.fileCheck(fas):
-		raise FileNotFoundError("Fatal exception, file %s not found."%fas)
-	fh = open(fas)
+#Every header is yielded (even with empty sequence), so records can be numbered
+#Optionally reads only the byte range [start, end) (see index_alignment)
+def read_fasta(fas, start=0, end=None):
+	contig = None
+	seq = list()
+	for line in read_lines(fas, start=start, end=end):
+		if not line:
+			continue
+		if line[0] == 62: #">", Found a header line
+			#If we already loaded a contig, yield that contig and
+			#start loading a new one
+			if contig is not None:
+				yield([contig.decode(), b"".join(seq).decode()]) #yield
+				seq = list() #reset seq
+			#Name is the header up to the first whitespace, as in a .fai index
+			contig = line[1:].split()
+			contig = contig[0] if contig else b""
+		else:
+			seq.append(line.replace(b" ",b""))
+	#yield last sequence
+	if contig is not None:
+		yield([contig.decode(), b"".join(seq).decode()])
+
+
+#Function to build samtools-style .fai entries for a (memory-mapped) FASTA file
+#Contig names are the header up to the first whitespace
+#Line regularity is checked with strided numpy views instead of walking each line
+#RETURNS: list of (name, length, offset, linebases, linewidth) tuples, in file order
+def index_fasta(mm):
+	data = np.frombuffer(mm, dtype=np.uint8)
+	starts = [match.start() for match in RECORD_BOUNDARY["fasta"][0].finditer(mm)]
+	ends = starts[1:] + [len(mm)]
+	entries = list()
+	for head, end in zip(starts, ends):
+		eol = mm.find(b"\n", head, end)
+		offset = end if eol == -1 else eol + 1
+		name = mm[head+1:offset].split()
+		name = name[0].decode() if name else ""
+		while end > offset and data[end-1] in (10, 13, 32, 9):
+			end -= 1
+		layout = _fasta_record_layout(mm, data, offset, end)
+		if layout is None:
+			break
+		entries.append((name,) + layout)
+	#Views of the map must be gone before raising, so the caller can close it
+	del data
+	if len(entries) < len(starts):
+		raise ValueError("Different line length in sequence '%s'"%name)
+	return(entries)
+
+#Function to get (length, offset, linebases, linewidth) of sequence bytes [offset, end) (internal)
+#end must not include trailing newlines
+#Returns None if lines are not all the same length
+def _fasta_record_layout(mm, data, offset, end):
+	if end <= offset:
+		return(0, offset, 0, 0)
+	eol = mm.find(b"\n", offset, end)
+	if eol == -1:
+		size = end - offset
+		return(size, offset, size, size + 1)
+	seq = data[offset:end]
+	linewidth = eol - offset + 1
+	linebases = linewidth - 1 - int(seq[linewidth-2] == 13) if linewidth > 1 else 0
+	full = int(np.count_nonzero(seq == 10))
+	lastline = len(seq) - full * linewidth
+	#Every full line ends at a multiple of linewidth, and there are no other newlines
+	regular = linebases > 0 and 0 < lastline <= linebases
+	if regular:
+		regular = bool((seq[linewidth-1:full*linewidth:linewidth] == 10).all())
+	if regular and linewidth - linebases == 2:
+		regular = bool((seq[linewidth-2:full*linewidth:linewidth] == 13).all())
+	if not regular:
+		return(None)
+	return(full * linebases + lastline, offset, linebases, linewidth)
+
+#Function to read a samtools-style .fai file
+#Raises ValueError on a malformed line, e.g. one cut off while the file was written
+#RETURNS: list of (name, length, offset, linebases, linewidth) tuples
+def read_fai(fai):
+	entries = list()
+	with open(fai, "r") as fh:
+		for line in fh:
+			fields = line.rstrip("\n").split("\t")
+			if len(fields) < 5:
+				raise ValueError("Malformed line in index file %s"%fai)
+			entries.append((fields[0],) + tuple(int(x) for x in fields[1:5]))
+	return(entries)
+
+#Function to get the offset just past the last base of a .fai entry
+def fai_entry_end(entry):
+	name, length, offset, linebases, linewidth = entry
+	if length == 0 or linebases == 0:
+		return(offset)
+	full, rem = divmod(length, linebases)
+	if rem:
+		return(offset + full * linewidth + rem)
+	return(offset + (full - 1) * linewidth + linebases)
+
+#Function to check that .fai entries cover a whole (memory-mapped) FASTA file,
+#so only whitespace follows the end of the last contig
+def fai_covers(entries, mm):
+	size = 0 if mm is None else len(mm)
+	end = max((fai_entry_end(entry) for entry in entries), default=0)
+	return(end <= size and (mm is None or not mm[end:].strip()))
+
+#Function to write .fai entries (see index_fasta) in samtools format
+def write_fai_file(entries, fai):
+	write_atomic(fai, lambda fh: fh.writelines("%s\t%s\t%s\t%s\t%s\n"%entry for entry in entries))
+
+#Function to write a file through a temporary file in the same directory, renamed into place once complete,
+#so a killed run (or two runs at once) never leave a partly written file
+#write is called with the open temporary file; mode is "w" (text) or "wb" (binary)
+def write_atomic(path, write, mode="w"):
+	fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=os.path.basename(path) + ".")
 	try:
-		with fh as file_object:
-			contig = ""
-			seq = ""
-			for line in file_object:
-				line = line.strip()
-				if not line:
-					continue
-				line = line.replace(" ","")
-				#print(line)
-				if line[0] == ">": #Found a header line
-					#If we already loaded a contig, yield that contig and
-					#start loading a new one
-					if contig:
-						yield([contig,seq]) #yield
-						contig = "" #reset contig and seq
-						seq = ""
-					contig = (line.replace(">",""))
+		with os.fdopen(fd, mode) as fh:
+			write(fh)
+		os.replace(tmp, path)
+	except:
+		if os.path.exists(tmp):
+			os.remove(tmp)
+		raise
+
+#Generator yielding [name, sequence] for records first to last (excluded) of a fastaIndex
+#Yields every record, including empty ones, so records can be numbered
+def read_fasta_indexed(ref, first=0, last=None):
+	last = len(ref) if last is None else last
+	for i in range(first, last):
+		yield([ref.entries[i][0], bytes(ref.fetch_record(i)).decode()])
+
+#Generator to read a (possibly gzip or bgzip compressed) file in large buffered blocks
+#Optionally reads only the byte range [start, end) of the uncompressed data,
+#which is relative to voffset if given (a virtual offset of a bgzip file, see compress_tools.open_input)
+#YIELDS: each line as bytes, with surrounding whitespace stripped
+def read_lines(infile, blocksize=BLOCKSIZE, start=0, end=None, voffset=None):
+	if not utils.fileCheck(infile):
+		raise FileNotFoundError("Fatal exception, file %s not found."%infile)
+	remaining = None if end is None else end - start
+	with compress_tools.open_input(infile, start=start, voffset=voffset, size=remaining) as fh:
+		rest = b""
+		while remaining is None or remaining > 0:
+			block = fh.read(blocksize if remaining is None else min(blocksize, remaining))
+			if not block:
+				break
+			if remaining is not None:
+				remaining -= len(block)
+			lines = (rest + block).split(b"\n")
+			rest = lines.pop()
+			for line in lines:
+				yield(line.strip())
+		if rest:
+			yield(rest.strip())
+
+#Function to index record boundaries of an alignment (or FASTA) file in one pass
+#fmt is one of "loci", "maf", "xmfa", or "fasta"
+#Record i spans bytes offsets[i] to offsets[i+1]
+#If sidecar, index is saved to (and re-used from) infile + INDEX_EXT
+#RETURNS: numpy array of byte offsets, length is number of records + 1
+def index_alignment(infile, fmt, sidecar=False):
+	if not utils.fileCheck(infile):
+		raise FileNotFoundError("Fatal exception, file %s not found."%infile)
+	stat = os.stat(infile)
+	stamp = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+	idx_file = infile + INDEX_EXT
+	if os.path.isfile(idx_file):
+		try:
+			saved = np.fromfile(idx_file, dtype=np.int64)
+			if len(saved) > 2 and (saved[0:2] == stamp).all():
+				return(saved[2:])
+		except (OSError, ValueError):
+			pass
+
+	pattern, side = RECORD_BOUNDARY[fmt]
+	if stat.st_size == 0:
+		offsets = np.zeros(1, dtype=np.int64)
+	elif compress_tools.is_gzip(infile):
+		offsets = np.array(_stream_boundaries(infile, pattern, side), dtype=np.int64)
+	else:
+		with open(infile, "rb") as fh:
+			with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+				if side == "start":
+					bounds = [match.start() for match in pattern.finditer(mm)]
+					bounds.append(stat.st_size)
 				else:
-					seq += line
-		#Iyield last sequence, if it has both a header and sequence
-		if contig and seq:
-			yield([contig,seq])
-	finally:
-		fh.close()
+					bounds = [0] + [match.end() for match in pattern.finditer(mm)]
+		offsets = np.array(bounds, dtype=np.int64)
 
+	if sidecar:
+		try:
+			write_atomic(idx_file, np.concatenate((stamp, offsets)).tofile, mode="wb")
+		except OSError as err:
+			print("\t\t\tWarning: Could not write index file %s: %s"%(idx_file, err))
+	return(offsets)
+
+#Function to find record boundaries in the uncompressed data of a gzip file (internal)
+#Data is searched in blocks cut after the last newline, so patterns anchored by ^ still work
+def _stream_boundaries(infile, pattern, side):
+	bounds = list() if side == "start" else [0]
+	base = 0
+	rest = b""
+	with compress_tools.open_input(infile) as fh:
+		while True:
+			block = fh.read(BLOCKSIZE)
+			data = rest + block
+			if block:
+				cut = data.rfind(b"\n") + 1
+				data, rest = data[:cut], data[cut:]
+			for match in pattern.finditer(data):
+				bounds.append(base + (match.start() if side == "start" else match.end()))
+			base += len(data)
+			if not block:
+				break
+	if side == "start":
+		bounds.append(base)
+	return(bounds)
+
+#Function to split indexed records into n byte ranges of similar size
+#Ranges always start on a record boundary; last range runs to end of file
+#If infile is given and is gzip (but not bgzip) compressed, it can only be read from the start, so isn't split
+#RETURNS: list of (start, end) tuples, where end of None means EOF
+def index_ranges(offsets, n, infile=None):
+	if infile is not None and not compress_tools.is_splittable(infile):
+		print("\t\t\tWarning: %s is gzip compressed, so it is read by a single worker (compress it with bgzip to read it in parallel)."%infile)
+		n = 1
+	ranges = [(int(offsets[i]), int(offsets[j])) for i, j in parallel_tools.split_balanced(offsets, n)]
+	if ranges:
+		ranges[-1] = (ranges[-1][0], None)
+	return(ranges)
 
 #This is a GENERATOR function to read through a .loci file
 #.loci is the RAD alignment output from the promgram pyRAD
-#YIELDS: BioPython MultipleSeqAlignment object
-def read_loci(infile):
-
-	if not utils.fileCheck(infile):
-		raise FileNotFoundError("Fatal exception, file %s not found."%infile)
-
-	# make emptyp dictionary
-	loci = Bio.Align.MultipleSeqAlignment([])
-	# read file from command line
-	try:
-		f = open(infile)
-	except IOError as err:
-		print("I/O error({0}): {1}".format(err.errno, err.strerror))
-	except:
-		print("Unexpected error:", sys.exec_info()[0])
-
-	with f as file_object:
-		for line in file_object:
-			line = line.strip()
-			if not line:
+#Optionally reads only the byte range [start, end) (see index_alignment)
+#YIELDS: alignBlock object
+def read_loci(infile, start=0, end=None):
+	names = list()
+	seqs = list()
+	for line in read_lines(infile, start=start, end=end):
+		if not line:
+			continue
+		if line[0] != 47: #"/"
+			fields = line.split()
+			names.append(fields[0].decode())
+			seqs.append(fields[1])
+		else:
+			if names:
+				yield(make_align_block(names, seqs))
+			names = list()
+			seqs = list()
+
+#This is a GENERATOR function to read through a MAF file
+#Optionally reads only the byte range [start, end) (see index_alignment)
+#YIELDS: alignBlock object, coords holds (src, start, size, strand, srcSize) per sequence
+def read_maf(infile, start=0, end=None):
+	names = list()
+	seqs = list()
+	coords = list()
+	inblock = False
+	for line in read_lines(infile, start=start, end=end):
+		if inblock:
+			if line[:1] == b"s":
+				fields = line.split()
+				if len(fields) != 7:
+					raise ValueError("Error parsing alignment - 's' line must have 7 fields")
+				src = fields[1].decode()
+				names.append(src)
+				seqs.append(fields[6])
+				coords.append((src, int(fields[2]), int(fields[3]), fields[4].decode(), int(fields[5])))
 				continue
-			if line[0] != "/":
-				identifier = line.split()[0]
-				sequence = line.split()[1]
-				loci.add_sequence(identifier, sequence)
-			else:
-				yield(loci)
-				loci = Bio.Align.MultipleSeqAlignment([])
-	f.close()
+			elif line and line[:1] != b"a":
+				#i, e, q, and comment lines are ignored
+				continue
+			#Blank line or new block ends current alignment
+			if names:
+				yield(_maf_block(names, seqs, coords))
+			names = list()
+			seqs = list()
+			coords = list()
+			inblock = False
+		if line[:1] == b"a":
+			inblock = True
+	if names:
+		yield(_maf_block(names, seqs, coords))
+
+#Function to build alignBlock for MAF, where "." means same as first sequence
+def _maf_block(names, seqs, coords):
+	block = make_align_block(names, seqs, coords)
+	if any(b"." in seq for seq in seqs[1:]):
+		mat = block.seqs.copy()
+		dots = mat == ord(".")
+		mat[dots] = np.broadcast_to(mat[0], mat.shape)[dots]
+		block.seqs = mat
+	if (block.seqs[0] == ord(".")).any():
+		raise ValueError("Found dot/period in first sequence of alignment")
+	return(block)
+
+#This is a GENERATOR function to read through an XMFA (Mauve) file
+#Sequences are ordered by when each sequence id is first seen in the file,
+#and sequences with a header but no sequence are filled with gaps
+#Optionally reads only the byte range [start, end) (see index_alignment)
+#YIELDS: alignBlock object, coords holds (id, start, end, strand) per sequence
+def read_xmfa(infile, start=0, end=None):
+	order = dict()
+	seqs = dict()
+	coords = dict()
+	current = None
+	for line in read_lines(infile, start=start, end=end):
+		if not line or line[0] == 35: #"#"
+			continue
+		if line[0] == 61: #"="
+			if seqs:
+				yield(_xmfa_block(order, seqs, coords))
+			seqs = dict()
+			coords = dict()
+			current = None
+		elif line[0] == 62: #">"
+			fields = line[1:].split(None, 2)
+			if len(fields) < 2 or b":" not in fields[0]:
+				raise ValueError("Malformed header line: %s"%line.decode())
+			id, pos = fields[0].decode().split(":")
+			start, end = pos.split("-")
+			#Convert to zero based
+			coords[id] = (id, max(int(start)-1, 0), int(end), fields[1].decode())
+			order.setdefault(id, len(order))
+			seqs.setdefault(id, list())
+			current = id
+		else:
+			if current is None:
+				raise ValueError("Saw sequence before definition line")
+			seqs[current].append(line)
+	if seqs:
+		yield(_xmfa_block(order, seqs, coords))
+
+#Function to build alignBlock for an XMFA alignment
+def _xmfa_block(order, seqs, coords):
+	ids = sorted(seqs, key=order.get)
+	joined = [b"".join(seqs[id]) for id in ids]
+	alen = max(len(seq) for seq in joined)
+	joined = [seq if seq else b"-"*alen for seq in joined]
+	return(make_align_block(ids, joined, [coords[id] for id in ids]))
 
 #Function to remove existing CHUNK files
 def removeChunks(dir_name):
@@ -164,38 +687,38 @@ def removeChunks(dir_name):
 
 #function to count number of loci alignments in file
 def countLoci(loci):
-	fh  = open(loci, 'r')
 	count=0
-	for l in fh:
-		line = l.strip()
-		if not line:
-			continue
-		if line.startswith("//"):
-			count+=1
+	with compress_tools.open_input(loci, "rt") as fh:
+		for l in fh:
+			line = l.strip()
+			if not line:
+				continue
+			if line.startswith("//"):
+				count+=1
 	return(count)
 
 #function to count number of loci in FASTA file (by headers)
 def countMAF(loci):
-	fh  = open(str(loci), 'r')
 	count=0
-	for l in fh:
-		line = l.strip()
-		if not line:
-			continue
-		if line.startswith("a"):
-			count+=1
+	with compress_tools.open_input(str(loci), "rt") as fh:
+		for l in fh:
+			line = l.strip()
+			if not line:
+				continue
+			if line.startswith("a"):
+				count+=1
 	return(count)
 
 #function to count number of loci in FASTA file (by headers)
 def countXMFA(loci):
-	fh  = open(str(loci), 'r')
 	count=0
-	for l in fh:
-		line = l.strip()
-		if not line:
-			continue
-		if line.startswith("="):
-			count+=1
+	with compress_tools.open_input(str(loci), "rt") as fh:
+		for l in fh:
+			line = l.strip()
+			if not line:
+				continue
+			if line.startswith("="):
+				count+=1
 	return(count)
 
 
@@ -212,7 +735,7 @@ def generic_chunker(infile, chunks, wd):
 
 	files = list()
 	#write .loci file into chunk files
-	with open(infile) as file_object:
+	with compress_tools.open_input(infile, "rt") as file_object:
 		max_chunks = chunks
 		chunks = 1
 		line_number = 1
@@ -246,209 +769,3 @@ def generic_chunker(infile, chunks, wd):
 		out_object.close()
 		file_object.close()
 	return(files)
-
-#Function split .loci file into n chunks
-def loci_chunker(infile, chunks, wd):
-
-	chunks = int(chunks)
-	loci_count = countLoci(infile)
-	if loci_count < chunks:
-		chunks = loci_count
-	chunk_size = loci_count // chunks
-	removeChunks(wd)
-
-	files = list()
-	#write .loci file into chunk files
-	with open(infile) as file_object:
-		max_chunks = chunks
-		chunks = 1
-		loci_number = 1
-
-		chunk_file = wd + "/." + str(chunks) + ".chunk"
-		out_object = open(chunk_file, "w")
-		files.append(chunk_file)
-
-		for l in file_object:
-			line = l.strip()
-			if not line:
-				continue
-			if chunks < max_chunks:
-				if loci_number <= chunk_size:
-					if line[0] == ">":
-						out = line + "\n"
-						out_object.write(out)
-					else:
-						loci_number = loci_number + 1
-						out = line + "\n"
-						out_object.write(out)
-				else:
-					loci_number = 1
-					chunks = chunks + 1
-					out_object.close()
-					chunk_file = wd + "/." + str(chunks) + ".chunk"
-					out_object = open(chunk_file, "w")
-					files.append(chunk_file)
-					out = line + "\n"
-					out_object.write(out)
-			else:
-				#If last chunk, keep writing to final chunk file
-				out = line + "\n"
-				out_object.write(out)
-		out_object.close()
-		file_object.close()
-			# else:
-			# 	chunks = max_chunks
-			# 	out_object.write(line.strip())
-	return(files)
-
-#Function to split maf file into n chunks
-def maf_chunker(infile, chunks, wd):
-
-	chunks = int(chunks)
-	loci_count = countMAF(infile)
-	if loci_count < chunks:
-		chunks = loci_count
-	chunk_size = loci_count // chunks
-	removeChunks(wd) #clear any existing chunkfiles
-
-	files = list()
-	#write .loci file into chunk files
-	with open(infile) as file_object:
-		max_chunks = chunks
-		chunks = 1
-		loci_number = 0
-
-		chunk_file = wd + "/." + str(chunks) + ".chunk"
-		out_object = open(chunk_file, "w")
-		files.append(chunk_file)
-
-		header = ""
-		hset = 0
-		for l in file_object:
-			line = l.strip()
-			if not line:
-				continue
-			#First, get header information
-			if hset == 0:
-				if line[0] == "a":
-					loci_number = 1
-					hset=1
-					header += "\n"
-					out_object.write(header)
-					out = "\n" + line + "\n"
-					out_object.write(out)
-				elif line[0] =="#":
-					header +=str(line+"\n")
-			else:
-				#Write chunk_size alignments to each chunk
-				if chunks < max_chunks:
-					#If starting new alignment
-					if line[0] == "a":
-						loci_number += 1 #increment locus number
-					 	#If current chunk not full, add locus to chunk
-						if loci_number <= chunk_size:
-							out = "\n" + line + "\n"
-							out_object.write(out)
-						#Otherwise, start new chunk
-						else:
-							loci_number = 1
-							chunks = chunks + 1
-							out_object.close()
-							chunk_file = wd + "/." + str(chunks) + ".chunk"
-							out_object = open(chunk_file, "w")
-							out_object.write(header)
-							files.append(chunk_file)
-							out = line + "\n"
-							out_object.write(out)
-					#If not new alignment, write to current chunk
-					else:
-						out = line + "\n"
-						out_object.write(out)
-
-				#If last chunk, keep writing to final chunk file
-				else:
-					if line[0] == "a":
-						out = "\n" + line + "\n"
-					else:
-						out = line + "\n"
-					out_object.write(out)
-		out_object.close()
-		file_object.close()
-			# else:
-			# 	chunks = max_chunks
-			# 	out_object.write(line.strip())
-	return(files)
-
-#Function to split xmfa file into n chunks
-def xmfa_chunker(infile, chunks, wd):
-
-	chunks = int(chunks)
-	loci_count = countXMFA(infile)
-	if loci_count < chunks:
-		chunks = loci_count
-	chunk_size = loci_count // chunks
-	removeChunks(wd)
-
-	files = list()
-	#write .loci file into chunk files
-	with open(infile) as file_object:
-		max_chunks = chunks
-		chunks = 1
-		loci_number = 1
-
-		chunk_file = wd + "/." + str(chunks) + ".chunk"
-		out_object = open(chunk_file, "w")
-		files.append(chunk_file)
-
-		header = ""
-		hset = 0
-		for l in file_object:
-			line = l.strip()
-			if not line:
-				continue
-			#First, get header information
-			if hset == 0:
-				if line[0] == ">":
-					loci_number = 1
-					hset=1
-					out_object.write(header)
-					out = line + "\n"
-					out_object.write(out)
-				elif line[0] =="#":
-					header +=str(line+"\n")
-			else:
-				if chunks < max_chunks:
-					if loci_number <= chunk_size:
-						#If its the header for a sequence, start seq
-						if line[0] == ">":
-							out = line + "\n"
-							out_object.write(out)
-						#If end of alignment, deposit it
-						elif line[0] == "=":
-							loci_number = loci_number + 1
-							out = line + "\n"
-							out_object.write(out)
-						#otherwise its a sequence!
-						else:
-							out = line + "\n"
-							out_object.write(out)
-					else:
-						loci_number = 1
-						chunks = chunks + 1
-						out_object.close()
-						chunk_file = wd + "/." + str(chunks) + ".chunk"
-						out_object = open(chunk_file, "w")
-						out_object.write(header)
-						files.append(chunk_file)
-						out = line + "\n"
-						out_object.write(out)
-				else:
-					#If last chunk, keep writing to final chunk file
-					out = line + "\n"
-					out_object.write(out)
-		out_object.close()
-		file_object.close()
-			# else:
-			# 	chunks = max_chunks
-			# 	out_object.write(line.strip())
-	return(files)
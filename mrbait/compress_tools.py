@@ -0,0 +1,303 @@
+#!/usr/bin/python
+
+import io
+import os
+import gzip
+import queue
+import struct
+import threading
+import functools
+import numpy as np
+
+"""
+
+Transparent reading of gzip and bgzip (BGZF) compressed inputs.
+
+Decompression runs in a background thread (zlib releases the GIL), which fills a
+bounded queue of blocks so that it overlaps with parsing. BGZF files can also be
+opened at any offset of the uncompressed data using their block index (see
+bgzf_index), so compressed alignments can be split between parallel workers, or at a
+virtual offset from a tabix index (see tabix_index), so only the indexed records are read.
+
+"""
+
+#First bytes of any gzip (or bgzip) file
+GZIP_MAGIC = b"\x1f\x8b"
+
+#Extension of bgzip block index files (as written by bgzip -i)
+GZI_EXT = ".gzi"
+
+#Extensions of tabix index files (as written by tabix, or bcftools index)
+TABIX_EXTS = (".tbi", ".csi")
+
+#Size of decompressed blocks, and number of blocks decompressed ahead of the reader
+BLOCKSIZE = 1 << 22
+PREFETCH_BLOCKS = 4
+
+############################# CLASSES ##################################
+
+class prefetchReader(io.RawIOBase):
+	'Read-only binary stream, filled ahead of the reader by a background thread'
+	#Default constructor
+	#fh is a binary file object (e.g. a GzipFile), read in blocksize pieces by the thread
+	#raw is an underlying file to close along with fh, if any
+	#limit is the number of bytes to read from fh, if not all of them
+	def __init__(self, fh, raw=None, blocksize=BLOCKSIZE, prefetch=PREFETCH_BLOCKS, limit=None):
+		super().__init__()
+		self.fh = fh
+		self.raw = raw
+		self.blocksize = blocksize
+		self.limit = limit
+		self.blocks = queue.Queue(maxsize=prefetch)
+		self.block = memoryview(b"")
+		self.done = False
+		self.stopping = threading.Event()
+		self.thread = threading.Thread(target=self._fill, daemon=True)
+		self.thread.start()
+
+	def readable(self):
+		return(True)
+
+	def readinto(self, b):
+		while not len(self.block):
+			if self.done:
+				return(0)
+			block = self.blocks.get()
+			if isinstance(block, BaseException):
+				self.done = True
+				raise block
+			if not block:
+				self.done = True
+				return(0)
+			self.block = memoryview(block)
+		n = min(len(b), len(self.block))
+		b[:n] = self.block[:n]
+		self.block = self.block[n:]
+		return(n)
+
+	#Stop the background thread and close files
+	def close(self):
+		if not self.closed:
+			self.stopping.set()
+			self.thread.join()
+			self.fh.close()
+			if self.raw is not None:
+				self.raw.close()
+		super().close()
+
+	#Function run by the background thread, queueing blocks until EOF (empty block) or an error (internal)
+	def _fill(self):
+		try:
+			remaining = self.limit
+			while not self.stopping.is_set():
+				block = self.fh.read(self.blocksize if remaining is None else min(self.blocksize, remaining))
+				if remaining is not None:
+					remaining -= len(block)
+				self._put(block)
+				if not block:
+					return
+		except BaseException as err:
+			self._put(err)
+
+	#Function to queue an item, giving up if the reader is closed (internal)
+	def _put(self, item):
+		while not self.stopping.is_set():
+			try:
+				self.blocks.put(item, timeout=0.1)
+				return
+			except queue.Full:
+				continue
+
+######################## STATIC FUNCTIONS ##############################
+
+#Function to check whether a file is gzip (or bgzip) compressed, from its first bytes
+def is_gzip(infile):
+	with open(infile, "rb") as fh:
+		return(fh.read(2) == GZIP_MAGIC)
+
+#Function to check whether a file is bgzip compressed (gzip with a "BC" extra subfield)
+def is_bgzf(infile):
+	with open(infile, "rb") as fh:
+		header = fh.read(12)
+		if len(header) < 12 or header[:2] != GZIP_MAGIC or not header[3] & 4:
+			return(False)
+		xlen = struct.unpack_from("<H", header, 10)[0]
+		return(_bsize(fh.read(xlen)) is not None)
+
+#Function to check whether a file can be opened at any offset (plain text or bgzip)
+def is_splittable(infile):
+	return(not is_gzip(infile) or is_bgzf(infile))
+
+#Function to get the block size field from the extra field of a BGZF header (internal)
+#Returns None if there is no "BC" subfield
+def _bsize(extra):
+	i = 0
+	while i + 4 <= len(extra):
+		slen = struct.unpack_from("<H", extra, i+2)[0]
+		if extra[i:i+2] == b"BC" and slen == 2:
+			return(struct.unpack_from("<H", extra, i+4)[0])
+		i += 4 + slen
+	return(None)
+
+#Function to get the block index of a BGZF file
+#Uses infile + GZI_EXT if it is up to date, otherwise reads the block headers
+#Results are cached, so each process only indexes a file once
+#RETURNS: (compressed offsets, uncompressed offsets) numpy arrays, one pair per block start
+def bgzf_index(infile):
+	stat = os.stat(infile)
+	return(_bgzf_index(os.path.abspath(infile), stat.st_size, stat.st_mtime_ns))
+
+#Function behind bgzf_index, cached by file size and modification time (internal)
+@functools.lru_cache(maxsize=8)
+def _bgzf_index(infile, size, mtime):
+	gzi = infile + GZI_EXT
+	if os.path.isfile(gzi) and os.stat(gzi).st_mtime_ns >= mtime:
+		saved = np.fromfile(gzi, dtype="<u8")
+		if len(saved) and len(saved) == 1 + 2*saved[0]:
+			pairs = saved[1:].astype(np.int64).reshape(-1, 2)
+			return(np.concatenate(([0], pairs[:, 0])), np.concatenate(([0], pairs[:, 1])))
+	coffsets = [0]
+	uoffsets = [0]
+	with open(infile, "rb") as fh:
+		pos = 0
+		while pos < size:
+			bsize, isize = _block_sizes(fh, pos, infile)
+			pos += bsize + 1
+			if pos < size:
+				coffsets.append(pos)
+				uoffsets.append(uoffsets[-1] + isize)
+	return(np.array(coffsets, dtype=np.int64), np.array(uoffsets, dtype=np.int64))
+
+#Function to read the BSIZE field (block size - 1) and uncompressed size of the BGZF block at pos (internal)
+def _block_sizes(fh, pos, infile):
+	fh.seek(pos)
+	header = fh.read(12)
+	if len(header) < 12 or header[:2] != GZIP_MAGIC or not header[3] & 4:
+		raise ValueError("File %s is not bgzip compressed (bad block at offset %s)"%(infile, pos))
+	bsize = _bsize(fh.read(struct.unpack_from("<H", header, 10)[0]))
+	if bsize is None:
+		raise ValueError("File %s is not bgzip compressed (bad block at offset %s)"%(infile, pos))
+	fh.seek(pos + bsize - 3)
+	return(bsize, struct.unpack("<I", fh.read(4))[0])
+
+#Function to count the uncompressed bytes between two virtual offsets of a BGZF file
+#A virtual offset is (offset of a block in the file << 16 | offset in its uncompressed data)
+#Only the headers of blocks between the two are read
+def virtual_span(infile, vstart, vend):
+	span = (vend & 0xFFFF) - (vstart & 0xFFFF)
+	with open(infile, "rb", buffering=0) as fh:
+		pos = vstart >> 16
+		while pos < vend >> 16:
+			bsize, isize = _block_sizes(fh, pos, infile)
+			span += isize
+			pos += bsize + 1
+	return(span)
+
+#Function to find a tabix index (.tbi or .csi) of a BGZF file, which is newer than the file
+#RETURNS: path of the index, or None
+def tabix_path(infile):
+	if not is_bgzf(infile):
+		return(None)
+	mtime = os.stat(infile).st_mtime_ns
+	for ext in TABIX_EXTS:
+		index = infile + ext
+		if os.path.isfile(index) and os.stat(index).st_mtime_ns >= mtime:
+			return(index)
+	return(None)
+
+#Function to read the records of each sequence from the tabix index (.tbi or .csi) of a BGZF file
+#Only the bins of the index are used: records of a sequence are contiguous in an indexed file,
+#so they span from the first chunk of its bins to the last
+#RETURNS: list of sequence names (None if the index doesn't have them, as in some .csi files),
+#and list of (first, last) virtual offsets of records for each sequence (None if there are none)
+def tabix_index(infile):
+	index = tabix_path(infile)
+	if index is None:
+		raise ValueError("File %s has no up to date tabix index (%s)"%(infile, " or ".join(TABIX_EXTS)))
+	stat = os.stat(index)
+	return(_tabix_index(os.path.abspath(index), stat.st_size, stat.st_mtime_ns))
+
+#Function behind tabix_index, cached by file size and modification time (internal)
+@functools.lru_cache(maxsize=8)
+def _tabix_index(index, size, mtime):
+	with gzip.open(index, "rb") as fh:
+		data = fh.read()
+	names = None
+	if data[:4] == b"TBI\x01":
+		csi = False
+		n_ref = struct.unpack_from("<i", data, 4)[0]
+		l_nm = struct.unpack_from("<i", data, 32)[0]
+		names = data[36:36+l_nm].split(b"\0")[:n_ref]
+		pos = 36 + l_nm
+		pseudo = 37450
+	elif data[:4] == b"CSI\x01":
+		csi = True
+		min_shift, depth, l_aux = struct.unpack_from("<3i", data, 4)
+		#Tabix metadata is stored as auxiliary data, with names at the end
+		if l_aux >= 28:
+			l_nm = struct.unpack_from("<i", data, 16+24)[0]
+			names = data[16+28:16+28+l_nm].split(b"\0")
+		pos = 16 + l_aux
+		n_ref = struct.unpack_from("<i", data, pos)[0]
+		pos += 4
+		pseudo = ((1 << ((depth + 1)*3)) - 1) // 7 + 1
+		if names is not None:
+			names = names[:n_ref]
+	else:
+		raise ValueError("File %s is not a tabix index"%index)
+	spans = list()
+	for i in range(n_ref):
+		n_bin = struct.unpack_from("<i", data, pos)[0]
+		pos += 4
+		first = None
+		last = None
+		for j in range(n_bin):
+			bin_id = struct.unpack_from("<I", data, pos)[0]
+			pos += 12 if csi else 4 #.csi bins also have a linear offset
+			n_chunk = struct.unpack_from("<i", data, pos)[0]
+			pos += 4
+			#Chunks of a bin are sorted, and the pseudo-bin holds statistics
+			if n_chunk and bin_id != pseudo:
+				start = struct.unpack_from("<Q", data, pos)[0]
+				end = struct.unpack_from("<Q", data, pos + 16*n_chunk - 8)[0]
+				first = start if first is None else min(first, start)
+				last = end if last is None else max(last, end)
+			pos += 16*n_chunk
+		if not csi:
+			pos += 4 + 8*struct.unpack_from("<i", data, pos)[0] #linear index
+		spans.append(None if first is None else (first, last))
+	if names is not None:
+		names = [name.decode() for name in names]
+	return(names, spans)
+
+#Function to open a file for reading, decompressing gzip and bgzip files in a background thread
+#start is an offset in the uncompressed data: BGZF files seek to it using their block index,
+#plain gzip files have to decompress everything before it
+#voffset is a virtual offset of a BGZF file (see virtual_span), which start is then relative to
+#size limits the number of bytes read after start, so compressed files aren't decompressed past it
+#mode is "rb" (binary) or "rt" (text)
+def open_input(infile, mode="rb", start=0, voffset=None, size=None):
+	if not is_gzip(infile):
+		fh = open(infile, "rb")
+		fh.seek(start)
+	else:
+		raw = open(infile, "rb")
+		skip = start
+		if voffset is not None:
+			raw.seek(voffset >> 16)
+			skip = start + (voffset & 0xFFFF)
+		elif start and is_bgzf(infile):
+			coffsets, uoffsets = bgzf_index(infile)
+			block = np.searchsorted(uoffsets, start, side="right") - 1
+			raw.seek(int(coffsets[block]))
+			skip = start - int(uoffsets[block])
+		fh = prefetchReader(gzip.GzipFile(fileobj=raw, mode="rb"), raw=raw, limit=None if size is None else skip + size)
+		while skip > 0:
+			data = fh.read(min(skip, BLOCKSIZE))
+			if not data:
+				break
+			skip -= len(data)
+		fh = io.BufferedReader(fh, buffer_size=1 << 16)
+	if mode == "rt":
+		return(io.TextIOWrapper(fh))
+	return(fh)
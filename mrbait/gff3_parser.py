@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
 
 import os
+import re
 import sys
 import urllib.parse
+from mrbait import compress_tools
+
+#Pattern finding Alias attributes (key=value pairs with a single "=", key in any case)
+ALIAS_ATTRIBUTE = re.compile(r"(?:^|;)alias=([^;=]*)(?=;|$)", re.IGNORECASE)
 
 #Function to split GFF attributes
 def splitAttributes(a):
@@ -52,11 +57,90 @@ def GFFRecordAsDict(things):
 	rec["attributes"] = None if things[8] == "." else splitAttributes(urllib.parse.unquote(things[8]))
 	return rec
 
+#Class for the GFF record fields used by mrbait
+class gffFeature():
+	'GFF record: seqid, type, start, end, and lowercase Alias attribute ("NULL" if missing)'
+	__slots__ = ["seqid", "type", "start", "end", "alias"]
+	def __init__(self, seqid, type, start, end, alias):
+		self.seqid = seqid
+		self.type = type
+		self.start = start
+		self.end = end
+		self.alias = alias
+
+class gffReader():
+	'Fast reader of GFF records, keeping only those with given seqids, types, or aliases'
+	#Default constructor
+	#seqids is a set (or dict) of sequence IDs to keep, or None to keep all
+	#types and aliases are sets of lowercase types and Alias values to keep: records are kept if
+	#they match either. "all" in types keeps any type, and "all" in aliases keeps any record with an Alias.
+	#Only the fields needed are parsed, and are only URL-unquoted if they contain '%'
+	def __init__(self, g, seqids=None, types=None, aliases=None):
+		self.g = g
+		self.seqids = seqids
+		self.types = types if types is not None else set(["all"])
+		self.aliases = aliases if aliases is not None else set()
+		self.dropped = 0 #records of kept seqids not matching types or aliases
+
+	#Generator function, yields gffFeature objects
+	def __iter__(self):
+		bad = 0 #tracker for if we have bad lines
+		seqids = self.seqids
+		all_types = "all" in self.types
+		types = self.types
+		aliases = self.aliases
+		any_alias = "all" in aliases
+		with compress_tools.open_input(self.g, "rt") as file_object:
+			for line in file_object:
+				if line[0] == "#":
+					continue
+				line = line.strip() #strip leading/trailing whitespace
+				if not line: #skip empty lines
+					continue
+				things = line.split("\t") #split lines
+				if len(things) != 9:
+					if bad == 0:
+						print("Warning: GFF file does not appear to be standard-compatible. See https://github.com/The-Sequence-Ontology/Specifications/blob/master/gff3.md")
+						bad = 1
+						continue
+					elif bad == 1:
+						sys.exit("Fatal error: GFF file does not appear to be standard-compatible. See https://github.com/The-Sequence-Ontology/Specifications/blob/master/gff3.md")
+				seqid = _unquote(things[0])
+				if seqids is not None and seqid not in seqids:
+					continue
+				gff_type = _unquote(things[2])
+				alias = _alias(things[8])
+				if not (all_types or gff_type.lower() in types or (alias != "NULL" and (any_alias or alias in aliases))):
+					self.dropped += 1
+					continue
+				start = "NULL" if things[3] == "." else int(things[3])
+				end = "NULL" if things[4] == "." else int(things[4])
+				yield(gffFeature(seqid, gff_type, start, end, alias))
+
+#Function to URL-unquote a GFF column, or return "NULL" if it is empty (internal)
+def _unquote(field):
+	if field == ".":
+		return("NULL")
+	if "%" in field:
+		return(urllib.parse.unquote(field))
+	return(field)
+
+#Function to get the lowercase Alias from a GFF attributes column, as GFFRecord.getAlias does (internal)
+#Returns "NULL" if there is no Alias
+def _alias(attributes):
+	if "%" in attributes:
+		attributes = urllib.parse.unquote(attributes)
+	found = ALIAS_ATTRIBUTE.findall(attributes)
+	#The last one wins, as in splitAttributes
+	if not found or not found[-1]:
+		return("NULL")
+	return(found[-1].lower())
+
 #function to read a GFF file
 #Generator function, yields individual elements
 def read_gff(g):
 	bad = 0 #tracker for if we have bad lines
-	gf = open(g)
+	gf = compress_tools.open_input(g, "rt")
 	try:
 		with gf as file_object:
 			for line in file_object:
@@ -1,16 +1,31 @@
 #!/usr/bin/python
 
+import os
 import sys
+import time
+import queue
 import sqlite3
+import urllib.request
 from sqlite3 import OperationalError
+import numpy as np
 import pandas as pd
 from mrbait import misc_utils as utils
+from mrbait import parallel_tools
 from mrbait import sequence_tools as s
 
 #Function to create database connection
 #Add code later to enable re-running from existing database
+#The database is put in WAL mode, so that worker processes can read it while
+#the database writer process (see db_writer) has a transaction open
 def create_connection(db):
 	conn = sqlite3.connect(db)
+	conn.execute("PRAGMA journal_mode=WAL")
+	return conn
+
+#Function to create a read-only database connection (e.g. for worker processes)
+def create_readonly_connection(db):
+	uri = "file:" + urllib.request.pathname2url(os.path.abspath(db)) + "?mode=ro"
+	conn = sqlite3.connect(uri, uri=True)
 	return conn
 
 
@@ -22,6 +37,7 @@ def init_new_db(connection):
 	clearBED(connection)
 	clearTargets(connection)
 	clearBaits(connection)
+	clearMeta(connection)
 
 
 #Function to clear baits table
@@ -109,6 +125,31 @@ def clearBED(conn):
 	''')
 	conn.commit()
 
+#Function to clear meta table (run parameters needed when resuming)
+def clearMeta(conn):
+	cursor = conn.cursor()
+	cursor.execute('''DROP TABLE IF EXISTS meta''')
+	cursor.execute('''CREATE TABLE meta(key TEXT PRIMARY KEY, value TEXT)''')
+	conn.commit()
+
+#Function to store a run parameter in meta table
+def setMeta(conn, key, value):
+	cursor = conn.cursor()
+	#Databases made by older versions have no meta table
+	cursor.execute('''CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value TEXT)''')
+	cursor.execute('''INSERT OR REPLACE INTO meta(key, value) VALUES (?,?)''', (key, str(value)))
+	conn.commit()
+
+#Function to fetch a run parameter from meta table, returns None if not set
+def getMeta(conn, key):
+	cursor = conn.cursor()
+	try:
+		cursor.execute('''SELECT value FROM meta WHERE key = ?''', (key,))
+	except OperationalError:
+		return(None)
+	row = cursor.fetchone()
+	return(row[0] if row else None)
+
 ################################################################################
 
 #function to reset all targets to passing
@@ -154,6 +195,79 @@ def filterLoci(conn, minlen, mincov, max_ambig, max_mask):
 def getPassedLoci(conn):
 	return(pd.read_sql_query("""SELECT id, consensus, chrom FROM loci WHERE pass=1""", conn))
 
+#Function to get a dict of chrom : locus ID for all loci
+#The first locus is used for any duplicate chrom names
+def getChromLookup(conn):
+	cur = conn.cursor()
+	cur.execute("""SELECT chrom, MIN(id) FROM loci GROUP BY chrom""")
+	return(dict(cur.fetchall()))
+
+#Function to get (id, chrom) of passing loci, without their sequences
+def getPassedLociNames(conn):
+	return(pd.read_sql_query("""SELECT id, chrom FROM loci WHERE pass=1""", conn))
+
+#Function to get consensus sequence of a locus
+def getLocusConsensus(conn, locid):
+	cur = conn.cursor()
+	cur.execute("""SELECT consensus FROM loci WHERE id=?""", (int(locid),))
+	return(cur.fetchone()[0])
+
+#SQL for passing records of loci and regions tables, used to split work by id ranges
+#(id, length) of passing records, and rows to send to workers, within an id range
+PASSED_SQL = {
+	"loci" : ("""SELECT id, length FROM loci WHERE pass=1 AND id BETWEEN ? AND ? ORDER BY id""",
+		"""SELECT id, consensus, chrom FROM loci WHERE pass=1 AND id BETWEEN ? AND ? ORDER BY id"""),
+	"regions" : ("""SELECT regid, length FROM regions WHERE pass=1 AND regid BETWEEN ? AND ? ORDER BY regid""",
+		"""SELECT regid, sequence FROM regions WHERE pass=1 AND regid BETWEEN ? AND ? ORDER BY regid""")
+}
+
+#Function to split passing records of table into about n (min_id, max_id) ranges with similar total length
+def getPassedRanges(conn, table, n):
+	cur = conn.cursor()
+	cur.execute(PASSED_SQL[table][0], (0, sys.maxsize))
+	rows = cur.fetchall()
+	offsets = np.concatenate(([0], np.cumsum([row[1] for row in rows], dtype=np.int64)))
+	return([(rows[first][0], rows[last-1][0]) for first, last in parallel_tools.split_balanced(offsets, n)])
+
+#Function to split passing loci into about n (min_id, max_id) ranges with similar total length
+def getPassedLociRanges(conn, n):
+	return(getPassedRanges(conn, "loci", n))
+
+#Function to split passing targets into about n (min_id, max_id) ranges with similar total length
+def getPassedTRRanges(conn, n):
+	return(getPassedRanges(conn, "regions", n))
+
+#Generator yielding rows of passing records of table with min_id <= id <= max_id
+#Records are fetched in pages of about page_bases bases, and each query is finished before
+#yielding, so readers don't hold the database lock while another process is writing
+def iterPassed(conn, table, min_id, max_id, page_bases=1<<22):
+	cur = conn.cursor()
+	cur.execute(PASSED_SQL[table][0], (min_id, max_id))
+	lengths = cur.fetchall()
+	first = 0
+	while first < len(lengths):
+		last = first
+		bases = lengths[first][1]
+		while last+1 < len(lengths) and bases + lengths[last+1][1] <= page_bases:
+			last += 1
+			bases += lengths[last][1]
+		cur.execute(PASSED_SQL[table][1], (lengths[first][0], lengths[last][0]))
+		for row in cur.fetchall():
+			yield(row)
+		first = last + 1
+
+#Generator yielding (id, consensus, chrom) for passing loci with min_id <= id <= max_id
+def iterPassedLoci(conn, min_id, max_id):
+	return(iterPassed(conn, "loci", min_id, max_id))
+
+#Generator yielding (regid, sequence) for passing targets with min_id <= regid <= max_id
+def iterPassedTRs(conn, min_id, max_id):
+	return(iterPassed(conn, "regions", min_id, max_id))
+
+#Function returns a Pandas DataFrame of target coordinates, ordered by locus
+def getRegionCoords(conn):
+	return(pd.read_sql_query("""SELECT regid, locid, start, stop FROM regions ORDER BY locid""", conn))
+
 #Function returns a Pandas DataFrame of passing target regions
 def getPassedTRs(conn):
 	return(pd.read_sql_query("""SELECT regid, sequence FROM regions WHERE pass=1""", conn))
@@ -178,6 +292,27 @@ def getNumGFF(conn):
 	cur.execute("""SELECT count(gffid) FROM gff""")
 	return(parseFetchNum(cur.fetchone()))
 
+#returns number of GFF elements of loci which were not loaded, because no --filter_r option needed them
+def getNumDroppedGFF(conn):
+	dropped = getMeta(conn, "gff_dropped")
+	return(0 if dropped is None else int(dropped))
+
+#Function to exit if GFF records needed by a --filter_r option were not loaded (see mrbait_corefuncs.loadGFF),
+#which can happen with --resume. o1 is "gff" (value is a type) or "gff_a" (value is an alias)
+def checkGFFLoaded(conn, o1, value):
+	types = getMeta(conn, "gff_types")
+	if types is None: #all records are loaded by older versions
+		return
+	types = set(types.split(";"))
+	aliases = set(getMeta(conn, "gff_aliases").split(";"))
+	if "all" in types:
+		return
+	if o1 == "gff" and value.lower() in types:
+		return
+	if o1 == "gff_a" and ("all" in aliases or value.lower() in aliases):
+		return
+	sys.exit("ERROR: GFF records for <--filter_r %s=%s> were not loaded into the database, which only has records needed by the --filter_r options it was built with. Load the GFF file again (-r 0) to use this option."%(o1, value))
+
 #returns number of GFF elements
 def getNumPassedGFF(conn):
 	cur = conn.cursor()
@@ -212,7 +347,7 @@ def getNumPassedBaits(conn):
 def getNumConflicts(conn):
 	cur = conn.cursor()
 	try:
-		cur.execute("""SELECT count(*) FROM conflicts WHERE choose != 1""")
+		cur.execute("""SELECT count(*) FROM conflicts WHERE choose IS NOT 1""")
 		return(parseFetchNum(cur.fetchone()))
 	except OperationalError:
 		return(False)
@@ -296,17 +431,174 @@ def getPassedBaits(conn):
 # def getVariants(conn):
 # 	return(pd.read_sql_query("""SELECT * FROM variants """, conn))
 
+#INSERT statements for rows sent to db_writer, keyed by table
+#loci_id rows are loci rows starting with a pre-assigned ID
+#consensus rows are (new consensus, locus ID), and update existing loci
+INSERT_SQL = {
+	"loci" : ''' INSERT INTO loci(depth, length, consensus, pass, chrom, ambig, gap, mask, gc)
+				VALUES(?,?,?,?,?,?,?,?,?) ''',
+	"loci_id" : ''' INSERT INTO loci(id, depth, length, consensus, pass, chrom, ambig, gap, mask, gc)
+				VALUES(?,?,?,?,?,?,?,?,?,?) ''',
+	"regions" : '''INSERT INTO regions(locid, length, sequence, vars, bad, gap, mask, gc,
+		vars_flank, bad_flank, gap_flank, start, stop, pass) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,1)''',
+	"gff" : ''' INSERT INTO gff(locid, type, start, stop, alias, pass)
+				VALUES(?,?,?,?,?,1) ''',
+	"bed" : ''' INSERT INTO bed(locid, start, stop, pass)
+				VALUES(?,?,?,1) ''',
+	"baits" : ''' INSERT INTO baits(regid, sequence, start, stop, mask, gc, pass)
+				VALUES(?,?,?,?,?,?,1) ''',
+	"consensus" : ''' UPDATE loci SET consensus = ? WHERE id = ? '''
+}
+
+#Primary key of tables where bufferedWriter assigns row IDs
+TABLE_IDS = {"loci" : "id", "regions" : "regid", "baits" : "baitid"}
+
+#Function to renumber rows of table from 1, in order of parent column, then current ID
+#The database writer numbers rows in the order workers finish their tasks; each
+#worker sends the rows of a parent in the order a serial run adds them, so this
+#gives the IDs (and output order) of a serial run
+def renumberRows(conn, table, parent):
+	names = {"table" : table, "id" : TABLE_IDS[table], "parent" : parent}
+	cur = conn.cursor()
+	cur.execute("DROP TABLE IF EXISTS temp.renumber")
+	#Rows are copied out in the new order, so their rowid in the copy is the new ID
+	cur.execute("CREATE TEMP TABLE renumber AS SELECT * FROM %(table)s ORDER BY %(parent)s, %(id)s"%names)
+	cur.execute("UPDATE temp.renumber SET %(id)s = rowid"%names)
+	cur.execute("DELETE FROM %(table)s"%names)
+	cur.execute("INSERT INTO %(table)s SELECT * FROM temp.renumber ORDER BY rowid"%names)
+	cur.execute("DROP TABLE temp.renumber")
+	conn.commit()
+
+#INSERT statements used by bufferedWriter, rows start with the assigned ID
+BUFFER_SQL = {
+	"loci" : ''' INSERT INTO loci(id, depth, length, consensus, pass, chrom, ambig, gap, mask, gc)
+				VALUES(?,?,?,?,?,?,?,?,?,?) ''',
+	"regions" : '''INSERT INTO regions(regid, locid, length, sequence, vars, bad, gap, mask, gc,
+		vars_flank, bad_flank, gap_flank, start, stop, pass) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,1)''',
+	"baits" : ''' INSERT INTO baits(baitid, regid, sequence, start, stop, mask, gc, pass)
+				VALUES(?,?,?,?,?,?,?,1) '''
+}
+
+class bufferedWriter():
+	'Buffers rows for the database and inserts them with executemany, one transaction per batch'
+	#Default constructor
+	def __init__(self, conn, batch_size=500):
+		self.conn = conn
+		self.batch_size = int(batch_size)
+		self.rows = dict()
+		self.next_id = dict()
+		self.pending = 0
+
+	#Function to add a row to table
+	#Row IDs for loci, regions, and baits are assigned here, so they can be returned
+	#before the row is written. Only valid while this is the only writer to the table.
+	#Returns: row ID, or None for gff and bed rows
+	def add(self, table, row):
+		rowid = None
+		if table in TABLE_IDS:
+			if table not in self.next_id:
+				cur = self.conn.cursor()
+				cur.execute("SELECT COALESCE(MAX(%s), 0) FROM %s;"%(TABLE_IDS[table], table))
+				self.next_id[table] = cur.fetchone()[0] + 1
+			rowid = self.next_id[table]
+			self.next_id[table] += 1
+			row = [rowid] + list(row)
+		self.rows.setdefault(table, list()).append(row)
+		self.pending += 1
+		if self.pending >= self.batch_size:
+			self.flush()
+		return(rowid)
+
+	def add_locus(self, depth, consensus, passed, name):
+		if name == None:
+			name = "NA"
+		return(self.add("loci", locus_record_values(depth, consensus, passed, name)))
+
+	def add_region(self, locid, start, stop, seq, counts, fcounts, mask, gc):
+		return(self.add("regions", region_record_values(locid, start, stop, seq, counts, fcounts, mask, gc)))
+
+	def add_bait(self, reg, seq, start, stop, mask, gc):
+		return(self.add("baits", bait_record_values(reg, seq, start, stop, mask, gc)))
+
+	#Function to write all buffered rows in a single transaction
+	def flush(self):
+		if not self.pending:
+			return
+		cur = self.conn.cursor()
+		try:
+			for table, rows in self.rows.items():
+				if rows:
+					cur.executemany(BUFFER_SQL[table], rows)
+			self.conn.commit()
+		except sqlite3.Error:
+			self.conn.rollback()
+			raise
+		self.rows = dict()
+		self.pending = 0
+
+
+#Function run by the single database writer process
+#Receives (table, rows) batches from queue until it gets None, or until
+#it has seen (None, None) end-of-task markers from all <tasks> tasks,
+#and inserts them in transactions of at least commit_size rows
+#Pending rows are also committed whenever the queue is empty, so a transaction
+#is never left open while waiting for workers
+#Reports the number of rows written, throughput, and maximum queue depth
+def db_writer(db, q, commit_size=10000, tasks=None):
+	conn = create_connection(db)
+	cur = conn.cursor()
+	rows = 0
+	batches = 0
+	pending = 0
+	max_depth = 0
+	done = 0
+	error = None
+	start = time.time()
+	while tasks is None or done < tasks:
+		try:
+			max_depth = max(max_depth, q.qsize())
+		except NotImplementedError: #qsize not available on MacOS
+			pass
+		try:
+			item = q.get_nowait()
+		except queue.Empty:
+			if pending:
+				conn.commit()
+				pending = 0
+			item = q.get()
+		if item is None:
+			break
+		table, data = item
+		#A task's rows are all ahead of its end-of-task marker in the queue
+		if table is None:
+			done += 1
+			continue
+		#After an error, keep draining queue so that workers don't block
+		if error:
+			continue
+		try:
+			cur.executemany(INSERT_SQL[table], data)
+		except sqlite3.Error as err:
+			error = err
+			continue
+		rows += len(data)
+		batches += 1
+		pending += len(data)
+		if pending >= commit_size:
+			conn.commit()
+			pending = 0
+	conn.commit()
+	conn.close()
+	elapsed = time.time() - start
+	print("\t\t\tDatabase writer: Inserted %s rows in %s batches (%.1f rows/sec, max queue depth %s)."%(rows, batches, rows/max(elapsed, 1e-9), max_depth))
+	if error:
+		raise error
+
 #Code to add record to 'loci' table
 def add_locus_record(conn, depth, consensus, passed, name):
 	if name == None:
 		name = "NA"
-	seq_norm = s.simplifySeq(consensus)
-	counts = s.seqCounterSimple(seq_norm)
-	ambig = counts["N"]/len(consensus)
-	gap = counts["-"]/len(consensus)
-	mask = s.mask_content(consensus)
-	gc = s.gc_content(consensus)
-	stuff = [depth, int(len(consensus)), str(consensus), int(passed), str(name), float(ambig), float(gap), float(mask), float(gc)]
+	stuff = locus_record_values(depth, consensus, passed, name)
 	try:
 		sql = ''' INSERT INTO loci(depth, length, consensus, pass, chrom, ambig, gap, mask, gc)
 					VALUES(?,?,?,?,?,?,?,?,?) '''
@@ -317,54 +609,56 @@ def add_locus_record(conn, depth, consensus, passed, name):
 		print("Constraint failed: Skipping locus \"%s\" because it already exists, this is usually caused by duplicate headers when parsing a FASTA file."%name)
 	return cur.lastrowid
 
+#Function to build the list of values for a row in the 'loci' table
+def locus_record_values(depth, consensus, passed, name):
+	index = s.locusIndex(consensus)
+	counts = index.range_counts(0, len(consensus))
+	ambig = counts[index.N]/len(consensus)
+	gap = counts[index.GAP]/len(consensus)
+	mask = counts[index.MASK]/len(consensus)
+	gc = counts[index.GC]/len(consensus)
+	return([depth, int(len(consensus)), str(consensus), int(passed), str(name), float(ambig), float(gap), float(mask), float(gc)])
+
 
 #Code to add record to 'bait' table
 def add_bait_record(conn, reg, seq, start, stop, mask, gc):
-	mask_p = float(mask/len(seq))
-	gc_p = float(gc/len(seq))
-	stuff = [int(reg), seq, int(start), int(stop), float(mask_p), float(gc_p)]
-	sql = ''' INSERT INTO baits(regid, sequence, start, stop, mask, gc, pass)
-				VALUES(?,?,?,?,?,?,1) '''
+	stuff = bait_record_values(reg, seq, start, stop, mask, gc)
 	cur = conn.cursor()
-	cur.execute(sql, stuff)
+	cur.execute(INSERT_SQL["baits"], stuff)
 	conn.commit()
 	return cur.lastrowid
 
+#Function to build the list of values for a row in the 'baits' table
+def bait_record_values(reg, seq, start, stop, mask, gc):
+	mask_p = float(mask/len(seq))
+	gc_p = float(gc/len(seq))
+	return([int(reg), seq, int(start), int(stop), float(mask_p), float(gc_p)])
+
 #Code to add record to GFF table
-def add_gff_record(conn,seqid, gff_type, start, stop, alias):
+def add_gff_record(conn, locid, gff_type, start, stop, alias):
 	cur = conn.cursor()
+	cur.execute(INSERT_SQL["gff"], gff_record_values(locid, gff_type, start, stop, alias))
+	conn.commit()
 
-	#Query seqid for given chrom
-	cur.execute("SELECT id FROM loci WHERE chrom = ?;",(seqid,))
-	res = cur.fetchone()
-	if res is not None:
-		#If any match exists, fetch locid
-		locid = res[0]
-		#print("Locid for",seqid,"is:",locid)
-		#BUILT INSERT SQL
-		sql = ''' INSERT INTO gff(locid, type, start, stop, alias, pass)
-					VALUES(?,?,?,?,?,1);'''
-		stuff = [int(locid), str(gff_type), int(start), int(stop), str(alias)]
-		cur.execute(sql, stuff)
-		conn.commit()
+#Function to build the list of values for a GFF row
+def gff_record_values(locid, gff_type, start, stop, alias):
+	return([int(locid), str(gff_type), int(start), int(stop), str(alias)])
 
 #Code to add record to BED table
-def add_bed_record(conn, seqid, start, stop):
+def add_bed_record(conn, locid, start, stop):
 	cur = conn.cursor()
+	cur.execute(INSERT_SQL["bed"], bed_record_values(locid, start, stop))
+	conn.commit()
 
-	#Query seqid for given chrom
-	cur.execute("SELECT id FROM loci WHERE chrom = ?;",(seqid,))
-	res = cur.fetchone()
-	if res is not None:
-		#If any match exists, fetch locid
-		locid = res[0]
-		#print("Locid for",seqid,"is:",locid)
-		#BUILT INSERT SQL
-		sql = ''' INSERT INTO bed(locid, start, stop, pass)
-					VALUES(?,?,?,1);'''
-		stuff = [int(locid), int(start), int(stop)]
-		cur.execute(sql, stuff)
-		conn.commit()
+#Function to build the list of values for a BED row
+def bed_record_values(locid, start, stop):
+	return([int(locid), int(start), int(stop)])
+
+#Function to insert rows into table (see INSERT_SQL) with executemany
+#Does not commit, so that a whole file can be loaded in one transaction
+def insertBatch(conn, table, rows):
+	if rows:
+		conn.cursor().executemany(INSERT_SQL[table], rows)
 
 """DEPRECATED"""
 # #Code to add to 'variants' table
@@ -389,20 +683,22 @@ def add_bed_record(conn, seqid, start, stop):
 def add_region_record(conn, locid, start, stop, seq, counts, fcounts, mask, gc):
 	#Establish cursor
 	cur = conn.cursor()
-
-	mask_p = float(mask/len(seq))
-	gc_p = float(gc/len(seq))
 	#build sql and pack values to insert
-	sql = '''INSERT INTO regions(locid, length, sequence, vars, bad, gap, mask, gc,
-		vars_flank, bad_flank, gap_flank, start, stop, pass) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,1)'''
-	stuff = [locid, len(seq), seq, counts["*"], counts["N"], counts["-"], mask_p, gc_p, fcounts["*"], fcounts["N"], fcounts["-"],start, stop]
+	stuff = region_record_values(locid, start, stop, seq, counts, fcounts, mask, gc)
 
 	#insert
-	cur.execute(sql, stuff)
+	cur.execute(INSERT_SQL["regions"], stuff)
 	conn.commit()
 
+#Function to build the list of values for a row in the 'regions' table
+def region_record_values(locid, start, stop, seq, counts, fcounts, mask, gc):
+	mask_p = float(mask/len(seq))
+	gc_p = float(gc/len(seq))
+	return([locid, len(seq), seq, counts["*"], counts["N"], counts["-"], mask_p, gc_p, fcounts["*"], fcounts["N"], fcounts["-"],start, stop])
+
 
 #Function to FAIL any GFF elements that do not overlap with our sequence for the given locus/region
+#Single pass over gff, looking up each locus by its primary key
 def validateGFFRecords(conn):
 	cur = conn.cursor()
 
@@ -411,17 +707,17 @@ def validateGFFRecords(conn):
 			gff
 		SET
 			pass = 0
-		WHERE gffid IN
-			(SELECT gffid FROM
-				gff INNER JOIN loci ON gff.locid = loci.id
+		WHERE EXISTS
+			(SELECT 1 FROM loci
 			WHERE
-				(gff.start > loci.length) AND (gff.stop > loci.length)
+				loci.id = gff.locid AND gff.start > loci.length AND gff.stop > loci.length
 			);
 	'''
 	cur.execute(sql)
 	conn.commit()
 
-#Function to FAIL any GFF elements that do not overlap with our sequence for the given locus/region
+#Function to FAIL any BED elements that do not overlap with our sequence for the given locus/region
+#Single pass over bed, looking up each locus by its primary key
 def validateBEDRecords(conn):
 	cur = conn.cursor()
 
@@ -430,11 +726,10 @@ def validateBEDRecords(conn):
 			bed
 		SET
 			pass = 0
-		WHERE bedid IN
-			(SELECT bedid FROM
-				bed INNER JOIN loci ON bed.locid = loci.id
+		WHERE EXISTS
+			(SELECT 1 FROM loci
 			WHERE
-				(bed.start > loci.length) AND (bed.stop > loci.length)
+				loci.id = bed.locid AND bed.start > loci.length AND bed.stop > loci.length
 			);
 	'''
 	cur.execute(sql)
@@ -601,33 +896,21 @@ def updateConsensus(conn, key, seq):
 	cur.execute(sql, stuff)
 	conn.commit()
 
-#Internal function for checking if TRs overlap within distance buffer
-def checkOverlap(row1, row2, dist):
-	#This could be made much more concise
-	x2 = row2["start"]
-	y2 = row2["stop"]
-	x1 = (row1["start"]-dist)
-	y1 = (row1["stop"]+dist)
-
-	if x1 < 0:
-		x1 = 0
-
-	# print("x1=",x1)
-	# print("y1=",y1)
-	# print("x2=",x2)
-	# print("y2=",y2)
-	#Left edge of row1 overlaps right edge of row2
-	if (x2 < x1) and (y2 >= x1):
-		return 1
-	#Right edge of row1 overlaps left edge of row2
-	elif (x2 <= y1) and (y2 > y1):
-		return 1
-	#Row 2 completely overlapped by row1
-	elif (x2 >= x1 and y2 > x1) and (x2 < y1 and y2 <= y1):
-		return 1
-	else:
-		return 0
+#Function to update consensus sequences of many loci
+#rows are (consensus, id); not committed, so several batches can share one transaction
+def updateConsensusBatch(conn, rows):
+	cur = conn.cursor()
+	sql = '''
+		UPDATE loci
+		SET
+			consensus = ?
+		WHERE
+			id = ?
+	'''
+	cur.executemany(sql, rows)
 
+#Number of targets read at a time when building conflict blocks
+CONFLICT_BATCH = 100000
 
 #Function to initialize TEMPORARY TABLE 'conflicts'
 def initializeConflicts(conn):
@@ -669,8 +952,8 @@ def initializeConflicts(conn):
 		SELECT
 			regions.regid,
 			loci.length,
-			"NULL" AS conflict_block,
-			"NULL" AS choose
+			NULL AS conflict_block,
+			NULL AS choose
 		FROM
 			regions INNER JOIN loci ON regions.locid = loci.id
 		WHERE
@@ -679,62 +962,6 @@ def initializeConflicts(conn):
 	cur.execute(sql2)
 	conn.commit()
 
-#Function to take a pointer to a pandas dataframe, send to SQL, and update conflicts table
-def updateConflictsFromPandas(conn, df):
-	cur = conn.cursor()
-
-	#Fetch number of entries in conflict tables
-	rows = getConflictNumRows(conn)
-
-	#Make sure there is some data to work on
-	if rows is 0 or rows is None:
-		raise ValueError("There are no rows in <conflicts>!")
-
-	df.to_sql('t', conn, if_exists='replace')
-
-	#Hacky way to do it, but SQlite doesn't support FROM clause in UPDATEs...
-	sql_update = '''
-		UPDATE
-			conflicts
-		SET
-			conflict_block = (SELECT t.conflict_block FROM t WHERE t.regid = conflicts.regid)
-		WHERE
-			EXISTS(SELECT * FROM t WHERE t.regid = conflicts.regid)
-	'''
-	cur.execute(sql_update)
-
-	#Clear up the temp table t
-	cur.execute("DROP TABLE IF EXISTS t")
-	conn.commit()
-
-#Function to take a pointer to a pandas dataframe, send to SQL, and update conflicts table
-def updateChosenFromPandas(conn, df):
-	cur = conn.cursor()
-
-	#Fetch number of entries in conflict tables
-	rows = getConflictNumRows(conn)
-
-	#Make sure there is some data to work on
-	if rows is 0 or rows is None:
-		raise ValueError("There are no rows in <conflicts>!")
-
-	df.to_sql('t', conn, if_exists='replace')
-
-	#Hacky way to do it, but SQlite doesn't support FROM clause in UPDATEs...
-	sql_update = '''
-		UPDATE
-			conflicts
-		SET
-			choose = (SELECT t.choose FROM t WHERE t.regid = conflicts.regid)
-		WHERE
-			EXISTS(SELECT * FROM t WHERE t.regid = conflicts.regid)
-	'''
-	cur.execute(sql_update)
-
-	#Clear up the temp table t
-	cur.execute("DROP TABLE IF EXISTS t")
-	conn.commit()
-
 #Updates
 def updateLociMask(conn, newMask):
 	cur = conn.cursor()
@@ -762,6 +989,21 @@ def updateLociMask(conn, newMask):
 	conn.commit()
 	#print(pd.read_sql_query("SELECT * FROM loci", conn))
 
+#Function to update flanking counts for targets
+#rows are lists of [vars_flank, bad_flank, gap_flank, regid]
+def updateRegionFlanks(conn, rows):
+	cur = conn.cursor()
+	sql = '''
+		UPDATE
+			regions
+		SET
+			vars_flank = ?, bad_flank = ?, gap_flank = ?
+		WHERE
+			regid = ?
+	'''
+	cur.executemany(sql, rows)
+	conn.commit()
+
 #Function to build conflicts table when --R is false
 def fetchConflictTRs_NoMult(conn):
 	cur = conn.cursor()
@@ -795,9 +1037,11 @@ def getConflictNumRows(conn):
 	return(rows)
 
 #Function to fetch all target regions requiring conflict resolution
-def fetchConflictTRs(conn, min_len, dist):
+#Targets are read in locus order, about batch at a time (never splitting a locus), and each batch
+#gets its conflict blocks from conflictBlocks(), which replace the contents of conflicts at the end
+#Targets alone in their block are chosen, the rest are left NULL for --select_r to resolve
+def fetchConflictTRs(conn, min_len, dist, batch=CONFLICT_BATCH):
 	cur = conn.cursor()
-	#TODO: Check and first make sure conflicts table exists, or otherwise implement error handling
 
 	#Function call to build conflicts table
 	try:
@@ -805,13 +1049,13 @@ def fetchConflictTRs(conn, min_len, dist):
 	except RuntimeError as err:
 		print(err.args)
 
-	#Query conflicts temp table to make a pandas dataframe for parsing
-	sql_test = '''
+	cur.execute("DROP TABLE IF EXISTS t")
+	cur.execute("CREATE TEMPORARY TABLE t (regid INTEGER, length INTEGER, conflict_block INTEGER, choose INTEGER)")
+
+	sql = '''
 		SELECT
 			conflicts.regid,
-			conflict_block,
 			conflicts.length,
-			choose,
 			locid,
 			start,
 			stop
@@ -819,73 +1063,51 @@ def fetchConflictTRs(conn, min_len, dist):
 			conflicts INNER JOIN regions ON conflicts.regid = regions.regid
 		WHERE
 			regions.pass=1
+		ORDER BY
+			locid, start, conflicts.regid
 	'''
+	reader = conn.cursor()
+	reader.execute(sql)
+	block = 0
+	held = np.empty((0, 5), dtype=np.int64)
+	while True:
+		rows = reader.fetchmany(batch)
+		chunk = np.concatenate((held, np.array(rows, dtype=np.int64).reshape(-1, 5)))
+		if rows:
+			#Hold back the last locus, which may continue in the next batch
+			last = np.searchsorted(chunk[:,2], chunk[-1,2], side="left")
+			chunk, held = chunk[:last], chunk[last:]
+		if len(chunk):
+			blocks = conflictBlocks(chunk[:,2], chunk[:,1], chunk[:,3], chunk[:,4], min_len, dist) + block
+			block = int(blocks[-1])
+			sizes = np.bincount(blocks - blocks[0])
+			choose = np.where(sizes[blocks - blocks[0]] == 1, 1, None)
+			cur.executemany("INSERT INTO t VALUES (?, ?, ?, ?)", zip(chunk[:,0].tolist(), chunk[:,1].tolist(), blocks.tolist(), choose.tolist()))
+		if not rows:
+			break
+
+	#Replace the contents of conflicts in one go, rather than updating each row
+	cur.execute("DELETE FROM conflicts")
+	cur.execute("INSERT INTO conflicts SELECT * FROM t ORDER BY regid")
 
-	df = pd.read_sql_query(sql_test, conn)
-	#Set block num start at 1+ last locid (to prevent overlap in block nums)
-	block = int(max(df["locid"]) + 1) #make sure to enforce integer type, or it fucks up in sql later
-	#Split df into locid groups (retains INDEX of each entry, but in separate dfs)
-	groups = df.groupby("locid")
-	for group, _df in groups:
-		group_df = _df.sort_values(by="start", ascending=True, kind='mergesort')
-		#If only one TR for alignment, set choose to 1:
-		if group_df.shape[0] == 1:
-			for name, row in group_df.iterrows():
-				#modify original dataframe
-				df.loc[name, "conflict_block"] = row["locid"]
-				df.loc[name, "choose"] = 1
-		else:
-			#print("\n########Group is: ",group,"\n")
-			#print(group_df)
-			#For each TR in locus
-			#Create iterable
-			row_iterator = group_df.iterrows()
-			_i, last_row = row_iterator.__next__() #grab first item
-			#print("First row:",_i,last_row)
-			#Make sure it is from a long enough locus
-			if last_row["length"] <= min_len:
-				df.loc[_i, "conflict_block"] = last_row["locid"]
-			#For each next row (starting at row 2)
-			for i, next_row in row_iterator:
-				#print("Comparing row ",_i," and ", i)
-				if next_row["length"] <= min_len:
-					df.loc[i, "conflict_block"] = next_row["locid"]
-				#If they overlap, assign them both to same conflict block
-				if checkOverlap(last_row, next_row, dist) == 1:
-					#print("overlap!")
-					#Fetch conflict_block currents from parent df
-					cb = df.loc[i, "conflict_block"]
-					_cb = df.loc[_i, "conflict_block"]
-					#If neither is assigned, assign both to new block
-					if (cb == "NULL") and (_cb == "NULL"):
-						#print("Assigning block: ",block)
-						df.loc[_i, "conflict_block"] = block
-						df.loc[i, "conflict_block"] = block
-						block+=1
-					#Else if row1 is assigned, give row2 the block of row1
-					#If last_row is assigned, move next_row to same block
-					elif cb == "NULL":
-						df.loc[i, "conflict_block"] = df.loc[_i, "conflict_block"]
-					#Or if row2 has block, assign it to row1
-					elif _cb == "NULL":
-						df.loc[_i, "conflict_block"] = df.loc[i, "conflict_block"]
-				#If they don't overlap, assign last_row to its own conflict block
-				#current next_row will then get checked with its next neighbor
-				#in the next iteration.
-				else:
-					df.loc[_i, "conflict_block"] = block
-					block += 1
-
-	#Set choose=1 for any which have no conflicts
-	df.loc[~df.duplicated("conflict_block",keep=False),"choose"] = 1
-	#print(df)
-	#Next step, send df back to SQLite and update conflicts table
-	updateConflictsFromPandas(conn, df)
-	updateChosenFromPandas(conn, df)
-	#DEBUG print
-	#print(pd.read_sql_query("SELECT * FROM conflicts", conn))
+	#Clear up the temp table t
+	cur.execute("DROP TABLE IF EXISTS t")
+	conn.commit()
+
+#Function to number the conflict blocks of targets sorted by locus and start
+#A target starts a new block unless it starts within dist of the furthest stop of the targets before it
+#in the same locus; all targets of a locus no longer than min_len share one block
+#RETURNS: numpy array of block numbers (from 1), one per target
+def conflictBlocks(locids, lengths, starts, stops, min_len, dist):
+	new = np.ones(len(locids), dtype=bool)
+	if len(locids) > 1:
+		reach = pd.Series(stops).groupby(locids).cummax().values + dist
+		conflict = (starts[1:] <= reach[:-1]) | (lengths[1:] <= min_len)
+		new[1:] = (locids[1:] != locids[:-1]) | ~conflict
+	return(np.cumsum(new))
 
 #Function for random selection of TRs within conflict blocks
+#One unresolved target per block is chosen at random, and the rest are set to 0/FALSE
 def regionSelectRandom(conn):
 	cur = conn.cursor()
 
@@ -893,43 +1115,70 @@ def regionSelectRandom(conn):
 	rows = getConflictNumRows(conn)
 
 	#Make sure there is some data to work on
-	if rows is 0 or rows is None:
+	if rows == 0 or rows is None:
 		raise ValueError("There are no rows in <conflicts>!")
 
 	sql = '''
-	UPDATE
-		conflicts
-	SET
-		choose=1
-	WHERE
-		regid IN
-			(SELECT
-				regid
-			FROM
-				(SELECT
-					*
-				FROM
-					conflicts
-				WHERE
-					choose="NULL"
-				ORDER BY
-					RANDOM()
-				)
-			GROUP BY
-				conflict_block
-			)
+		INSERT OR REPLACE INTO conflicts (regid, length, conflict_block, choose)
+		SELECT
+			regid,
+			length,
+			conflict_block,
+			ROW_NUMBER() OVER (PARTITION BY conflict_block ORDER BY RANDOM()) = 1
+		FROM
+			conflicts
+		WHERE
+			choose IS NULL
 	'''
-	#print(pd.read_sql_query(sql, conn))
 	cur.execute(sql)
 	conn.commit()
 
-	#Set "unchosen" regions to 0/FALSE
-	cur.execute("UPDATE conflicts SET choose=0 WHERE choose='NULL'")
-	conn.commit()
-
+#SQL to resolve unresolved targets of each conflict block by a count, with window functions
+#Window functions need SQLite >= 3.25 (see conda.recipe/meta.yaml)
+#Targets are ranked within blocks by counts (NULL counts last); targets alone in their block are chosen,
+#otherwise a single best target is chosen and the rest set to 0/FALSE, or tied best targets are left
+#NULL (and the rest set to 0) for random selection. Blocks are left unresolved when the best count is NULL,
+#or doesn't pass %(best)s (e.g. zero SNPs when choosing the most)
+RESOLVE_COUNTS_SQL = '''
+	INSERT OR REPLACE INTO conflicts (regid, length, conflict_block, choose)
+	SELECT
+		regid,
+		length,
+		conflict_block,
+		CASE
+			WHEN n = 1 THEN 1
+			WHEN best IS NULL OR NOT (%(best)s) THEN NULL
+			WHEN rank > 1 THEN 0
+			WHEN ties = 1 THEN 1
+			ELSE NULL
+		END
+	FROM
+		(SELECT
+			regid,
+			length,
+			conflict_block,
+			COUNT(*) OVER (PARTITION BY conflict_block) AS n,
+			RANK() OVER w AS rank,
+			FIRST_VALUE(counts) OVER w AS best,
+			COUNT(*) OVER (PARTITION BY conflict_block, counts) AS ties
+		FROM
+			(SELECT
+				c.regid,
+				c.length,
+				c.conflict_block,
+				(%(counts)s) AS counts
+			FROM
+				conflicts AS c INNER JOIN regions AS r USING (regid)
+			WHERE
+				c.choose IS NULL
+			)
+		WINDOW w AS (PARTITION BY conflict_block ORDER BY counts IS NULL, counts %(order)s)
+		)
+'''
 
-#Function for resolving conflict blocks by number of flanking SNPs
-def regionSelect_SNP(conn):
+#Function to resolve conflict blocks by a count of regions columns (an SQL expression)
+#highest=True chooses targets with the most (which must be more than zero), otherwise the fewest
+def resolveConflictsByCounts(conn, counts, highest=True):
 	cur = conn.cursor()
 
 	#Fetch number of entries in conflict tables
@@ -939,47 +1188,17 @@ def regionSelect_SNP(conn):
 	if rows <= 0 :
 		raise ValueError("There are no rows in <conflicts>!")
 
-	# Template:
-	# -Fetch joined conflict table (get flanking SNPs)
-	# -Split pandas df into groups
-	# -Loop through each group, tracking top region(s)
-	# -If one region wins, set choose=1 and choose=0 for the rest
-	#-Set chosen to 1
-	#-If two are chosen, set others to 0 and keep the "tied" as NULL
-	#-Any region in a block that had NO vars will be kept as NULL.
-	#-----AFTER pushing pandas df back and updating, need to update
-	#-----all unchosen regions to 0 ONLY IF the block alreday has a selected region
-	#-----final call to RANDOM select by parent function will sort out the rest
-
-	#-Use RANDOM to resolve any remaining NULLs.
-	#print("DIST IS ",dist)
-	#Query conflicts temp table to make a pandas dataframe for parsing
-	sql = '''
-		SELECT
-			c.regid,
-			conflict_block,
-			choose,
-			(vars+vars_flank) as counts
-		FROM
-			conflicts AS c INNER JOIN regions AS r USING (regid)
-		WHERE
-			c.choose="NULL"
-	'''
-
-	#printFlankingSNPs_conflicts(conn, dist)
-	#printFlankingSNPCounts_conflicts(conn, dist)
-	df = pd.read_sql_query(sql, conn)
-
-	#Split df into locid groups (retains INDEX of each entry, but in separate dfs)
-	#Loop through groups and select highest
-	try:
-		df = parseCountsMax(df)
-	except:
-		raise
-
-	#Push modified DF to SQL as temp table
-	updateChosenFromPandas(conn, df)
+	if highest:
+		sql = RESOLVE_COUNTS_SQL%{"counts" : counts, "order" : "DESC", "best" : "best > 0"}
+	else:
+		sql = RESOLVE_COUNTS_SQL%{"counts" : counts, "order" : "ASC", "best" : "1"}
+	cur.execute(sql)
+	conn.commit()
 
+#Function for resolving conflict blocks by number of flanking SNPs
+#Blocks where the best have no SNPs, and ties, are left for random selection
+def regionSelect_SNP(conn):
+	resolveConflictsByCounts(conn, "vars + vars_flank", highest=True)
 
 #Function to prints flanking SNPs for conflicting regions...
 #Function for use when debugging
@@ -996,101 +1215,11 @@ def regionSelect_SNP(conn):
 # 		FROM
 # 			conflicts AS c INNER JOIN regions AS r USING (regid)
 # 		WHERE
-# 			c.choose="NULL"
+# 			c.choose IS NULL
 # 	'''
 # 	print(pd.read_sql_query(sql, conn))
 
 
-#Function to loop though pandas DF of conflict counts and choose best by "minimum"
-def parseCountsMin(df):
-	#Loop through groups and select lowest
-	groups = df.groupby("conflict_block")
-	for group, group_df in groups:
-		#print("\n########Conflict Block is: ",group,"\n")
-		#print(group_df)
-		#If only one TR for alignment, set choose to 1:
-		if group_df.shape[0] == 1:
-			for name, row in group_df.iterrows():
-				#modify original dataframe
-				df.loc[name, "choose"] = 1
-		else:
-			#For each TR in locus
-			chosen_ones = []
-			best = 0
-			track = 0
-			#Loop through and figure out which is best
-			for name, row in group_df.iterrows():
-				if track == 0:
-					best = row["counts"]
-					chosen_ones = [name]
-					track = 1
-				else:
-					if row["counts"] > best:
-						continue
-					elif row["counts"] < best:
-						#If this is the best we've seen, replace chosen_ones with new choice
-						best = row["counts"]
-						chosen_ones = [name]
-					elif row["counts"] == best:
-						#If its a tie, add to list of chosen_ones
-						chosen_ones.append(name)
-
-			#Use chosen list to assign values
-			#If one chosen, set chosen to 1/True and the rest to 0/False
-			if len(chosen_ones) == 1:
-				df.loc[df["conflict_block"] == group, "choose"] = 0
-				df.loc[chosen_ones[0], "choose"] = 1
-			#Elif, multiple were chosen
-			elif len(chosen_ones) > 1:
-				df.loc[df["conflict_block"] == group, "choose"] = 0
-				for i in chosen_ones:
-					df.loc[i, "choose"] = "NULL"
-			# else:
-			# 	message = "Error: No TR chosen for block " + group + ", something went wrong"
-			# 	raise RuntimeError(message)
-	return(df)
-
-#Function to go through pandas df of conflict counts and choose best by "maximum"
-def parseCountsMax(df):
-	groups = df.groupby("conflict_block")
-	for group, group_df in groups:
-		#print("\n########Conflict Block is: ",group,"\n")
-		#print(group_df)
-		#If only one TR for alignment, set choose to 1:
-		if group_df.shape[0] == 1:
-			for name, row in group_df.iterrows():
-				#modify original dataframe
-				df.loc[name, "choose"] = 1
-		else:
-			#For each TR in locus
-			chosen_ones = []
-			best = 0
-			#Loop through and figure out which is best
-			for name, row in group_df.iterrows():
-				if row["counts"] < best:
-					continue
-				elif row["counts"] > best:
-					#If this is the best we've seen, replace chosen_ones with new choice
-					best = row["counts"]
-					chosen_ones = [name]
-				elif row["counts"] == best and best != 0:
-					#If its a tie, add to list of chosen_ones
-					chosen_ones.append(name)
-			#Use chosen list to assign values
-			#If one chosen, set chosen to 1/True and the rest to 0/False
-			if len(chosen_ones) == 1:
-				df.loc[df["conflict_block"] == group, "choose"] = 0
-				df.loc[chosen_ones[0], "choose"] = 1
-			#Elif, multiple were chosen
-			elif len(chosen_ones) > 1:
-				df.loc[df["conflict_block"] == group, "choose"] = 0
-				for i in chosen_ones:
-					df.loc[i, "choose"] = "NULL"
-			# else:
-			# 	message = "Error: No TR chosen for block %s, something went wrong"%(group)
-			# 	raise RuntimeError(message)
-	return(df)
-
 #Function to prints flanking SNPs for conflicting regions...
 #Function for use when debugging
 def printFlankingSNPCounts_conflicts(conn):
@@ -1106,131 +1235,29 @@ def printFlankingSNPCounts_conflicts(conn):
 		FROM
 			conflicts AS c INNER JOIN regions AS r USING (regid)
 		WHERE
-			c.choose="NULL"
+			c.choose IS NULL
 
 	'''
 	print(pd.read_sql_query(sql, conn))
 
 #Function for resolving conflict blocks by minimizing "bad" bases in flanking region
 def regionSelect_MINBAD(conn):
-	cur = conn.cursor()
-
-	#Fetch number of entries in conflict tables
-	rows = getConflictNumRows(conn)
-
-	#Make sure there is some data to work on
-	if rows <= 0 :
-		raise ValueError("There are no rows in <conflicts>!")
-
-	#-Use RANDOM to resolve any remaining NULLs.
-	#print("DIST IS ",dist)
-	#Query conflicts temp table to make a pandas dataframe for parsing
-	#This version includes records which have a zero from the COUNT aggregate function by
-	#outer joining the 'counts' table by the original table.
-	#Probably a better way to go about it but i'm tired of dicking with it...
-	sql = '''
-		SELECT
-			c.regid,
-			conflict_block,
-			choose,
-			(gap + bad + bad_flank + gap_flank) as counts
-		FROM
-			conflicts AS c INNER JOIN regions AS r USING (regid)
-		WHERE
-			c.choose="NULL"
-	'''
-
-	df = pd.read_sql_query(sql, conn)
-
-	#Split df into locid groups (retains INDEX of each entry, but in separate dfs)
-	#Loop through groups and select highest
-	try:
-		df = parseCountsMin(df)
-	except:
-		raise
-
-	#Push modified DF to SQL as temp table
-	updateChosenFromPandas(conn, df)
+	resolveConflictsByCounts(conn, "gap + bad + bad_flank + gap_flank", highest=False)
 
 #Function for resolving conflict blocks by minimizing all variable bases in flanking region
 def regionSelect_MINVAR_TR(conn):
-	cur = conn.cursor()
-
-	#Fetch number of entries in conflict tables
-	rows = getConflictNumRows(conn)
-	#Make sure there is some data to work on
-	if rows <= 0 :
-		raise ValueError("There are no rows in <conflicts>!")
-
-	#Query conflicts temp table to make a pandas dataframe for parsing
-	sql = '''
-		SELECT
-			c.regid,
-			conflict_block,
-			choose,
-			(vars + flank_vars) AS counts
-		FROM
-			conflicts AS c INNER JOIN regions AS r USING (regid)
-		WHERE
-			c.choose="NULL"
-	'''
-
-	df = pd.read_sql_query(sql, conn)
-	#Split df into locid groups (retains INDEX of each entry, but in separate dfs)
-	try:
-		df = parseCountsMin(df)
-	except:
-		raise
-
-	#Push modified DF to SQL as temp table
-	updateChosenFromPandas(conn, df)
+	resolveConflictsByCounts(conn, "vars + flank_vars", highest=False)
 
 #Function for resolving conflict blocks by minimizing number of flanking SNPs
 def regionSelect_MINSNP(conn):
-	cur = conn.cursor()
-
-	#Fetch number of entries in conflict tables
-	rows = getConflictNumRows(conn)
-
-	#Make sure there is some data to work on
-	if rows <= 0 :
-		raise ValueError("There are no rows in <conflicts>!")
-
-	#-Use RANDOM to resolve any remaining NULLs.
-	#print("DIST IS ",dist)
-	#Query conflicts temp table to make a pandas dataframe for parsing
-	sql = '''
-		SELECT
-			c.regid,
-			conflict_block,
-			choose,
-			(vars + vars_flank) as counts
-		FROM
-			conflicts AS c INNER JOIN regions AS r USING (regid)
-		WHERE
-			c.choose="NULL"
-	'''
-
-	#printFlankingSNPs_conflicts(conn, dist)
-	#printFlankingSNPCounts_conflicts(conn, dist)
-	df = pd.read_sql_query(sql, conn)
-
-	#Split df into locid groups (retains INDEX of each entry, but in separate dfs)
-	#Loop through groups and select highest
-	try:
-		df = parseCountsMin(df)
-	except:
-		raise
-
-	#Push modified DF to SQL as temp table
-	updateChosenFromPandas(conn, df)
+	resolveConflictsByCounts(conn, "vars + vars_flank", highest=False)
 
 #Function to push resolved TR conflicts to the regions table
 def pushResolvedConflicts(conn):
 
 	#Check that all conflicts are resolved
 	cur = conn.cursor()
-	unres = pd.read_sql_query("SELECT COUNT(*) FROM conflicts WHERE choose='NULL'", conn)
+	unres = pd.read_sql_query("SELECT COUNT(*) FROM conflicts WHERE choose IS NULL", conn)
 	rows = unres.shape[0]
 	if rows <= 0:
 		print("Unresolved conflicts:")
@@ -1485,27 +1512,9 @@ def regionFilterBED_include(conn, dist):
 
 	if getNumBED(conn) > 0:
 		if getNumPassedBED(conn) > 0:
-			df = pd.DataFrame() #empty pandas DF
-
-			sql = """
-				SELECT regid, regions.start, regions.stop, regions.pass,
-					bedid, bed.start AS bed_start, bed.stop AS bed_stop
-				FROM
-					regions INNER JOIN bed ON regions.locid = bed.locid
-				WHERE
-					regions.pass = 1 AND bed.pass = 1
-			"""
-			df = pd.read_sql_query(sql, conn)
-			whitelist = parseJoinBEDTable(df, dist)
-			removeRegionsByWhitelist(conn, whitelist)
-
-			"""
-			1. Fetch INNER JOINED db matching criterion
-			2. Parse overlaps in Python (see function above)
-			3. Return list of ones to keep.
-			4. For UPDATE- Set pass to 0 if: pass NOT 1 in returned list, OR if already failed
-				This should also fail the case where NO BED RECORDS TO JOIN or bed record was failed
-			"""
+			#Fail targets with no passing BED record within dist, including
+			#those on loci with no BED records
+			regionFilterProximity(conn, "bed", dist, keep=True)
 		else:
 			cur.execute("UPDATE regions SET pass = 0")
 			print("WARNING: No BED records passed quality control. Because you chose to filter target regions on proximity to BED records, no targets will be retained.")
@@ -1515,61 +1524,21 @@ def regionFilterBED_exclude(conn, dist):
 
 	if getNumBED(conn) > 0:
 		if getNumPassedBED(conn) > 0:
-			df = pd.DataFrame() #empty pandas DF
-
-			sql = """
-				SELECT regid, regions.start, regions.stop, regions.pass,
-					bedid, bed.start AS bed_start, bed.stop AS bed_stop
-				FROM
-					regions INNER JOIN bed ON regions.locid = bed.locid
-				WHERE
-					regions.pass = 1 AND bed.pass = 1
-			"""
-			df = pd.read_sql_query(sql, conn)
-			blacklist = parseJoinBEDTable(df, dist)
-			removeRegionsByList(conn, blacklist)
+			regionFilterProximity(conn, "bed", dist, keep=False)
 
 
 #Function to filter targets by proximity or overlap with GFF records
 def regionFilterGFF(conn, gff_type, dist):
 	cur = conn.cursor()
 
-	if getNumGFF(conn) > 0:
+	checkGFFLoaded(conn, "gff", gff_type)
+	if getNumGFF(conn) > 0 or getNumDroppedGFF(conn) > 0:
 		if getNumPassedGFF(conn) > 0:
-			df = pd.DataFrame() #empty pandas DF
 			#If get GFF by type:
 			if gff_type == "all":
-				sql = """
-					SELECT regid, regions.start, regions.stop, regions.pass,
-						gffid, gff.start AS gff_start, gff.stop AS gff_stop
-					FROM
-						regions INNER JOIN gff ON regions.locid = gff.locid
-					WHERE
-						regions.pass = 1 AND gff.pass = 1
-				"""
-				df = pd.read_sql_query(sql, conn)
+				regionFilterProximity(conn, "gff", dist, keep=True)
 			else:
-				#Query database to get targets with passing GFFs
-				sql = """
-					SELECT regid, regions.start, regions.stop, regions.pass,
-						gffid, gff.start AS gff_start, gff.stop AS gff_stop
-					FROM
-						regions INNER JOIN gff ON regions.locid = gff.locid
-					WHERE
-						regions.pass = 1 AND gff.pass = 1 AND gff.type = ?
-				"""
-				df = pd.read_sql_query(sql, conn, params=(gff_type,))
-
-			whitelist = parseJoinGFFTable(df, dist)
-			removeRegionsByWhitelist(conn, whitelist)
-
-			"""
-			1. Fetch INNER JOINED db matching criterion
-			2. Parse overlaps in Python (see function above)
-			3. Return list of ones to keep.
-			4. For UPDATE- Set pass to 0 if: pass NOT 1 in returned list, OR if already failed
-				This should also fail the case where NO GFF RECORDS TO JOIN or gff record was failed
-			"""
+				regionFilterProximity(conn, "gff", dist, keep=True, where="type = ?", args=(gff_type,))
 		else:
 			cur.execute("UPDATE regions SET pass = 0")
 			print("WARNING: No GFF records passed quality control. Because you chose to filter target regions on proximity to GFF records, no targets will be retained.")
@@ -1581,36 +1550,14 @@ def regionFilterGFF(conn, gff_type, dist):
 def regionFilterGFF_Alias(conn, gff_type, dist):
 	cur = conn.cursor()
 
-	if getNumGFF(conn) > 0:
+	checkGFFLoaded(conn, "gff_a", gff_type)
+	if getNumGFF(conn) > 0 or getNumDroppedGFF(conn) > 0:
 		if getNumPassedGFF(conn) > 0:
-			df = pd.DataFrame() #empty pandas DF
-			#If get GFF by type:
+			#If get GFF by alias:
 			if gff_type == "all":
-				sql = """
-					SELECT regid, regions.start, regions.stop, regions.pass,
-						gffid, gff.start AS gff_start, gff.stop AS gff_stop
-					FROM
-						regions INNER JOIN gff ON regions.locid = gff.locid
-					WHERE
-						regions.pass = 1 AND gff.pass = 1 AND gff.alias != "NULL"
-				"""
-				df = pd.read_sql_query(sql, conn)
+				regionFilterProximity(conn, "gff", dist, keep=True, where="alias != 'NULL'")
 			else:
-				#Query database to get targets with passing GFFs
-				sql = """
-					SELECT regid, regions.start, regions.stop, regions.pass,
-						gffid, gff.start AS gff_start, gff.stop AS gff_stop
-					FROM
-						regions INNER JOIN gff ON regions.locid = gff.locid
-					WHERE
-						regions.pass = 1 AND gff.pass = 1 AND gff.alias = ?
-				"""
-				df = pd.read_sql_query(sql, conn, params=(gff_type,))
-
-			#Get list of passed targets, pass list to FAIL all non-whitelisted targets
-			whitelist = parseJoinGFFTable(df, dist)
-			removeRegionsByWhitelist(conn, whitelist)
-
+				regionFilterProximity(conn, "gff", dist, keep=True, where="alias = ?", args=(gff_type,))
 		else:
 			cur.execute("UPDATE regions SET pass = 0")
 			print("WARNING: No GFF records passed quality control. Because you chose to filter target regions on proximity to GFF records, no targets will be retained.")
@@ -1618,35 +1565,51 @@ def regionFilterGFF_Alias(conn, gff_type, dist):
 		print("WARNING: No GFF records present in database. Skipping target region filtering on proximity to GFF records.")
 	conn.commit()
 
-#Function to parse an INNER JOIN regions/gff table for overlapping fragments, and return whitelist
-def parseJoinGFFTable(df, dist):
-	for index, row in df.iterrows():
-		min1 = row["start"] - dist or 0
-		min2 = row["gff_start"]
-		max1 = row["stop"] + dist
-		max2 = row["gff_stop"]
-		#If no overlap (overlap distance <= 0), set 'pass' to 0/FAIL
-		if utils.calcOverlap(min1, max1, min2, max2) <= 0:
-			df.loc[index, "pass"] = 0
-
-	#Get list of passed targets, pass list to FAIL all non-whitelisted targets
-	whitelist = df[df["pass"]==1].regid.unique()
-	return(whitelist)
-
-#Function to parse an INNER JOIN regions/bed table for overlapping fragments, and return whitelist
-def parseJoinBEDTable(df, dist):
-	for index, row in df.iterrows():
-		min1 = row["start"] - dist or 0
-		min2 = row["bed_start"]
-		max1 = row["stop"] + dist
-		max2 = row["bed_stop"]
-		#If no overlap (overlap distance <= 0), set 'pass' to 0/FAIL
-		if utils.calcOverlap(min1, max1, min2, max2) <= 0:
-			df.loc[index, "pass"] = 0
-
-	#Get list of passed targets, pass list to FAIL all non-whitelisted targets
-	whitelist = df[df["pass"]==1].regid.unique()
-	return(whitelist)
+#Function to fail passing targets by their proximity to the passing records of an interval table (gff or bed)
+#where is an extra SQL condition on the records, with its parameters in args
+#keep=True fails targets with no record within dist of them, keep=False fails those with one
+def regionFilterProximity(conn, table, dist, keep=True, where=None, args=()):
+	regions = pd.read_sql_query("SELECT regid, locid, start, stop FROM regions WHERE pass = 1", conn)
+	sql = "SELECT locid, start, stop FROM %s WHERE pass = 1"%table
+	if where:
+		sql += " AND " + where
+	sql += " ORDER BY locid, start"
+	intervals = pd.read_sql_query(sql, conn, params=args)
+
+	near = findNearbyIntervals(regions, intervals, dist)
+	removeRegionsByList(conn, regions["regid"][near != keep].tolist())
+
+#Function to find which targets overlap an interval on the same locus, once extended by dist on both sides
+#regions and intervals are DataFrames with locid, start, and stop columns; intervals sorted by locid and start
+#Intervals are indexed by a sorted (locid, start) key, along with the running maximum of stops in each locus,
+#so each target only needs a binary search for the last interval starting before the end of its window
+#RETURNS: boolean numpy array, True for each row of regions with an overlapping interval
+def findNearbyIntervals(regions, intervals, dist):
+	#Empty intervals (stop <= start) never overlap anything
+	intervals = intervals[intervals["stop"] > intervals["start"]]
+	if regions.empty or intervals.empty:
+		return(np.zeros(len(regions), dtype=bool))
+
+	ilocs = intervals["locid"].values.astype(np.int64)
+	istarts = intervals["start"].values.astype(np.int64)
+	istops = intervals.groupby("locid", sort=False)["stop"].cummax().values.astype(np.int64)
+	rlocs = regions["locid"].values.astype(np.int64)
+	wstarts = regions["start"].values.astype(np.int64) - dist
+	wstops = regions["stop"].values.astype(np.int64) + dist
+
+	#Keys of each locus fall in their own block, ordered by start
+	base = min(istarts.min(), wstops.min())
+	span = max(istarts.max(), wstops.max()) - base + 1
+	keys = ilocs * span + (istarts - base)
+	last = np.searchsorted(keys, rlocs * span + (wstops - base), side="left") - 1
+
+	#Overlap if an interval of the locus starts before the window ends, and one of those stops after it starts
+	found = last >= 0
+	last[~found] = 0
+	found &= ilocs[last] == rlocs
+	found &= istops[last] > wstarts
+	found &= wstops > wstarts
+	return(found)
 
 """DEPRECATED"""
 # #Function to parse variants table to update regions VARS for flanking information
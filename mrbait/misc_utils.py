@@ -6,11 +6,12 @@ import os.path
 import pandas as pd
 import re
 import operator
+from mrbait import compress_tools
 
 #counts non-empty lines in file
 #if skip=True, skips commented lines (startswith #)
 def fileLength(fname, skip=False):
-	with open(fname) as f:
+	with compress_tools.open_input(fname, "rt") as f:
 		count=0
 		for l in f:
 			line = l.strip()
@@ -35,171 +35,190 @@ def main():
 	print ("\t\tEstablishing database connection:", params.db)
 	conn = m.create_connection(params.db)
 
+	#Start one pool of workers, reused by the parallel parts of all steps
+	pool = None
+	if int(params.threads) > 1:
+		if params._executor == "serial":
+			print ("\t\tRunning parallel steps serially (executor: serial)")
+		elif params._executor == "thread":
+			print ("\t\tStarting",str(params.threads),"worker threads")
+		else:
+			print ("\t\tStarting",str(params.threads),"worker processes")
+		pool = pcore.start_pool(params)
+
 	#Initialize empty databases
 	#if conn.empty() or something like that
 	if params.resume:
 		step = params.resume + 1
 	else:
 		step = 0
-	while step < 6:
-		if step == 0:
-			#Establishing new database
-			start = timer()
-			print ("\t\tInitializing empty tables.\n")
-			m.init_new_db(conn)
-			step = 1
-			printTime(start,2)
-		elif step == 1:
-			start = timer()
-			#Loading inputs
-			print ("\n\tStep 1: Loading Alignments")
-			#Clear database
-			if m.getNumPassedLoci(conn) > 0:
-				print("\t\tClearing existing records from database")
+	#The pool is shut down however the run ends (sys.exit calls, errors, or Ctrl-C)
+	try:
+		while step < 6:
+			if step == 0:
+				#Establishing new database
+				start = timer()
+				print ("\t\tInitializing empty tables.\n")
 				m.init_new_db(conn)
-			loadAlignments(conn, params)
-			#PASS=1 is PASS=FALSE
-
-			#optional masking of loci using DUST algorithm
-			if params.dustMask:
-				print("\t\tMasking consensus sequences using the DUST algorithm in VSEARCH...", end="")
-				masked = core.fastxMaskLoci(conn, params, m.getPassedLoci(conn))
-				m.updateLociMask(conn, masked)
-				print(" Done!")
-
-			#Pre-filters: Length, alignment depth
-			print("\t\tFiltering loci...",end="")
-			#print(m.getLoci(conn))
-			m.filterLoci(conn, params.minlen, params.cov, params.max_ambig, params.max_mask)
-			#print(m.getLoci(conn))
-			print(" Done!\n")
-
-			passedLoci = m.getNumPassedLoci(conn)
-			if passedLoci <= 0:
-				sys.exit("\nProgram killed: No loci passed filtering.\n")
-			else:
-				print("\t\t### Results: %s loci passed filtering! ###"%passedLoci)
-			if params.print_loc:
-				print("\t\tPrinting locus catalog to file...")
-				core.printLoci(conn, params)
-			step = 2
-			printTime(start,2)
-		elif step == 2:
-			start = timer()
-			#Target discovery
-			print("\n\tStep 2: Target Discovery")
-			#Check that database has loci
-			passedLoci = m.getNumPassedLoci(conn)#returns pandas dataframe
-			if passedLoci <= 0:
-				sys.exit("\nProgram killed: No loci in database.\n")
-			else:
-				#Check if targets exist
-				#If yes, clear them
-				numTRs = m.getNumTRs(conn)
-				if numTRs > 0:
-					print("\t\tWarning: Database already contains targets. Clearing existing records.")
+				step = 1
+				printTime(start,2)
+			elif step == 1:
+				start = timer()
+				#Loading inputs
+				print ("\n\tStep 1: Loading Alignments")
+				#Clear database
+				if m.getNumPassedLoci(conn) > 0:
+					print("\t\tClearing existing records from database")
+					m.init_new_db(conn)
+				loadAlignments(conn, params, pool)
+				#PASS=1 is PASS=FALSE
+
+				#optional masking of loci using DUST algorithm
+				if params.dustMask:
+					print("\t\tMasking consensus sequences using the DUST algorithm in VSEARCH...", end="")
+					masked = core.fastxMaskLoci(conn, params, m.getPassedLoci(conn))
+					m.updateLociMask(conn, masked)
+					print(" Done!")
+
+				#Pre-filters: Length, alignment depth
+				print("\t\tFiltering loci...",end="")
+				#print(m.getLoci(conn))
+				m.filterLoci(conn, params.minlen, params.cov, params.max_ambig, params.max_mask)
+				#print(m.getLoci(conn))
+				print(" Done!\n")
+
+				passedLoci = m.getNumPassedLoci(conn)
+				if passedLoci <= 0:
+					sys.exit("\nProgram killed: No loci passed filtering.\n")
+				else:
+					print("\t\t### Results: %s loci passed filtering! ###"%passedLoci)
+				if params.print_loc:
+					print("\t\tPrinting locus catalog to file...")
+					core.printLoci(conn, params)
+				step = 2
+				printTime(start,2)
+			elif step == 2:
+				start = timer()
+				#Target discovery
+				print("\n\tStep 2: Target Discovery")
+				#Check that database has loci
+				passedLoci = m.getNumPassedLoci(conn)#returns pandas dataframe
+				if passedLoci <= 0:
+					sys.exit("\nProgram killed: No loci in database.\n")
+				else:
+					#Check if targets exist
+					#If yes, clear them
+					numTRs = m.getNumTRs(conn)
+					if numTRs > 0:
+						print("\t\tWarning: Database already contains targets. Clearing existing records.")
+						m.clearBaits(conn)
+						m.clearTargets(conn)
+
+					#Target discovery call
+					targetDiscovery(conn, params, pool)
+					passed = m.getNumPassedTRs(conn)
+					if passed <= 0:
+						sys.exit("\nProgram killed: No viable targets found.\n")
+					else:
+						print("\n\t\t### Results: %s potential targets identified! ###"%passed)
+					step = 3
+					printTime(start,2)
+				step = 3
+				#print(m.getRegions(conn))
+			elif step == 3:
+				start = timer()
+				print("\n\tStep 3: Target Filtering and Selection")
+				#Target filtering and conflict resolution
+				passedLoci = m.getNumPassedLoci(conn)#returns pandas dataframe
+				passedTargets = m.getNumPassedTRs(conn)
+				if passedLoci <= 0:
+					sys.exit("\nProgram killed: No loci in database.\n")
+				elif passedTargets <= 0:
+					sys.exit("\nProgram killed: No targets in database.\n")
+				else:
+					#Clear baits
 					m.clearBaits(conn)
-					m.clearTargets(conn)
-
-				#Target discovery call
-				targetDiscovery(conn, params)
+					#reset targets
+					m.resetTargets(conn)
+					#Recount flanking regions if -d differs from when targets were found
+					updated = core.flankDistParser(conn, params)
+					if updated > 0:
+						print("\t\tFlanking distance (-d,--flank_dist) changed: Updated flanking counts for",updated,"targets.")
+					#select: resolve conflicts, apply filters
+					selectFilterTargets(conn, params)
 				passed = m.getNumPassedTRs(conn)
+				if params.print_tr:
+					print("\t\tPrinting targets to file...")
+					core.printTargets(conn, params)
 				if passed <= 0:
-					sys.exit("\nProgram killed: No viable targets found.\n")
+					sys.exit("\nProgram killed: No targets passed filtering.\n")
 				else:
-					print("\n\t\t### Results: %s potential targets identified! ###"%passed)
-				step = 3
+					print("\n\t\t### Results: %s targets passed filtering! ###"%passed)
 				printTime(start,2)
-			step = 3
-			#print(m.getRegions(conn))
-		elif step == 3:
-			start = timer()
-			print("\n\tStep 3: Target Filtering and Selection")
-			#Target filtering and conflict resolution
-			passedLoci = m.getNumPassedLoci(conn)#returns pandas dataframe
-			passedTargets = m.getNumPassedTRs(conn)
-			if passedLoci <= 0:
-				sys.exit("\nProgram killed: No loci in database.\n")
-			elif passedTargets <= 0:
-				sys.exit("\nProgram killed: No targets in database.\n")
-			else:
-				#Clear baits
-				m.clearBaits(conn)
-				#reset targets
-				m.resetTargets(conn)
-				#select: resolve conflicts, apply filters
-				selectFilterTargets(conn, params)
-			passed = m.getNumPassedTRs(conn)
-			if params.print_tr:
-				print("\t\tPrinting targets to file...")
-				core.printTargets(conn, params)
-			if passed <= 0:
-				sys.exit("\nProgram killed: No targets passed filtering.\n")
-			else:
-				print("\n\t\t### Results: %s targets passed filtering! ###"%passed)
-			printTime(start,2)
-			step = 4
-		elif step == 4:
-			#Bait discovery
-			start = timer()
-			print("\n\tStep 4: Bait discovery")
-			passedLoci = m.getNumPassedLoci(conn)#returns pandas dataframe
-			passedTargets = m.getNumPassedTRs(conn)
-			if passedLoci <= 0:
-				sys.exit("\nProgram killed: No loci in database.\n")
-			elif passedTargets <= 0:
-				sys.exit("\nProgram killed: No targets in database.\n")
-			else:
-				#clear baits
-				m.clearBaits(conn)
-				baitDiscovery(conn, params)
-				passed = m.getNumPassedBaits(conn)
-				if passed <= 0:
-					sys.exit("\nProgram killed: No baits found.\n")
-				else:
-					print("\n\t\t### Results: %s potential baits identified! ###"%passed)
-			printTime(start,2)
-			step = 5
-		elif step == 5:
-			start = timer()
-			print("\n\tStep 5: Bait filtering")
-			passedLoci = m.getNumPassedLoci(conn)#returns pandas dataframe
-			passedTargets = m.getNumPassedTRs(conn)
-			if passedLoci <= 0:
-				sys.exit("\nProgram killed: No passed loci in database.\n")
-			elif passedTargets <= 0:
-				sys.exit("\nProgram killed: No passed targets in database.\n")
-			else:
-				#Bait filtering
-				#reset baits
-				m.resetBaits(conn)
-				filterBaits(conn,params)
-				passedBaits = m.getNumPassedBaits(conn)
-				if passedBaits <= 0:
-					sys.exit("\nProgram killed: No baits passed filtering.\n")
+				step = 4
+			elif step == 4:
+				#Bait discovery
+				start = timer()
+				print("\n\tStep 4: Bait discovery")
+				passedLoci = m.getNumPassedLoci(conn)#returns pandas dataframe
+				passedTargets = m.getNumPassedTRs(conn)
+				if passedLoci <= 0:
+					sys.exit("\nProgram killed: No loci in database.\n")
+				elif passedTargets <= 0:
+					sys.exit("\nProgram killed: No targets in database.\n")
 				else:
-					print("\t\t\t",passedBaits,"passed filtering.")
-					#Print baits
-					print("\t\tFormatting for printing...")
-					formatPrintBaits(conn, params)
+					#clear baits
+					m.clearBaits(conn)
+					baitDiscovery(conn, params, pool)
 					passed = m.getNumPassedBaits(conn)
 					if passed <= 0:
+						sys.exit("\nProgram killed: No baits found.\n")
+					else:
+						print("\n\t\t### Results: %s potential baits identified! ###"%passed)
+				printTime(start,2)
+				step = 5
+			elif step == 5:
+				start = timer()
+				print("\n\tStep 5: Bait filtering")
+				passedLoci = m.getNumPassedLoci(conn)#returns pandas dataframe
+				passedTargets = m.getNumPassedTRs(conn)
+				if passedLoci <= 0:
+					sys.exit("\nProgram killed: No passed loci in database.\n")
+				elif passedTargets <= 0:
+					sys.exit("\nProgram killed: No passed targets in database.\n")
+				else:
+					#Bait filtering
+					#reset baits
+					m.resetBaits(conn)
+					filterBaits(conn,params)
+					passedBaits = m.getNumPassedBaits(conn)
+					if passedBaits <= 0:
 						sys.exit("\nProgram killed: No baits passed filtering.\n")
 					else:
-						print("\n\t\t### Results: %s baits output to file! ###"%passed)
-			printTime(start,2)
-			step = 6
-
-	print("\n\t=======================================================================")
-	out = params.workdir + "/" + params.out + ".fasta"
-	print("\t### Final output: %s ###"%out)
-	printTime(global_start, 1)
-	print()
+						print("\t\t\t",passedBaits,"passed filtering.")
+						#Print baits
+						print("\t\tFormatting for printing...")
+						formatPrintBaits(conn, params)
+						passed = m.getNumPassedBaits(conn)
+						if passed <= 0:
+							sys.exit("\nProgram killed: No baits passed filtering.\n")
+						else:
+							print("\n\t\t### Results: %s baits output to file! ###"%passed)
+				printTime(start,2)
+				step = 6
+
+		print("\n\t=======================================================================")
+		out = params.workdir + "/" + params.out + ".fasta"
+		print("\t### Final output: %s ###"%out)
+		printTime(global_start, 1)
+		print()
+	finally:
+		pcore.stop_pool(pool)
 	conn.close()
 	sys.exit()
 
 #Loading inputs
-def loadAlignments(conn, params):
+def loadAlignments(conn, params, pool):
 	#load alignment to database
 	print("\t\tStep 1 parameters:")
 	if params.alignment or params.loci or params.xmfa:
@@ -215,14 +234,14 @@ def loadAlignments(conn, params):
 			print("\t\tLoading MAF file:",params.alignment)
 			if int(params.threads) > 1:
 				print("\t\t\tLoading alignments using",str(params.threads),"parallel processes.")
-				pcore.loadMAF_parallel(conn, params)
+				pcore.loadMAF_parallel(conn, params, pool)
 			else:
 				core.loadMAF(conn, params)
 		elif params.xmfa:
 			print("\t\tLoading XMFA file:",params.xmfa)
 			if int(params.threads)>1:
 				print("\t\t\tLoading alignments using",str(params.threads),"parallel processes.")
-				pcore.loadXMFA_parallel(conn, params)
+				pcore.loadXMFA_parallel(conn, params, pool)
 			else:
 				pass
 				core.loadXMFA(conn, params)
@@ -231,7 +250,7 @@ def loadAlignments(conn, params):
 			print("\t\tLoading LOCI file:",params.loci)
 			if int(params.threads) > 1:
 				print("\t\t\tLoading alignments using",str(params.threads),"parallel processes.")
-				pcore.loadLOCI_parallel(conn, params)
+				pcore.loadLOCI_parallel(conn, params, pool)
 			else:
 				core.loadLOCI(conn, params)
 
@@ -241,27 +260,31 @@ def loadAlignments(conn, params):
 		print("\t\t\tMaximum allowed masked bases (-K):",params.max_mask)
 		#Load assembly file
 		print("\t\tLoading FASTA file:",params.assembly)
-		core.loadFASTA(conn, params)
+		if int(params.threads) > 1:
+			print("\t\t\tLoading contigs using",str(params.threads),"parallel processes.")
+			pcore.loadFASTA_parallel(conn, params, pool)
+		else:
+			core.loadFASTA(conn, params)
 
 		#If VCF file
 		if params.vcf:
 			print("\t\tLoading VCF file:",params.vcf)
-			# if int(params.threads) > 1:
-			# 	print("\t\t\tLoading VCF records using",str(params.threads),"parallel processes.")
-			# 	pcore.loadVCF_parallel(conn, params)
-			# else:
 			if (params.vcfALT):
 				print("\t\t\tAttempting to override N/gap alleles using ALT from VCF (--vcfALT=True)\n")
 			else:
 				print("\t\t\tRetaining N/gap alleles from FASTA reference (--vcfALT=False)\n")
-			core.loadVCF(conn, params)
+			if int(params.threads) > 1:
+				print("\t\t\tLoading VCF records using",str(params.threads),"parallel processes.")
+				pcore.loadVCF_parallel(conn, params, pool)
+			else:
+				core.loadVCF(conn, params)
 
 		#if GFF file
 		if params.gff:
 			print("\t\tLoading GFF file:",params.gff)
 			if int(params.threads) > 1:
 				print("\t\t\tLoading GFF using",str(params.threads),"parallel processes.")
-				pcore.loadGFF_parallel(conn, params)
+				pcore.loadGFF_parallel(conn, params, pool)
 			else:
 				core.loadGFF(conn, params)
 			#print(m.getGFF(conn))
@@ -270,7 +293,7 @@ def loadAlignments(conn, params):
 			print("\t\tLoading BED file:",params.bed)
 			if int(params.threads) > 1:
 				print("\t\t\tLoading BED using",str(params.threads),"parallel processes.")
-				pcore.loadBED_parallel(conn, params)
+				pcore.loadBED_parallel(conn, params, pool)
 			else:
 				core.loadBED(conn, params)
 			#print(m.getGFF(conn))
@@ -280,7 +303,7 @@ def loadAlignments(conn, params):
 
 
 #Function to call targetDiscoverySlidingWindow and print relevant params
-def targetDiscovery(conn, params):
+def targetDiscovery(conn, params, pool):
 	print("\t\tStep 2 parameters:")
 	print("\t\t\tSliding window width (-b, --bait):", params.win_width)
 	print("\t\t\tSliding window shift distance (-w, --win_shift):", params.win_shift)
@@ -289,8 +312,6 @@ def targetDiscovery(conn, params):
 	print("\t\t\tGap characters allowed per target (-g, --numG):", params.numG)
 	print("\t\t\tFlanking distance to parse (-d,--flank_dist):",params.flank_dist)
 
-	#Fetch passed loci
-	passedLoci = m.getPassedLoci(conn)
 	numPassedLoci = m.getNumPassedLoci(conn)
 	#sliding window call
 	if params.target_all:
@@ -301,9 +322,13 @@ def targetDiscovery(conn, params):
 
 	if int(params.threads) > 1:
 		print("\t\t\tFinding targets using",str(params.threads),"parallel processes...")
-		pcore.targetDiscoverySlidingWindow_parallel(conn, params, passedLoci)
+		#Workers read their own loci from the database
+		pcore.targetDiscoverySlidingWindow_parallel(conn, params, pool)
 	else:
-		core.targetDiscoverySlidingWindow(conn, params, passedLoci)
+		core.targetDiscoverySlidingWindow(conn, params, m.getPassedLoci(conn))
+	#Record parameters flanking counts depend on, so they can be updated on --resume
+	m.setMeta(conn, "flank_dist", params.flank_dist)
+	m.setMeta(conn, "target_all", params.target_all)
 
 #Function to print params and make calls for target region selection
 def selectFilterTargets(conn, params):
@@ -355,7 +380,7 @@ def selectFilterTargets(conn, params):
 			m.regionFilterRandom(conn, rand)
 
 #function to print and call core functions for probe development
-def baitDiscovery(conn, params):
+def baitDiscovery(conn, params, pool):
 	print("\t\tStep 4 parameters:")
 	print("\t\t\tBait length (-b, --blen):",params.blen)
 
@@ -368,7 +393,11 @@ def baitDiscovery(conn, params):
 	elif(params.select_b=="calc"):
 		print("\t\t\tDesigning",params.select_b_num,"baits per target with",params.overlap,"maximum overlap")
 	#core function call
-	core.baitDiscovery(conn, params, m.getPassedTRs(conn))
+	if int(params.threads) > 1:
+		print("\t\tDesigning baits using",str(params.threads),"parallel processes...")
+		pcore.baitDiscovery_parallel(conn, params, pool)
+	else:
+		core.baitDiscovery(conn, params, m.getPassedTRs(conn))
 
 #Function to filter baits
 def filterBaits(conn, params):
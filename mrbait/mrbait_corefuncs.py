@@ -5,7 +5,6 @@ import getopt
 import Bio
 import os
 import time
-from Bio import AlignIO
 from decimal import *
 from mrbait import mrbait_menu
 from mrbait import substring
@@ -16,6 +15,7 @@ from mrbait import sequence_tools as s
 from mrbait import misc_utils as utils
 from mrbait import seq_graph as graph
 from mrbait import aln_file_tools
+from mrbait import compress_tools
 from mrbait import vcf_tools
 from mrbait import vsearch
 from mrbait import gff3_parser as gff
@@ -37,18 +37,20 @@ def loadXMFA(conn, params):
 		print("\t\t\tReading",numLoci,"alignments... This may take a while.")
 	#Parse XMFA file and create database
 
+	writer = m.bufferedWriter(conn, params._batchSize)
 	num = 1
-	for aln in AlignIO.parse(params.xmfa, "mauve"):
+	for aln in aln_file_tools.read_xmfa(params.xmfa):
 		#NOTE: Add error handling, return error code
 		#print(aln)
 		cov = len(aln)
 		alen = aln.get_alignment_length()
 
 		#Add each locus to database
-		locus = a.consensAlign(aln, threshold=params.thresh, mask=params.mask, maf=params.maf)
+		consensus = a.make_consensus_array(aln.seqs, threshold=params.thresh, mask=params.mask, maf=params.maf)
 
-		locid = m.add_locus_record(conn, cov, locus.conSequence, 1, num)
+		locid = writer.add_locus(cov, consensus, 1, num)
 		num+=1
+	writer.flush()
 
 
 #Function to load a MAF file into database
@@ -59,16 +61,16 @@ def loadMAF(conn, params):
 	else:
 		print("\t\t\tReading",numLoci,"alignments... This may take a while.")
 	#Parse MAF file and create database
+	writer = m.bufferedWriter(conn, params._batchSize)
 	num = 1
-	for aln in AlignIO.parse(params.alignment, "maf"):
+	for aln in aln_file_tools.read_maf(params.alignment):
 		#NOTE: Add error handling, return error code
 		cov = len(aln)
 		alen = aln.get_alignment_length()
 
 		#Add each locus to database
-		locus = a.consensAlign(aln, threshold=params.thresh, mask=params.mask, maf=params.maf)
-		#consensus = str(a.make_consensus(aln, threshold=params.thresh)) #Old way
-		locid = m.add_locus_record(conn, cov, locus.conSequence, 1, num)
+		consensus = a.make_consensus_array(aln.seqs, threshold=params.thresh, mask=params.mask, maf=params.maf)
+		locid = writer.add_locus(cov, consensus, 1, num)
 		num+=1
 
 	#	print("Loading Locus #:",locid)
@@ -77,6 +79,7 @@ def loadMAF(conn, params):
 		#Extract variable positions for database
 		#for var in locus.alnVars:
 			#m.add_variant_record(conn, locid, var.position, var.value)
+	writer.flush()
 
 #Function to load .loci file into database.
 def loadLOCI(conn, params):
@@ -86,6 +89,9 @@ def loadLOCI(conn, params):
 	else:
 		print("\t\t\tReading",numLoci,"alignments... This may take a while.")
 	#Parse LOCI file and create database
+	#Alignments are processed in batches: one consensus call and one insert per batch
+	writer = m.bufferedWriter(conn, params._batchSize)
+	batch = list()
 	for aln in aln_file_tools.read_loci(params.loci):
 		#NOTE: Add error handling, return error code
 		cov = len(aln)
@@ -96,203 +102,345 @@ def loadLOCI(conn, params):
 			#print("Locus skipped")
 			continue
 		else:
-			#Add each locus to database
-			locus = a.consensAlign(aln, threshold=params.thresh, mask=params.mask, maf=params.maf)
-			#consensus = str(a.make_consensus(aln, threshold=params.thresh)) #Old way
-			locid = m.add_locus_record(conn, cov, locus.conSequence, 1, "NULL")
-			#print("Loading Locus #:",locid)
-
-			#Extract variable positions for database
-			#or var in locus.alnVars:
-				#m.add_variant_record(conn, locid, var.position, var.value)
+			batch.append(aln.seqs)
+			if len(batch) >= params._batchSize:
+				addLociBatch(writer, batch, params.thresh, params.mask, params.maf)
+				batch = list()
+	if batch:
+		addLociBatch(writer, batch, params.thresh, params.mask, params.maf)
+	writer.flush()
+
+#Function to call consensus for a batch of alignment arrays and add them to loci table
+def addLociBatch(writer, batch, thresh, mask, maf):
+	consensus = a.make_consensus_batch(batch, threshold=thresh, mask=mask, maf=maf)
+	for aln, cons in zip(batch, consensus):
+		writer.add_locus(aln.shape[0], cons, 1, "NULL")
 
 #Function to load FASTA into database
 def loadFASTA(conn, params):
-	for contig in aln_file_tools.read_fasta(params.assembly):
+	writer = m.bufferedWriter(conn, params._batchSize)
+	ref = openReference(params.assembly, params._alnIndex)
+	if ref is None:
+		contigs = aln_file_tools.read_fasta(params.assembly)
+	else:
+		contigs = aln_file_tools.read_fasta_indexed(ref)
+	for contig in contigs:
 		#print("Reading contig:",contig[0])
 		#print("Sequence is:",contig[1])
-		locid = m.add_locus_record(conn, 1, contig[1], 1, contig[0])
+		if not contig[1]:
+			continue
+		locid = writer.add_locus(1, contig[1], 1, contig[0])
 
 		#Parse consensus for vars, submit those vars to db
 		"""Deprecated"""
 		#for var in a.get_vars(contig[1]):
 			#m.add_variant_record(conn, locid, var.position, var.value)
+	writer.flush()
+	if ref is not None:
+		ref.close()
+
+#Function to open the assembly for random access: a .2bit file, or a FASTA with its .fai index (built if needed)
+#The .fai is only saved next to the FASTA if write_fai (--hacker aln_index)
+#Returns None if a FASTA can't be indexed (lines of unequal length), so it can be read sequentially
+def openReference(fas, write_fai=False):
+	if aln_file_tools.is_twobit(fas):
+		return(aln_file_tools.twoBitFile(fas))
+	try:
+		return(aln_file_tools.fastaIndex(fas, write_fai=write_fai))
+	except ValueError as err:
+		print("\t\t\tWarning: Can't index %s (%s): Reading it sequentially."%(fas, err))
+		return(None)
+
 
 #Function to load GFF file into database
+#Locus IDs are looked up in memory, and all records are inserted in one transaction
+#Only records needed by --filter_r options are loaded (see gffFilterSets)
 def loadGFF(conn, params):
-	#For each GFF record in params.gff
-	for record in gff.read_gff(params.gff):
+	chrom_lookup = m.getChromLookup(conn)
+	types, aliases = gffFilterSets(params)
+	reader = gff.gffReader(params.gff, chrom_lookup, types, aliases)
+	rows = list()
+	for row in gffRecordValues(reader, chrom_lookup):
+		rows.append(row)
+		if len(rows) >= params._batchSize:
+			m.insertBatch(conn, "gff", rows)
+			rows = list()
+	m.insertBatch(conn, "gff", rows)
+	conn.commit()
+	setGFFMeta(conn, types, aliases, reader.dropped)
+
+	#Check if all GFF records fall within bounds of
+	m.validateGFFRecords(conn)
+
+#Function to get the GFF types and aliases needed by gff and gff_a options of --filter_r
+#Without any, all records are kept (e.g. for use with --resume)
+#RETURNS: sets of lowercase types and aliases (see gff3_parser.gffReader)
+def gffFilterSets(params):
+	types = set()
+	aliases = set()
+	for option in params.filter_r_objects:
+		if option.o1 == "gff":
+			types.add(option.o2.lower())
+		elif option.o1 == "gff_a":
+			aliases.add(option.o2.lower())
+	if not types and not aliases:
+		types.add("all")
+	return(types, aliases)
+
+#Function to record which GFF records were loaded, so --resume can check that --filter_r options are covered
+#dropped is the number of records of loci which were not loaded
+def setGFFMeta(conn, types, aliases, dropped):
+	m.setMeta(conn, "gff_types", ";".join(sorted(types)))
+	m.setMeta(conn, "gff_aliases", ";".join(sorted(aliases)))
+	m.setMeta(conn, "gff_dropped", dropped)
+
+#Generator yielding values for gff table rows (see manage_bait_db.gff_record_values) from a gffReader
+#NOTE: Only records where seqid matches a locus (a key of chrom_lookup) are kept
+def gffRecordValues(reader, chrom_lookup):
+	for record in reader:
 		#Skip any records that are missing the sequence ID, or coordinates
 		if record.seqid == "NULL" or record.start == "NULL" or record.end == "NULL":
 			continue
+		locid = chrom_lookup.get(record.seqid)
+		if locid is None:
+			continue
 		if record.start > record.end:
 			temp = record.start
 			record.start = record.end
 			record.end = temp
-		#Get the alias, if it exists
-		alias = ""
-		if record.getAlias(): #returns false if no alias
-			alias = record.getAlias()
-		else:
-			alias = "NULL"
-		#NOTE: This function ONLY inserts GFFRecords where record.seqid matches an existing locus in the loci table
-		m.add_gff_record(conn, record.seqid, record.type.lower(), record.start, record.end, alias)
-
-	#Check if all GFF records fall within bounds of
-	m.validateGFFRecords(conn)
+		yield(m.gff_record_values(locid, record.type.lower(), record.start, record.end, record.alias))
 
 #Function to load BED file
+#Locus IDs are looked up in memory, and all records are inserted in one transaction
 def loadBED(conn, params):
+	chrom_lookup = m.getChromLookup(conn)
+	rows = list()
+	for row in bedRecordValues(params.bed, chrom_lookup, params.bed_header):
+		rows.append(row)
+		if len(rows) >= params._batchSize:
+			m.insertBatch(conn, "bed", rows)
+			rows = list()
+	m.insertBatch(conn, "bed", rows)
+	conn.commit()
 
-	with open(params.bed)as f:
+	#remove BED records not falling within our loci
+	m.validateBEDRecords(conn)
+
+#Generator yielding values for bed table rows (see manage_bait_db.bed_record_values) from a BED file
+#The first <header> non-empty lines are skipped
+#NOTE: Only records where the chrom matches a locus (a key of chrom_lookup) are kept
+def bedRecordValues(infile, chrom_lookup, header=0):
+	with compress_tools.open_input(infile, "rt") as f:
 		count=0
 		for line in f:
 			line = line.strip()
 			if not line:
 				continue
 			count+=1
-			if count <= params.bed_header:
+			if count <= header:
 				continue
 			content = line.split()
-
-			#NOTE: This function ONLY inserts BEDRecords where record.seqid matches an existing locus in the loci table
-			m.add_bed_record(conn, content[0], content[1], content[2])
-
-	#remove BED records not falling within our loci
-	#print(m.getBED(conn))
-	m.validateBEDRecords(conn)
-	#print(m.getBED(conn))
+			locid = chrom_lookup.get(content[0])
+			if locid is not None:
+				yield(m.bed_record_values(locid, content[1], content[2]))
 
 
 #Function to load VCF variants file
 def loadVCF(conn, params):
 
-	loci = m.getPassedLoci(conn) #get DF of passed loci
-	#print(loci)
-	#chrom_lookup = set(loci["chrom"].tolist()) #lookup table of locus IDs
+	loci = m.getPassedLociNames(conn) #get DF of passed loci, without sequences
 	chrom_lookup = loci.set_index('chrom')['id'].to_dict()
-	loci.set_index('id', inplace=True)
-	#print(loci)
-	#print(chrom_lookup)
-	#Using set_index causes a bug for some reason.
-	#loci.set_index('chrom', inplace=True) #index loci DF by chrom column
+	#Plain gzip files can't be read by contig, so are read through
+	if not compress_tools.is_splittable(params.vcf):
+		loadVCF_stream(conn, params, chrom_lookup)
+		return
+
+	samples, tasks, virtual = indexVCF(params.vcf, chrom_lookup)
+	ref = openUniqueReference(params.assembly, params._alnIndex)
+	patched = dict() #positions changed per contig
+	updates = list()
+	for chrom, locid, seq, changed in patchContigs(conn, params.vcf, tasks, ref, samples, virtual, params.thresh, params.vcfALT):
+		patched[chrom] = changed
+		#Queue new consensus seq for db; all updates are committed together
+		if changed:
+			updates.append((seq.decode(), locid))
+		if len(updates) >= params._batchSize:
+			m.updateConsensusBatch(conn, updates)
+			updates = list()
+	m.updateConsensusBatch(conn, updates)
+	conn.commit()
+	if ref is not None:
+		ref.close()
+	printPatched(patched)
+
+#Function to find VCF records of passing loci (see vcf_tools.index_vcf)
+#Records for contigs without a locus are never read
+#RETURNS: number of samples, list of (chrom, locus ID, byte ranges of its records), and whether ranges are virtual offsets
+def indexVCF(vcf, chrom_lookup):
+	samples, contigs, virtual = vcf_tools.index_vcf(vcf)
+	if virtual:
+		print("\t\t\tReading records of passing loci using the tabix index of %s."%vcf)
+	failed = [chrom for chrom in contigs if chrom not in chrom_lookup]
+	if failed:
+		print("\t\t\tWARNING:%s/%s contigs in <%s> don't match any reference sequences"%(len(failed), len(contigs), vcf))
+	tasks = [(chrom, int(chrom_lookup[chrom]), ranges) for chrom, ranges in contigs.items() if chrom in chrom_lookup]
+	return(samples, tasks, virtual)
+
+#Function to open the assembly for fetching contigs by name, leaving out duplicate names (which are read from the db)
+#Returns None if the assembly can't be indexed
+def openUniqueReference(fas, write_fai=False):
+	ref = openReference(fas, write_fai)
+	if ref is None:
+		return(None)
+	names = pd.Series(list(ref))
+	duplicated = set(names[names.duplicated()])
+	if not duplicated:
+		return(ref)
+	entries = [entry for entry in ref.entries if entry[0] not in duplicated]
+	ref.close()
+	return(aln_file_tools.open_reference(fas, entries=entries))
+
+#Function to patch consensus sequences of contigs with their VCF records
+#tasks are (chrom, locus ID, byte ranges of its records) from indexVCF
+#Sequences are fetched from ref if it has them, otherwise from the db
+#Generator function, yields (chrom, locus ID, patched sequence as bytearray, number of positions changed)
+def patchContigs(conn, vcf, tasks, ref, samples, virtual, thresh, altRef):
+	for chrom, locid, ranges in tasks:
+		if ref is not None and chrom in ref:
+			seq = bytearray(ref.fetch(chrom))
+		else:
+			seq = bytearray(m.getLocusConsensus(conn, locid).encode())
+		changed = 0
+		for reclist in vcf_tools.read_vcf_ranges(vcf, ranges, samples, virtual):
+			outside = vcf_tools.count_outside(reclist, len(seq))
+			if outside:
+				print("\t\t\tWarning: %s VCF records for locus %s (locid=<%s>) are past the end of its sequence. Skipping them."%(outside, chrom, locid))
+			#Patch consensus in place given VCF records
+			changed += vcf_tools.patch_consensus(seq, reclist, float(thresh), altRef)
+		yield([chrom, locid, seq, changed])
+
+#Function to load a gzip compressed VCF file, reading through it
+def loadVCF_stream(conn, params, chrom_lookup):
+	ref = openUniqueReference(params.assembly, params._alnIndex)
 
-	#print(loci)
 	passed=0 #To track number of VCF records for which no locus exists
 	failed=0
+	patched = dict() #positions changed per contig
+	updates = list()
 
 	for reclist in vcf_tools.read_vcf(params.vcf):
-		rec_chrom = reclist[0].CHROM
-		#print("Starting locus",rec_chrom)
+		rec_chrom = reclist.chrom
 		if rec_chrom in chrom_lookup:
-			#print("chrom:",rec_chrom, " - id:",chrom_lookup[rec_chrom])
-			locid = chrom_lookup[rec_chrom]
-			#print("locid is",locid)
+			locid = int(chrom_lookup[rec_chrom])
 			passed+=1
-			#for rec in reclist:
-			#	print(rec.CHROM, rec.POS, rec.REF, rec.ALT, len(rec.samples), rec.call_rate, rec.aaf)
-			#Grab DF record for the matching CHROM
-			seq = loci.loc[locid,'consensus']
-			#Get new consensus sequence given VCF records
-			new_cons = vcf_tools.make_consensus_from_vcf(seq,rec_chrom,reclist, params.thresh, params.vcfALT)
-
-			#Update new consensus seq in db
-			if len(new_cons) != len(seq): #Check length first
-				print("\t\t\tWarning: New consensus sequence for locus %s (locid=<%s>) is the wrong length! Skipping."%(rec_chrom, locid))
+			#Grab sequence for the matching CHROM, as a mutable buffer
+			#(from the db if records for it were already seen, so earlier changes are kept)
+			if rec_chrom in patched:
+				m.updateConsensusBatch(conn, updates)
+				updates = list()
+			if ref is not None and rec_chrom in ref and rec_chrom not in patched:
+				seq = bytearray(ref.fetch(rec_chrom))
 			else:
-				m.updateConsensus(conn, locid, new_cons)
-				#Delete old vars for locus, and parse new consensus
-				"""
-				#Deprecated
-				#m.purgeVars(conn, locid)
-				#Get new vars and add records to table
-				#for var in a.get_vars(new_cons):
-					#m.add_variant_record(conn, locid, var.position, var.value)
-				"""
-
+				seq = bytearray(m.getLocusConsensus(conn, locid).encode())
+			outside = vcf_tools.count_outside(reclist, len(seq))
+			if outside:
+				print("\t\t\tWarning: %s VCF records for locus %s (locid=<%s>) are past the end of its sequence. Skipping them."%(outside, rec_chrom, locid))
+			#Patch consensus in place given VCF records
+			changed = vcf_tools.patch_consensus(seq, reclist, float(params.thresh), params.vcfALT)
+			patched[rec_chrom] = patched.get(rec_chrom, 0) + changed
+
+			#Queue new consensus seq for db; all updates are committed together
+			if changed:
+				updates.append((seq.decode(), locid))
+			if len(updates) >= params._batchSize:
+				m.updateConsensusBatch(conn, updates)
+				updates = list()
 		else:
-			#print(rec_chrom, "not found.")
 			failed+=1
+	m.updateConsensusBatch(conn, updates)
+	conn.commit()
+	if ref is not None:
+		ref.close()
 	if failed > 0:
 		print("\t\t\tWARNING:%s/%s records in <%s> don't match any reference sequences"%(failed, failed+passed, params.vcf))
+	printPatched(patched)
+
+#Function to print number of positions changed per contig by VCF records
+#Contigs with the most changes are listed
+def printPatched(patched, show=10):
+	total = sum(patched.values())
+	changed = sorted([c for c in patched if patched[c]], key=patched.get, reverse=True)
+	print("\t\t\tPatched %s positions in %s/%s contigs with VCF records."%(total, len(changed), len(patched)))
+	for chrom in changed[:show]:
+		print("\t\t\t\t%s: %s positions"%(chrom, patched[chrom]))
+	if len(changed) > show:
+		print("\t\t\t\t(%s more contigs)"%(len(changed) - show))
 
 #Function to discover target regions using a sliding windows through passedLoci
 def targetDiscoverySlidingWindow(conn, params, loci):
 
+	writer = m.bufferedWriter(conn, params._batchSize)
 	#looping through passedLoci only
 	for seq in loci.itertuples():
 		#print(seq)
-		start = 0
-		stop = 0
 		#print(params.win_shift)
 		#print("\nConsensus: ", seq[2], "ID is: ", seq[1], "\n")
 		if params.target_all:
 			#print("target_all")
 			#submit full locus as target
-			seq_norm = s.simplifySeq(seq[2])
-			counts = s.seqCounterSimple(seq_norm)
+			index = s.locusIndex(seq[2])
+			counts = index.simple_counts(0, len(index))
 			if counts['*'] <= params.var_max and counts['N'] <= params.numN and counts['-'] <= params.numG:
 				target = seq[2]
-				tr_counts = s.seqCounterSimple(seq_norm)
-				n_mask = utils.n_lower_chars(seq[2])
-				n_gc = s.gc_counts(seq[2])
+				tr_counts = counts
+				n_mask = index.mask(0, len(index))
+				n_gc = index.gc(0, len(index))
 				#NOTE: flank count set to number of variable sites in whole locus
 				#print(int(seq[1]), 0, len(seq[2]), seq[2], tr_counts, tr_counts, n_mask, n_gc)
-				m.add_region_record(conn, int(seq[1]), 0, len(seq[2]), seq[2], tr_counts, tr_counts, n_mask, n_gc)
+				writer.add_region(int(seq[1]), 0, len(seq[2]), seq[2], tr_counts, tr_counts, n_mask, n_gc)
 		else:
 			#print("\nConsensus: ", seq[2], "ID is: ", seq[1], "\n")
-			generator = s.slidingWindowGenerator(seq[2], params.win_shift, params.win_width)
-			for window_seq in generator():
-
-				seq_norm = s.simplifySeq(window_seq[0])
-				counts = s.seqCounterSimple(seq_norm)
-
-				#If window passes filters, extend current bait region
-				#print("Start is ", start, " and stop is ",stop) #debug print
-				if counts['*'] <= params.var_max and counts['N'] <= params.numN and counts['-'] <= params.numG:
-					stop = window_seq[2]
-					#if this window passes BUT is the last window, evaluate it
-					if stop == len(seq[2]):
-						#print("last window")
-						if (stop - start) >= params.blen:
-							target = (seq[2])[start:stop]
-							tr_counts = s.seqCounterSimple(s.simplifySeq(target))
-							#print("candidate:",window_seq[0])
-							n_mask = utils.n_lower_chars(target)
-							n_gc = s.gc_counts(target)
-							#Check that there aren't too many SNPs
-							#if tr_counts["*"] <= params.vmax_r:
-							#print("	Target region: ", target)
-							#Submit target region to database
-							#print("process: grabbing lock")'
-							flank_counts = s.getFlankCounts(seq[2], start, stop, params.flank_dist)
-							m.add_region_record(conn, int(seq[1]), start, stop, target, tr_counts, flank_counts, n_mask, n_gc)
-							#set start of next window to end of current TR
-							generator.setI(stop)
-				else:
-					#If window fails, check if previous bait region passes to submit to DB
-					#print (stop-start)
-					if (stop - start) >= params.blen:
-						target = (seq[2])[start:stop]
-						tr_counts = s.seqCounterSimple(s.simplifySeq(target))
-						n_mask = utils.n_lower_chars(target)
-						n_gc = s.gc_counts(target)
-						#Check that there aren't too many SNPs
-						#if tr_counts["*"] <= params.vmax_r:
-						#print("	Target region: ", target)
-						#Submit target region to database
-						#print("process: grabbing lock")'
-						flank_counts = s.getFlankCounts(seq[2], start, stop, params.flank_dist)
-						m.add_region_record(conn, int(seq[1]), start, stop, target, tr_counts, flank_counts, n_mask, n_gc)
-						#set start of next window to end of current TR
-						generator.setI(stop)
-
-					#If bait fails, set start to start point of next window
-					start = generator.getI()+params.win_shift
+			#Find all target regions at once, from windowed counts of vars, Ns, and gaps
+			#All target and flank counts are taken from the same prefix-sum index
+			index = s.locusIndex(seq[2])
+			for start, stop in s.slidingWindowTargets(index, params.win_shift, params.win_width, params.var_max, params.numN, params.numG, params.blen):
+				target = (seq[2])[start:stop]
+				tr_counts = index.simple_counts(start, stop)
+				n_mask = index.mask(start, stop)
+				n_gc = index.gc(start, stop)
+				#Submit target region to database
+				flank_counts = index.flank_counts(start, stop, params.flank_dist)
+				writer.add_region(int(seq[1]), start, stop, target, tr_counts, flank_counts, n_mask, n_gc)
+	writer.flush()
 	#Now update regions table to include information for flanking regions if available
 	#m.flankDistParser(conn, params.flank_dist)
 
 
+#Function to recount flanking regions of existing targets if -d changed since target discovery
+#Returns number of targets updated
+def flankDistParser(conn, params):
+	old_dist = m.getMeta(conn, "flank_dist")
+	#Nothing to do if flank distance unchanged, unknown, or targets are full loci
+	if old_dist is None or int(old_dist) == params.flank_dist or m.getMeta(conn, "target_all") == "True":
+		return(0)
+	targets = m.getRegionCoords(conn)
+	if targets.empty:
+		return(0)
+	regions = {locid : group for locid, group in targets.groupby("locid", sort=False)}
+	rows = list()
+	#Index each locus once, then count flanks of each of its targets in constant time
+	for seq in m.getPassedLoci(conn).itertuples():
+		if seq[1] not in regions:
+			continue
+		index = s.locusIndex(seq[2])
+		for reg in regions[seq[1]].itertuples():
+			counts = index.flank_counts(int(reg.start), int(reg.stop), params.flank_dist)
+			rows.append([counts["*"], counts["N"], counts["-"], int(reg.regid)])
+	m.updateRegionFlanks(conn, rows)
+	m.setMeta(conn, "flank_dist", params.flank_dist)
+	return(len(rows))
+
+
 
 #Function to filter target regions by --filter_R arguments
 def filterTargetRegions(conn, params):
@@ -899,32 +1047,38 @@ def dupEdgeResolution(conn, params, blacklist_edges):
 
 
 #function for sliding window bait generation
-def baitSlidingWindow(conn, source, sequence, overlap, length):
-	generator = s.slidingWindowGenerator(sequence, overlap, length)
-	for window_seq in generator():
+def baitSlidingWindow(writer, source, sequence, overlap, length):
+	index = s.locusIndex(sequence)
+	for i, j in s.slidingWindow(sequence, overlap, length).windows().tolist():
 	#Don't need to do a bunch of filtering, because all was checked when TRs built
-	#print(window_seq)
-		if (len(window_seq[0]) == length):
-			n_mask = utils.n_lower_chars(window_seq[0])
-			n_gc = s.gc_counts(window_seq[0])
+		if (j - i == length):
+			n_mask = index.mask(i, j)
+			n_gc = index.gc(i, j)
 			#print("add")
-			m.add_bait_record(conn, source, window_seq[0], window_seq[1], window_seq[2], n_mask, n_gc)
+			writer.add_bait(source, sequence[i:j], i, j, n_mask, n_gc)
 
 #function for sliding window bait generation, with custom coordinates
-def baitSlidingWindowCoord(conn, source, sequence, overlap, length, start):
-	generator = s.slidingWindowGenerator(sequence, overlap, length)
-	for window_seq in generator():
+def baitSlidingWindowCoord(writer, source, sequence, overlap, length, start):
+	index = s.locusIndex(sequence)
+	for i, j in s.slidingWindow(sequence, overlap, length).windows().tolist():
 		#Don't need to do a bunch of filtering, because all was checked when TRs built
-		#print(window_seq)
-		if (len(window_seq[0]) == length):
-			start_coord = start + window_seq[1]
+		if (j - i == length):
+			start_coord = start + i
 			stop_coord = start_coord + length
-			n_mask = utils.n_lower_chars(window_seq[0])
-			n_gc = s.gc_counts(window_seq[0])
-			m.add_bait_record(conn, source, window_seq[0], start_coord, stop_coord, n_mask, n_gc)
+			n_mask = index.mask(i, j)
+			n_gc = index.gc(i, j)
+			writer.add_bait(source, sequence[i:j], start_coord, stop_coord, n_mask, n_gc)
 
 #Function to discover target regions
 def baitDiscovery(conn, params, targets):
+	writer = m.bufferedWriter(conn, params._batchSize)
+	baitDiscoveryTargets(writer, params, targets)
+	writer.flush()
+
+#Function to design baits for a DataFrame of targets (regid, sequence)
+#Baits are sent to writer (anything with add_bait, e.g. bufferedWriter)
+#params only needs select_b, select_b_num, blen, overlap, and bait_shift
+def baitDiscoveryTargets(writer, params, targets):
 	#print("Params.overlap is ", params.overlap)
 	#print("Params.bait_shift is", params.bait_shift)
 	#Design baits based on specified selection criterion (default is to tile at 2X)
@@ -932,7 +1086,7 @@ def baitDiscovery(conn, params, targets):
 		#looping through passedLoci only
 		for seq in targets.itertuples():
 			#seq[1] is the regid; seq[2] is the target sequence
-			baitSlidingWindow(conn, seq[1], seq[2], params.bait_shift, params.blen)
+			baitSlidingWindow(writer, seq[1], seq[2], params.bait_shift, params.blen)
 	elif params.select_b == 'center':
 		#print("Designing centered baits...")
 		#First calculate union length needed, if this is longer than target, just
@@ -944,7 +1098,7 @@ def baitDiscovery(conn, params, targets):
 			length = len(seq[2])
 			#If the target is too short, just do a full sliding window
 			if union >= length:
-				baitSlidingWindow(conn, seq[1], seq[2], params.bait_shift, params.blen)
+				baitSlidingWindow(writer, seq[1], seq[2], params.bait_shift, params.blen)
 			else:
 				center = len(seq[2]) // 2 #Divide by two and round down
 				start = center - (union // 2)
@@ -952,7 +1106,7 @@ def baitDiscovery(conn, params, targets):
 				#print("Starting at:",start," and stopping at:",stop)
 				subseq = (seq[2])[start:stop]
 				#print(subseq)
-				baitSlidingWindowCoord(conn, seq[1], subseq, params.bait_shift, params.blen, start)
+				baitSlidingWindowCoord(writer, seq[1], subseq, params.bait_shift, params.blen, start)
 	elif params.select_b == "calc":
 		#calculate the minimum target length to meet requirement
 		union = utils.calculateUnionLengthFixed(params.select_b_num, params.blen, params.overlap)
@@ -964,7 +1118,7 @@ def baitDiscovery(conn, params, targets):
 			#if target shorter than union length, tile whole thing
 			if length < union:
 				#print(length,"<",union,"- tiling all")
-				baitSlidingWindow(conn, seq[1], seq[2], params.bait_shift, params.blen)
+				baitSlidingWindow(writer, seq[1], seq[2], params.bait_shift, params.blen)
 			#otherwise if target is LONGER, calculate new overlap
 			else:
 				#bait_shift = how far to shift each starting point
@@ -974,7 +1128,7 @@ def baitDiscovery(conn, params, targets):
 				#print("old_shift",params.bait_shift)
 				#print("pas_shift",pad_shift)
 				#print("new_shift",new_shift)
-				baitSlidingWindow(conn, seq[1], seq[2], new_shift, params.blen)
+				baitSlidingWindow(writer, seq[1], seq[2], new_shift, params.blen)
 
 	elif params.select_b == "flank":
 		#First calculate union length needed, if this is longer than target, just
@@ -985,7 +1139,7 @@ def baitDiscovery(conn, params, targets):
 			length = len(seq[2])
 			#If the target is too short, just do a full sliding window
 			if union*2 >= length:
-				baitSlidingWindow(conn, seq[1], seq[2], params.bait_shift, params.blen)
+				baitSlidingWindow(writer, seq[1], seq[2], params.bait_shift, params.blen)
 			else:
 				#Need to: Substring both ends (start + union and stop - union)
 				subseq1 = (seq[2])[0:union] #right
@@ -993,9 +1147,9 @@ def baitDiscovery(conn, params, targets):
 				#print(subseq1)
 				#print(subseq2)
 				#Right side
-				baitSlidingWindowCoord(conn, seq[1], subseq1, params.bait_shift, params.blen, 0)
+				baitSlidingWindowCoord(writer, seq[1], subseq1, params.bait_shift, params.blen, 0)
 				#Left side
-				baitSlidingWindowCoord(conn, seq[1], subseq2, params.bait_shift, params.blen, length-union)
+				baitSlidingWindowCoord(writer, seq[1], subseq2, params.bait_shift, params.blen, length-union)
 	# elif params.select_b == "rand":
 	# 	#Here, union is the MINIMUM length required to make the specified number of baits with maximum overlap
 	# 	union = (utils.calculateUnionLengthFixed(params.select_b_num, params.blen, params.overlap))
@@ -1006,7 +1160,7 @@ def baitDiscovery(conn, params, targets):
 	# 		#If the target is too short, just do a full sliding window
 	# 		if union >= length:
 	# 			print("Too short, make all.")
-	# 			baitSlidingWindow(conn, seq[1], seq[2], params.overlap, params.blen)
+	# 			baitSlidingWindow(writer, seq[1], seq[2], params.overlap, params.blen)
 	# 		else:
 	# 			pass
 	# 			#While overlap is to high, generate and add/check another random substring until X passing are gathered.
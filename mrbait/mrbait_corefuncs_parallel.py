@@ -5,567 +5,530 @@ import getopt
 import Bio
 import os
 import time
-from Bio import AlignIO
+import types
 from mrbait import mrbait_menu
 from mrbait import substring
 from mrbait.substring import SubString
 from functools import partial
 from mrbait import manage_bait_db as m
+from mrbait import mrbait_corefuncs as core
 from mrbait import alignment_tools as a
 from mrbait import sequence_tools as s
 from mrbait import misc_utils as utils
 from mrbait import seq_graph as graph
 from mrbait import aln_file_tools
+from mrbait import parallel_tools
 from mrbait import vcf_tools
+from mrbait import compress_tools
 from mrbait import vsearch
 from mrbait import gff3_parser as gff
 from mrbait import blast as b
 import subprocess
 import pandas as pd
 import numpy as np
+import threading
 import multiprocessing
 
 """
 
 Parallel versions of some of the MrBait corefuncs.
 
-Much thanks to SO user 'dano' for 2014 post on how to share lock in multiprocessing pool:
+Workers only do computation, and send batches of rows through a queue to a single
+writer process (manage_bait_db.db_writer) which owns the database connection.
+
+Much thanks to SO user 'dano' for 2014 post on how to share lock in multiprocessing pool
+(the same approach is used to share the writer queue):
 https://stackoverflow.com/questions/25557686/python-sharing-a-lock-between-processes
 
 """
 
 #Function to load a GFF file into database
-def loadGFF_parallel(conn, params):
+def loadGFF_parallel(conn, params, pool):
 
 	t = int(params.threads)
 
 	#file chunker call
 	file_list = aln_file_tools.generic_chunker(params.gff, t, params.workdir)
 
-	#print("Files are:",file_list)
-	#Initialize multiprocessing pool
-	#if 'lock' not in globals():
-	lock = multiprocessing.Lock()
-	try:
-		with multiprocessing.Pool(t,initializer=init, initargs=(lock,)) as pool:
-			func = partial(loadGFF_worker, params.db, chunk)
-			results = pool.map(func, file_list)
-	except Exception as e:
-		pool.close()
-	pool.close()
-	pool.join()
+	#Run workers, with a single process writing to the database
+	#Workers look up locus IDs in memory, and only load records needed by --filter_r options
+	types, aliases = core.gffFilterSets(params)
+	func = partial(loadGFF_worker, params._batchSize, m.getChromLookup(conn), types, aliases)
+	dropped = run_with_writer(pool, params, func, file_list)
+	core.setGFFMeta(conn, types, aliases, sum(dropped))
 
-	#reset_lock()
 	#Remove chunkfiles
 	aln_file_tools.removeChunks(params.workdir)
 
+	#Check if all GFF records fall within bounds of
+	m.validateGFFRecords(conn)
+
 #worker function version of loadGFF
-def loadGFF_worker(db, chunk):
-	try:
-		connection = sqlite3.connect(db)
-
-		#For each GFF record in params.gff
-		for record in gff.read_gff(chunk):
-			#Skip any records that are missing the sequence ID, or coordinates
-			if record.seqid == "NULL" or record.start == "NULL" or record.end == "NULL":
-				continue
-			if record.start > record.end:
-				temp = record.start
-				record.start = record.end
-				record.end = temp
-			#Get the alias, if it exists
-			alias = ""
-			if record.getAlias(): #returns false if no alias
-				alias = record.getAlias()
-			else:
-				alias = "NULL"
-			#NOTE: This function ONLY inserts GFFRecords where record.seqid matches an existing locus in the loci table
-			lock.acquire()
-			m.add_gff_record(connection, record.seqid, record.type.lower(), record.start, record.end, alias)
-			lock.release()
-
-		connection.close()
-	except Exception as e:
-		raise Exception(e.message)
+#RETURNS: number of records not loaded (see gff3_parser.gffReader)
+def loadGFF_worker(params_batch, chrom_lookup, types, aliases, chunk):
+	reader = gff.gffReader(chunk, chrom_lookup, types, aliases)
+	rows = list()
+	for row in core.gffRecordValues(reader, chrom_lookup):
+		rows.append(row)
+		if len(rows) >= params_batch:
+			write_rows("gff", rows)
+			rows = list()
+	write_rows("gff", rows)
+	return(reader.dropped)
 
 #Function to load a GFF file into database
-def loadBED_parallel(conn, params):
+def loadBED_parallel(conn, params, pool):
 
 	t = int(params.threads)
 
 	#file chunker call
 	file_list = aln_file_tools.generic_chunker(params.bed, t, params.workdir)
 
-	#print("Files are:",file_list)
-	#Initialize multiprocessing pool
-	#if 'lock' not in globals():
-	lock = multiprocessing.Lock()
-	try:
-		with multiprocessing.Pool(t,initializer=init, initargs=(lock,)) as pool:
-			func = partial(loadBED_worker, params.db, params.bed_header)
-			results = pool.map(func, file_list)
-	except Exception as e:
-		pool.close()
-	pool.close()
-	pool.join()
+	#Run workers, with a single process writing to the database
+	#Workers look up locus IDs in memory. Header lines are only present in the first chunk
+	func = partial(loadBED_worker, params._batchSize, m.getChromLookup(conn), params.bed_header, file_list[0])
+	run_with_writer(pool, params, func, file_list)
 
-	#reset_lock()
 	#Remove chunkfiles
 	aln_file_tools.removeChunks(params.workdir)
 
-#worker function version of loadGFF
-def loadBED_worker(db, bed_header, chunk):
-	try:
-		connection = sqlite3.connect(db)
-
-		with open(chunk)as f:
-			count=0
-			for line in f:
-				line = line.strip()
-				if not line:
-					continue
-				count+=1
-				if count <= bed_header:
-					continue
-				content = line.split()
-
-				#NOTE: This function ONLY inserts BEDRecords where record.seqid matches an existing locus in the loci table
-				lock.acquire()
-				print(content)
-				m.add_bed_record(connection, content[0], content[1], content[2])
-				lock.release()
-		connection.close()
-	except Exception as e:
-		raise Exception(e.message)
-
-
-#Function to load BED file
-def loadBED(conn, params):
-
-	with open(params.bed)as f:
-		count=0
-		for line in f:
-			line = line.strip()
-			if not line:
-				continue
-			count+=1
-			if count <= params.bed_header:
-				continue
-			content = line.split()
-
-			#NOTE: This function ONLY inserts BEDRecords where record.seqid matches an existing locus in the loci table
-			m.add_bed_record(conn, content[0], content[1], content[2])
-
 	#remove BED records not falling within our loci
-	#print(m.getBED(conn))
 	m.validateBEDRecords(conn)
-	#print(m.getBED(conn))
+
+#worker function version of loadGFF
+def loadBED_worker(params_batch, chrom_lookup, bed_header, first_chunk, chunk):
+	rows = list()
+	header = bed_header if chunk == first_chunk else 0
+	for row in core.bedRecordValues(chunk, chrom_lookup, header):
+		rows.append(row)
+		if len(rows) >= params_batch:
+			write_rows("bed", rows)
+			rows = list()
+	write_rows("bed", rows)
+
+#Function to load a FASTA assembly into database in parallel
+def loadFASTA_parallel(conn, params, pool):
+
+	t = int(params.threads)
+	ref = core.openReference(params.assembly, params._alnIndex)
+	if ref is None:
+		#Index contig boundaries; workers read their own byte range of the file
+		offsets = aln_file_tools.index_alignment(params.assembly, "fasta", params._alnIndex)
+	else:
+		#Workers map the file and fetch their own contigs, balanced by sequence length
+		offsets = np.concatenate(([0], np.cumsum([entry[1] for entry in ref.entries], dtype=np.int64)))
+	numContigs = len(offsets) - 1
+	if numContigs < 10000:
+		print("\t\t\tReading",numContigs,"contigs.")
+	else:
+		print("\t\t\tReading",numContigs,"contigs... This may take a while.")
+	#Contigs get their record number as locus ID, so IDs follow file order as in loadFASTA
+	#(e.g. first of any duplicate headers is matched by GFF and BED records)
+	if ref is None:
+		chunk_list = aln_file_tools.index_ranges(offsets, t*params._tasksPerThread, params.assembly)
+		first_ids = np.searchsorted(offsets, [chunk[0] for chunk in chunk_list]) + 1
+		chunk_list = [(chunk[0], chunk[1], int(first)) for chunk, first in zip(chunk_list, first_ids)]
+		func = partial(loadFASTA_worker, params._batchSize, params.assembly)
+	else:
+		ranges = parallel_tools.split_balanced(offsets, t*params._tasksPerThread)
+		chunk_list = [(ref.entries[first:last], first+1) for first, last in ranges]
+		ref.close()
+		func = partial(loadFASTA_indexed_worker, params._batchSize, params.assembly)
+
+	#Run workers, with a single process writing to the database
+	run_with_writer(pool, params, func, chunk_list)
+
+#worker function version of loadFASTA
+#chunk is (start byte, end byte, ID of first contig)
+def loadFASTA_worker(params_batch, infile, chunk):
+	loadFASTA_rows(params_batch, aln_file_tools.read_fasta(infile, chunk[0], chunk[1]), chunk[2])
+
+#worker function version of loadFASTA, for an indexed FASTA or .2bit file
+#chunk is (index entries of contigs to load, ID of first contig)
+def loadFASTA_indexed_worker(params_batch, infile, chunk):
+	with aln_file_tools.open_reference(infile, entries=chunk[0]) as ref:
+		loadFASTA_rows(params_batch, aln_file_tools.read_fasta_indexed(ref), chunk[1])
+
+#Function to send contigs (with per-contig stats) to database writer, numbering them from first_id
+def loadFASTA_rows(params_batch, contigs, first_id):
+	rows = list()
+	for locid, contig in enumerate(contigs, first_id):
+		if not contig[1]:
+			continue
+		rows.append([locid] + m.locus_record_values(1, contig[1], 1, contig[0]))
+		if len(rows) >= params_batch:
+			write_rows("loci_id", rows)
+			rows = list()
+	write_rows("loci_id", rows)
 
 #Function to load a XMFA file into database
-def loadXMFA_parallel(conn, params):
+def loadXMFA_parallel(conn, params, pool):
 
 	t = int(params.threads)
-	numLoci = aln_file_tools.countXMFA(params.xmfa)
+	#Index alignment boundaries; workers read their own byte range of the file
+	offsets = aln_file_tools.index_alignment(params.xmfa, "xmfa", params._alnIndex)
+	numLoci = len(offsets) - 1
 	if numLoci < 10000:
 		print("\t\t\tReading",numLoci,"alignments.")
 	else:
 		print("\t\t\tReading",numLoci,"alignments... This may take a while.")
+	chunk_list = aln_file_tools.index_ranges(offsets, t*params._tasksPerThread, params.xmfa)
 
-	#file chunker call
-	file_list = aln_file_tools.xmfa_chunker(params.xmfa, t, params.workdir)
-
-	#print("Files are:",file_list)
-	#Initialize multiprocessing pool
-	#if 'lock' not in globals():
-	lock = multiprocessing.Lock()
-	try:
-		with multiprocessing.Pool(t,initializer=init, initargs=(lock,)) as pool:
-			func = partial(loadXMFA_worker, params.db, params.cov, params.minlen, params.thresh, params.mask, params.maf)
-			results = pool.map(func, file_list)
-	except Exception as e:
-		pool.close()
-	pool.close()
-	pool.join()
-
-	#reset_lock()
-	#Remove chunkfiles
-	aln_file_tools.removeChunks(params.workdir)
+	#Run workers, with a single process writing to the database
+	func = partial(loadXMFA_worker, params.cov, params.minlen, params.thresh, params.mask, params.maf, params._batchSize, params.xmfa)
+	run_with_writer(pool, params, func, chunk_list)
 
 #worker function version of loadMAF
-def loadXMFA_worker(db, params_cov, params_minlen, params_thresh, params_mask, params_maf, chunk):
-	try:
-		connection = sqlite3.connect(db)
-		#Parse MAF file and create database
-		for aln in AlignIO.parse(chunk, "mauve"):
-			#NOTE: Add error handling, return error code
-			cov = len(aln)
-			alen = aln.get_alignment_length()
-
-			if cov < params_cov or alen < params_minlen:
-				continue
-			#Add each locus to database
-			locus = a.consensAlign(aln, threshold=params_thresh, mask=params_mask, maf=params_maf)
-			lock.acquire()
-			locid = m.add_locus_record(connection, cov, locus.conSequence, 1, "NULL")
-			lock.release()
-		connection.close()
-	except Exception as e:
-		raise Exception(e.message)
-
+def loadXMFA_worker(params_cov, params_minlen, params_thresh, params_mask, params_maf, params_batch, infile, chunk):
+	rows = list()
+	#Parse XMFA file and send loci to database writer
+	for aln in aln_file_tools.read_xmfa(infile, chunk[0], chunk[1]):
+		#NOTE: Add error handling, return error code
+		cov = len(aln)
+		alen = aln.get_alignment_length()
+
+		if cov < params_cov or alen < params_minlen:
+			continue
+		#Add each locus to database
+		consensus = a.make_consensus_array(aln.seqs, threshold=params_thresh, mask=params_mask, maf=params_maf)
+		rows.append(m.locus_record_values(cov, consensus, 1, "NULL"))
+		if len(rows) >= params_batch:
+			write_rows("loci", rows)
+			rows = list()
+	write_rows("loci", rows)
 
 #Function to load LOCI file in parallel
-def loadLOCI_parallel(conn, params):
+def loadLOCI_parallel(conn, params, pool):
 	"""
 	Format:
 	multiprocessing pool.
 	Master:
-		splits file into n chunks
+		indexes file and splits it into byte ranges of similar size
 		creates multiprocessing pool
 	Workers:
-		read file chunk
+		read byte range of file
 		calculate consensus
-		grab lock
+		send batches of rows to writer process
+	Writer:
 		INSERT data to SQL database
-		release lock
 	"""
 	t = int(params.threads)
 
-	numLoci = aln_file_tools.countLoci(params.loci)
+	#Index alignment boundaries; workers read their own byte range of the file
+	offsets = aln_file_tools.index_alignment(params.loci, "loci", params._alnIndex)
+	numLoci = len(offsets) - 1
 	if numLoci < 10000:
 		print("\t\t\tReading",numLoci,"alignments.")
 	else:
 		print("\t\t\tReading",numLoci,"alignments... This may take a while.")
+	chunk_list = aln_file_tools.index_ranges(offsets, t*params._tasksPerThread, params.loci)
 
-	#file chunker call
-	file_list = aln_file_tools.loci_chunker(params.loci, t, params.workdir)
-
-	#print("Files are:",file_list)
-	#Initialize multiprocessing pool
-	#if 'lock' not in globals():
-	lock = multiprocessing.Lock()
-	try:
-		with multiprocessing.Pool(t,initializer=init, initargs=(lock,)) as pool:
-			func = partial(loadLOCI_worker, params.db, params.cov, params.minlen, params.thresh, params.mask, params.maf)
-			results = pool.map(func, file_list)
-	except Exception as e:
-		pool.close()
-	pool.close()
-	pool.join()
-
-	#reset_lock()
-	#Remove chunkfiles
-	aln_file_tools.removeChunks(params.workdir)
+	#Run workers, with a single process writing to the database
+	func = partial(loadLOCI_worker, params.cov, params.minlen, params.thresh, params.mask, params.maf, params._batchSize, params.loci)
+	run_with_writer(pool, params, func, chunk_list)
 
 #Function to load MAF file in parallel
-def loadMAF_parallel(conn, params):
+def loadMAF_parallel(conn, params, pool):
 
 	t = int(params.threads)
-	numLoci = aln_file_tools.countMAF(params.alignment)
+	#Index alignment boundaries; workers read their own byte range of the file
+	offsets = aln_file_tools.index_alignment(params.alignment, "maf", params._alnIndex)
+	numLoci = len(offsets) - 1
 	if numLoci < 10000:
 		print("\t\t\tReading",numLoci,"alignments.")
 	else:
 		print("\t\t\tReading",numLoci,"alignments... This may take a while.")
+	chunk_list = aln_file_tools.index_ranges(offsets, t*params._tasksPerThread, params.alignment)
 
-	#file chunker call
-	file_list = aln_file_tools.maf_chunker(params.alignment, t, params.workdir)
+	#Run workers, with a single process writing to the database
+	func = partial(loadMAF_worker, params.cov, params.minlen, params.thresh, params.mask, params.maf, params._batchSize, params.alignment)
+	run_with_writer(pool, params, func, chunk_list)
 
-	#print("Files are:",file_list)
-	#Initialize multiprocessing pool
-	#if 'lock' not in globals():
-	lock = multiprocessing.Lock()
-	try:
-		with multiprocessing.Pool(t,initializer=init, initargs=(lock,)) as pool:
-			func = partial(loadMAF_worker, params.db, params.cov, params.minlen, params.thresh, params.mask, params.maf)
-			results = pool.map(func, file_list)
-	except Exception as e:
+#Function to load VCF variants file, patching contigs in parallel
+#Records are indexed by contig, and each task patches whole contigs, balanced by size of their records
+def loadVCF_parallel(conn, params, pool):
+
+	t = int(params.threads)
+	if not compress_tools.is_splittable(params.vcf):
+		print("\t\t\tWarning: %s is gzip compressed, so it is read by a single worker (compress it with bgzip to read it in parallel)."%params.vcf)
+		core.loadVCF(conn, params)
+		return
+
+	loci = m.getPassedLociNames(conn) #get DF of passed loci, without sequences
+	chrom_lookup = loci.set_index('chrom')['id'].to_dict()
+	samples, tasks, virtual = core.indexVCF(params.vcf, chrom_lookup)
+	if not tasks:
+		core.printPatched(dict())
+		return
+
+	#Workers fetch sequences from the indexed assembly, if possible
+	ref = core.openUniqueReference(params.assembly, params._alnIndex)
+	entries = dict()
+	if ref is not None:
+		entries = {entry[0] : entry for entry in ref.entries}
+		ref.close()
+
+	sizes = [sum([end - start for start, end in task[2]]) for task in tasks]
+	offsets = np.concatenate(([0], np.cumsum(sizes, dtype=np.int64)))
+	chunk_list = list()
+	for first, last in parallel_tools.split_balanced(offsets, t*params._tasksPerThread):
+		chunk = tasks[first:last]
+		chunk_list.append((chunk, [entries[task[0]] for task in chunk if task[0] in entries]))
+
+	#Run workers, with a single process writing to the database
+	func = partial(loadVCF_worker, params.thresh, params.vcfALT, params._batchSize, params.vcf, params.assembly, samples, virtual)
+	results = run_with_writer(pool, params, func, chunk_list)
+
+	patched = dict()
+	for result in results:
+		patched.update(result)
+	core.printPatched(patched)
+
+#Function to start the pool of workers shared by all parallel steps (see mrbait.main)
+#Workers are started once, with the heavy imports done, a queue to the database
+#writer, and the database path for their own read-only connections (see worker_connection)
+#Backend is chosen by --hacker executor=
+def start_pool(params):
+	t = int(params.threads)
+	q = multiprocessing.Queue(maxsize=4*t)
+	#The main process also needs the queue, to start writers and for serial backend
+	init(q, params.db)
+	return(parallel_tools.taskExecutor(params._executor, t, initializer=init, initargs=(q, params.db)))
+
+#Function to shut down the shared pool of workers
+def stop_pool(pool):
+	if pool is not None:
 		pool.close()
-	pool.close()
-	pool.join()
 
-	#reset_lock()
-	#Remove chunkfiles
-	aln_file_tools.removeChunks(params.workdir)
+#Function to run func over items (tasks) using the shared pool of workers
+#Tasks are handed out one at a time to whichever worker is free
+#Workers send rows to a database writer process, started for each call, through a queue (see write_rows)
+def run_with_writer(pool, params, func, items):
+	writer = multiprocessing.Process(target=m.db_writer, args=(params.db, writer_queue, params._commitSize, len(items)))
+	writer.start()
+	try:
+		results = pool.map(partial(run_task, func), items)
+		print("\t\t\tWorkers:", pool.timing_report())
+	except BaseException:
+		#Stop remaining tasks (the writer keeps draining the queue until thread workers
+		#have finished theirs), then stop the writer. It isn't told through the queue,
+		#which killed worker processes can leave locked
+		pool.terminate()
+		writer.terminate()
+		raise
+	finally:
+		writer.join()
+	if writer.exitcode != 0:
+		sys.exit("ERROR: Database writer process failed (exit code %s)"%writer.exitcode)
+	return(results)
+
+#Function to run a task in a worker, then tell the database writer it is finished
+#Rows sent by a worker arrive in order, so the writer has all of them when it gets the marker
+def run_task(func, task):
+	try:
+		return(func(task))
+	finally:
+		writer_queue.put((None, None))
 
-# #first chunking, then arsing in parallel
-# def loadVCF_parallel(conn, params):
-# 	t = int(params.threads)
-# 	#file chunker call
-# 	file_list = vcf_tools.vcf_chunker(params.vcf, t, params.workdir)
-#
-# 	print("Files are:",file_list)
-# 	#Initialize multiprocessing pool
-# 	#if 'lock' not in globals():
-# 	lock = multiprocessing.Lock()
-# 	try:
-# 		with multiprocessing.Pool(t,initializer=init, initargs=(lock,)) as pool:
-# 			func = partial(loadVCF_worker, params.db, params.thresh)
-# 			results = pool.map(func, file_list)
-# 	except Exception as e:
-# 		pool.close()
-# 	pool.close()
-# 	pool.join()
-#
-# 	#reset_lock()
-# 	#Remove chunkfiles
-# 	#aln_file_tools.removeChunks(params.workdir)
-
-
-#INitialize a global lock. Doing it this way allows it to be inherited by the child processes properly
+#Initialize a global writer queue. Doing it this way allows it to be inherited by the child processes properly
 #Found on StackOverflow: https://stackoverflow.com/questions/25557686/python-sharing-a-lock-between-processes
 #Thanks go to SO user dano
-def init(l):
-	global lock
-	lock = l
-
-#Function to reset lock
-def reset_lock():
-	global lock
-	del lock
+def init(q, db):
+	global writer_queue, worker_db
+	writer_queue = q
+	worker_db = db
+
+#Per-thread worker state (database connection)
+worker_state = threading.local()
+
+#Function to get this worker's read-only database connection, opened on first use
+def worker_connection():
+	if getattr(worker_state, "conn", None) is None:
+		worker_state.conn = m.create_readonly_connection(worker_db)
+	return(worker_state.conn)
+
+#Function to send a batch of rows for table to the database writer process
+def write_rows(table, rows):
+	if rows:
+		writer_queue.put((table, rows))
+
+#Object with the add_bait interface of manage_bait_db.bufferedWriter,
+#which sends batches of rows to the database writer process
+class queueWriter():
+	'Buffers bait rows in a worker and sends them to the database writer in batches'
+	#Default constructor
+	def __init__(self, batch_size=500):
+		self.batch_size = batch_size
+		self.rows = list()
+
+	def add_bait(self, reg, seq, start, stop, mask, gc):
+		self.rows.append(m.bait_record_values(reg, seq, start, stop, mask, gc))
+		if len(self.rows) >= self.batch_size:
+			self.flush()
+
+	def flush(self):
+		write_rows("baits", self.rows)
+		self.rows = list()
 
 #NOTE: 'params' object can't be pickled, so I have to do it this way.
 #worker function version of loadMAF
-def loadMAF_worker(db, params_cov, params_minlen, params_thresh, params_mask, params_maf, chunk):
-	try:
-		connection = sqlite3.connect(db)
-		#Parse MAF file and create database
-		for aln in AlignIO.parse(chunk, "maf"):
-			#NOTE: Add error handling, return error code
-			cov = len(aln)
-			alen = aln.get_alignment_length()
-
-			if cov < params_cov or alen < params_minlen:
-				continue
-			#Add each locus to database
-			locus = a.consensAlign(aln, threshold=params_thresh, mask=params_mask, maf=params_maf)
-			lock.acquire()
-			locid = m.add_locus_record(connection, cov, locus.conSequence, 1, "NULL")
-			#print(locid)
-			lock.release()
-			#Extract variable positions for database
-			#for var in locus.alnVars:
-				#m.add_variant_record(connection, locid, var.position, var.value)
-		connection.close()
-	except Exception as e:
-		raise Exception(e.message)
-
-# #Function to load VCF variants file
-# def loadVCF_worker(db, threshold, chunk):
-# 	try:
-# 		#Each worker opens unique connection to db
-# 		connection = sqlite3.connect(db)
-# 		#Lock DB and read loci, then release lock
-# 		lock.acquire()
-# 		loci = m.getPassedLoci(connection) #get DF of passed loci
-# 		lock.release()
-#
-# 		chrom_lookup = loci.set_index('chrom')['id'].to_dict()
-# 		loci.set_index('id', inplace=True)
-#
-# 		passed=0 #To track number of VCF records for which no locus exists
-# 		failed=0
-# 		for reclist in vcf_tools.read_vcf(chunk):
-# 			rec_chrom = reclist[0].CHROM
-# 			if rec_chrom in chrom_lookup:
-# 				locid = chrom_lookup[rec_chrom]
-# 				passed+=1
-# 				#Grab DF record for the matching CHROM
-# 				seq = loci.loc[locid,'consensus']
-# 				#Get new consensus sequence given VCF records
-# 				new_cons = vcf_tools.make_consensus_from_vcf(seq,rec_chrom,reclist, threshold)
-# 				print(new_cons)
-# 				#Update new consensus seq in db
-# 				if len(new_cons) != len(seq): #Check length first
-# 					print("\t\t\tWarning: New consensus sequence for locus %s (locid=<%s>) is the wrong length! Skipping."%(rec_chrom, locid))
-# 				else:
-# 					#Lock database for update, then relase lock
-# 					lock.acquire()
-# 					m.updateConsensus(connection, locid, new_cons)
-# 					lock.release()
-# 			else:
-# 				failed+=1
-# 		if failed > 0:
-# 			print("\t\t\tWARNING:%s/%s records in <%s> don't match any reference sequences"%(failed, failed+passed, chunk))
-# 		#close connection
-# 		connection.close()
-# 	except Exception as e:
-# 		raise Exception(e.message)
+def loadMAF_worker(params_cov, params_minlen, params_thresh, params_mask, params_maf, params_batch, infile, chunk):
+	rows = list()
+	#Parse MAF file and send loci to database writer
+	for aln in aln_file_tools.read_maf(infile, chunk[0], chunk[1]):
+		#NOTE: Add error handling, return error code
+		cov = len(aln)
+		alen = aln.get_alignment_length()
+
+		if cov < params_cov or alen < params_minlen:
+			continue
+		#Add each locus to database
+		consensus = a.make_consensus_array(aln.seqs, threshold=params_thresh, mask=params_mask, maf=params_maf)
+		rows.append(m.locus_record_values(cov, consensus, 1, "NULL"))
+		if len(rows) >= params_batch:
+			write_rows("loci", rows)
+			rows = list()
+	write_rows("loci", rows)
+
+#worker function version of loadVCF
+#chunk is (list of (chrom, locus ID, byte ranges of its records), assembly index entries for those contigs)
+#RETURNS: dict of number of positions changed per contig
+def loadVCF_worker(params_thresh, params_vcfALT, params_batch, vcf, assembly, samples, virtual, chunk):
+	tasks, entries = chunk
+	ref = aln_file_tools.open_reference(assembly, entries=entries) if entries else None
+	patched = dict()
+	rows = list()
+	for chrom, locid, seq, changed in core.patchContigs(worker_connection(), vcf, tasks, ref, samples, virtual, params_thresh, params_vcfALT):
+		patched[chrom] = changed
+		if changed:
+			rows.append((seq.decode(), locid))
+		if len(rows) >= params_batch:
+			write_rows("consensus", rows)
+			rows = list()
+	write_rows("consensus", rows)
+	if ref is not None:
+		ref.close()
+	return(patched)
 
 #Worker function for loadLOCI_parallel
-def loadLOCI_worker(db, params_cov, params_minlen, params_thresh, params_mask, params_maf, chunk):
-	try:
-		connection = sqlite3.connect(db)
-		#Parse LOCI file and create database
-		for aln in aln_file_tools.read_loci(chunk):
-			#NOTE: Add error handling, return error code
-			cov = len(aln)
-			alen = aln.get_alignment_length()
-
-			#Skip if coverage or alignment length too short
-			if cov < params_cov or alen < params_minlen:
-				#print("Locus skipped")
-				continue
-			else:
-				#Add each locus to database
-				locus = a.consensAlign(aln, threshold=params_thresh, mask=params_mask, maf=params_maf)
-
-				#Acquire lock, submit to Database
-				lock.acquire()
-				locid = m.add_locus_record(connection, cov, locus.conSequence, 1, "NULL")
-				lock.release()
-				#print("Loading Locus #:",locid)
-
-				#Extract variable positions for database
-				#for var in locus.alnVars:
-					#m.add_variant_record(connection, locid, var.position, var.value)
-		connection.close()
-	except Exception as e:
-		raise Exception(e.message)
+def loadLOCI_worker(params_cov, params_minlen, params_thresh, params_mask, params_maf, params_batch, infile, chunk):
+	#Parse LOCI file and send loci to database writer
+	batch = list()
+	for aln in aln_file_tools.read_loci(infile, chunk[0], chunk[1]):
+		#NOTE: Add error handling, return error code
+		cov = len(aln)
+		alen = aln.get_alignment_length()
+
+		#Skip if coverage or alignment length too short
+		if cov < params_cov or alen < params_minlen:
+			#print("Locus skipped")
+			continue
+		else:
+			batch.append(aln.seqs)
+			if len(batch) >= params_batch:
+				loadLOCI_batch(batch, params_thresh, params_mask, params_maf)
+				batch = list()
+	if batch:
+		loadLOCI_batch(batch, params_thresh, params_mask, params_maf)
+
+#Function to call consensus for a batch of alignments and submit them to database writer
+def loadLOCI_batch(batch, params_thresh, params_mask, params_maf):
+	consensus = a.make_consensus_batch(batch, threshold=params_thresh, mask=params_mask, maf=params_maf)
+	write_rows("loci", [m.locus_record_values(aln.shape[0], cons, 1, "NULL") for aln, cons in zip(batch, consensus)])
 
 #Function to discover target regions using a sliding windows through passedLoci
-def targetDiscoverySlidingWindow_parallel(conn, params, loci):
+def targetDiscoverySlidingWindow_parallel(conn, params, pool):
 	"""
 	Format:
-	1. Write pandas DF to n chunk files
-	2. List of chunk file names
-	3. Pass 1 chunk file to each worker in a multiprocessing pool.
+	1. Split passing loci into (min_id, max_id) ranges of similar total length
+	2. Hand ranges out to workers as they become free
+	3. Renumber targets in serial order
 	Master:
-		creates n chunk files
+		gets ranges of locus ids
 		creates multiprocessing pool
 	Workers:
-		read file chunk
-		calculate consensus
-		grab lock
+		read loci in range from database (own read-only connection)
+		find target regions
+		send batches of rows to writer process
+	Writer:
 		INSERT data to SQL database
-		release lock
 	"""
 	t = int(params.threads)
-	chunk = 1
-	loci_num = int(loci.shape[0])
-	#print("number of loci:",loci_num)
-	#print("number of threads:",t)
-	chunks = 0
-	if loci_num < t:
-		chunks = loci_num
-	else:
-		chunks = t
-	chunk_size = loci_num // chunks
-	remainder = loci_num % chunks
-	#print("Chunk size is:",chunk_size)
-	#print("remainder is:",remainder)
-
-	start = 0
-	stop = 0
-
-	files = list()
-	#Split loci DataFrame into chunks, and keep list of chunk files
-	for df_chunk in np.array_split(loci, chunks):
-		size = df_chunk.shape[0]
-		#print("size of chunk",chunk,"is:",size)
-		chunk_file = params.workdir + "/." + str(chunk) + ".chunk"
-		#print(df_chunk)
-		df_chunk.to_csv(chunk_file, mode="w", index=False)
-		files.append(chunk_file)
-		chunk += 1
-
-	#Initialize multiprocessing pool
-	#if 'lock' not in globals():
-	lock = multiprocessing.Lock()
-	with multiprocessing.Pool(t,initializer=init, initargs=(lock,)) as pool:
-		func = partial(targetDiscoverySlidingWindow_worker, params.db, params.win_shift, params.win_width, params.var_max, params.numN, params.numG, params.blen, params.flank_dist, params.target_all)
-		results = pool.map(func, files)
-	pool.close()
-	pool.join()
-
-	#reset_lock()
-	#Remove chunkfiles
-	d = os.listdir(params.workdir)
-	for item in d:
-		if item.endswith(".chunk"):
-			os.remove(os.path.join(params.workdir, item))
+	ranges = m.getPassedLociRanges(conn, t*params._tasksPerThread)
+
+	#Run workers, with a single process writing to the database
+	func = partial(targetDiscoverySlidingWindow_worker, params.win_shift, params.win_width, params.var_max, params.numN, params.numG, params.blen, params.flank_dist, params.target_all, params._batchSize)
+	run_with_writer(pool, params, func, ranges)
+	#Number targets as a serial run does, rather than in the order workers finished
+	m.renumberRows(conn, "regions", "locid")
 
 
 #Function to discover target regions using a sliding windows through passedLoci
-def targetDiscoverySlidingWindow_worker(db, shift, width, var, n, g, blen, flank_dist, target_all, chunk):
-	connection = sqlite3.connect(db)
-	#print("process: reading hdf from",chunk)
-	loci = pd.read_csv(chunk)
-	#print(loci)
-	for seq in loci.itertuples():
-		#print(seq)
-		start = 0
-		stop = 0
+def targetDiscoverySlidingWindow_worker(shift, width, var, n, g, blen, flank_dist, target_all, params_batch, id_range):
+	rows = list()
+	for locid, consensus, chrom in m.iterPassedLoci(worker_connection(), id_range[0], id_range[1]):
 		if target_all:
 			#print("target_all")
 			#submit full locus as target
-			seq_norm = s.simplifySeq(seq[2])
-			counts = s.seqCounterSimple(seq_norm)
+			index = s.locusIndex(consensus)
+			counts = index.simple_counts(0, len(index))
 			if counts['*'] <= var and counts['N'] <= n and counts['-'] <= g:
-				target = seq[2]
-				tr_counts = s.seqCounterSimple(seq_norm)
-				n_mask = utils.n_lower_chars(seq[2])
-				n_gc = s.gc_counts(seq[2])
+				target = consensus
+				tr_counts = counts
+				n_mask = index.mask(0, len(index))
+				n_gc = index.gc(0, len(index))
 				#NOTE: flank count set to number of variable sites in whole locus
-				#print(int(seq[1]), 0, len(seq[2]), seq[2], tr_counts, tr_counts, n_mask, n_gc)
-				lock.acquire()
-				m.add_region_record(connection, int(seq[1]), 0, len(seq[2]), seq[2], tr_counts, tr_counts, n_mask, n_gc)
-				lock.release()
+				#print(locid, 0, len(consensus), consensus, tr_counts, tr_counts, n_mask, n_gc)
+				rows.append(m.region_record_values(locid, 0, len(consensus), consensus, tr_counts, tr_counts, n_mask, n_gc))
 		else:
-			#print("\nConsensus: ", seq[2], "ID is: ", seq[1], "\n")
-			generator = s.slidingWindowGenerator(seq[2], shift, width)
-			for window_seq in generator():
-
-				seq_norm = s.simplifySeq(window_seq[0])
-				counts = s.seqCounterSimple(seq_norm)
-
-				#If window passes filters, extend current bait region
-				#print("Start is ", start, " and stop is ",stop) #debug print
-				if counts['*'] <= var and counts['N'] <= n and counts['-'] <= g:
-					stop = window_seq[2]
-					#if this window passes BUT is the last window, evaluate it
-					if stop == len(seq[2]):
-						#print("last window")
-						if (stop - start) >= blen:
-							target = (seq[2])[start:stop]
-							tr_counts = s.seqCounterSimple(s.simplifySeq(target))
-							#print("candidate:",window_seq[0])
-							n_mask = utils.n_lower_chars(target)
-							n_gc = s.gc_counts(target)
-							#Check that there aren't too many SNPs
-							#if tr_counts["*"] <= params.vmax_r:
-							#print("	Target region: ", target)
-							#Submit target region to database
-							#print("process: grabbing lock")'
-							flank_counts = s.getFlankCounts(seq[2], start, stop, flank_dist)
-							lock.acquire()
-							m.add_region_record(connection, int(seq[1]), start, stop, target, tr_counts, flank_counts, n_mask, n_gc)
-							#print("process: releasing lock")
-							lock.release()
-							#set start of next window to end of current TR
-							generator.setI(stop)
-				else:
-					#If window fails, check if previous bait region passes to submit to DB
-					#print (stop-start)
-					if (stop - start) >= blen:
-						target = (seq[2])[start:stop]
-						tr_counts = s.seqCounterSimple(s.simplifySeq(target))
-						n_mask = utils.n_lower_chars(target)
-						n_gc = s.gc_counts(target)
-						#Check that there aren't too many SNPs
-						#if tr_counts["*"] <= params.vmax_r:
-						#print("	Target region: ", target)
-						#Submit target region to database
-						#print("process: grabbing lock")'
-						flank_counts = s.getFlankCounts(seq[2], start, stop, flank_dist)
-						lock.acquire()
-						m.add_region_record(connection, int(seq[1]), start, stop, target, tr_counts, flank_counts, n_mask, n_gc)
-						#print("process: releasing lock")
-						lock.release()
-						#set start of next window to end of current TR
-						generator.setI(stop)
-
-					#If bait fails, set start to start point of next window
-					start = generator.getI()+shift
-	connection.close()
+			#print("\nConsensus: ", consensus, "ID is: ", locid, "\n")
+			#Find all target regions at once, from windowed counts of vars, Ns, and gaps
+			#All target and flank counts are taken from the same prefix-sum index
+			index = s.locusIndex(consensus)
+			for start, stop in s.slidingWindowTargets(index, shift, width, var, n, g, blen):
+				target = (consensus)[start:stop]
+				tr_counts = index.simple_counts(start, stop)
+				n_mask = index.mask(start, stop)
+				n_gc = index.gc(start, stop)
+				#Submit target region to database
+				flank_counts = index.flank_counts(start, stop, flank_dist)
+				rows.append(m.region_record_values(locid, start, stop, target, tr_counts, flank_counts, n_mask, n_gc))
+		#Send finished rows to database writer
+		if len(rows) >= params_batch:
+			write_rows("regions", rows)
+			rows = list()
+	write_rows("regions", rows)
+
+
+#Function to design baits for passing targets in parallel
+def baitDiscovery_parallel(conn, params, pool):
+	"""
+	Format:
+	1. Split passing targets into (min_id, max_id) ranges of similar total length
+	2. Hand ranges out to workers as they become free
+	3. Renumber baits in serial order
+	Workers:
+		read targets in range from database (own read-only connection)
+		design baits
+		send batches of rows to writer process
+	Writer:
+		INSERT data to SQL database
+	"""
+	t = int(params.threads)
+	ranges = m.getPassedTRRanges(conn, t*params._tasksPerThread)
+	#params can't be pickled, so workers only get the bait design options
+	bait_params = types.SimpleNamespace(select_b=params.select_b, select_b_num=params.select_b_num, blen=params.blen, overlap=params.overlap, bait_shift=params.bait_shift)
+	func = partial(baitDiscovery_worker, bait_params, params._batchSize)
+	run_with_writer(pool, params, func, ranges)
+	#Number baits as a serial run does, rather than in the order workers finished
+	m.renumberRows(conn, "baits", "regid")
+
+#Function to design baits for a range of passing targets
+def baitDiscovery_worker(bait_params, params_batch, id_range):
+	targets = pd.DataFrame(list(m.iterPassedTRs(worker_connection(), id_range[0], id_range[1])), columns=["regid", "sequence"])
+	writer = queueWriter(params_batch)
+	core.baitDiscoveryTargets(writer, bait_params, targets)
+	writer.flush()
 
 
 #Function to get DataFrame of targets + flank regions, and calculate some stuff
@@ -76,7 +76,7 @@ Input options:
 
 	-M,--maf	: Input multiple alignment MAF file
 	-L,--loci	: For RAD-data, as the \".loci\" output of pyRAD
-	-A,--assembly	: Input whole genome assembly as FASTA
+	-A,--assembly	: Input whole genome assembly as FASTA or UCSC .2bit
 	-X,--xmfa	: Input whole genome alignments as XMFA""")
 	print("""
 Assembly input options (for use only with -A <genome.fasta>):
@@ -375,6 +375,11 @@ class parseArgs():
 		self._weightMax = 50000 #maximum size to attempt weighted edge resolution
 		self._weightByMin = False
 		self._os = None
+		self._batchSize = 500 #number of alignments per consensus/insert batch
+		self._alnIndex = False #save alignment byte-offset (.mbi) and FASTA (.fai) indexes next to input file
+		self._commitSize = 10000 #rows per transaction for database writer
+		self._executor = "process" #backend for parallel steps: process, thread, or serial
+		self._tasksPerThread = 8 #number of tasks per thread that parallel work is split into
 
 
 
@@ -659,6 +664,22 @@ class parseArgs():
 					self._noWeightGraph = 1
 				elif main == "weightByMin":
 					self._weightByMin = 1
+				elif main == "batch_size":
+					assert len(subopts) == 2, "Warning: HACKER option <batch_size> must have two arguments separated by \"=\""
+					self._batchSize = int(subopts[1])
+				elif main == "commit_size":
+					assert len(subopts) == 2, "Warning: HACKER option <commit_size> must have two arguments separated by \"=\""
+					self._commitSize = int(subopts[1])
+				elif main == "aln_index":
+					self._alnIndex = True
+				elif main == "executor":
+					assert len(subopts) == 2, "Warning: HACKER option <executor> must have two arguments separated by \"=\""
+					assert subopts[1] in ("process", "thread", "serial"), "Unrecognized option %s for <--hacker executor=>"%subopts[1]
+					self._executor = subopts[1]
+				elif main == "tasks_per_thread":
+					assert len(subopts) == 2, "Warning: HACKER option <tasks_per_thread> must have two arguments separated by \"=\""
+					self._tasksPerThread = int(subopts[1])
+					assert self._tasksPerThread >= 1, "<tasks_per_thread> must be at least 1"
 				elif main == "bed_header":
 					self.bed_header=int(subopts[1])
 				elif main == "weightMax":
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+
+import time
+import multiprocessing
+import multiprocessing.pool
+from functools import partial
+import numpy as np
+
+"""
+
+Scheduling and execution helpers shared by the parallel MrBait steps.
+
+Work is cut into many small tasks of similar size (see split_balanced), which
+are handed out one at a time to whichever worker is free (imap_unordered), so a
+single large task doesn't decide the wall time of a step.
+
+"""
+
+#Supported taskExecutor backends
+BACKENDS = ("process", "thread", "serial")
+
+#Object to run a function over a list of tasks with process, thread, or serial workers
+class taskExecutor():
+	'Runs tasks on a process, thread, or serial backend and records per-task timings'
+	#Default constructor
+	#initializer(*initargs) is called once in each worker (once in this process if serial)
+	def __init__(self, backend="process", workers=1, initializer=None, initargs=()):
+		if backend not in BACKENDS:
+			raise ValueError("Unknown executor backend <%s>: must be one of %s"%(backend, ", ".join(BACKENDS)))
+		self.backend = backend
+		self.workers = max(1, int(workers))
+		self.timings = list()
+		self.pool = None
+		if backend == "process":
+			self.pool = multiprocessing.Pool(self.workers, initializer=initializer, initargs=initargs)
+		elif backend == "thread":
+			self.pool = multiprocessing.pool.ThreadPool(self.workers, initializer=initializer, initargs=initargs)
+		else:
+			self.workers = 1
+			if initializer is not None:
+				initializer(*initargs)
+
+	def __enter__(self):
+		return(self)
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.close()
+		else:
+			self.terminate()
+		return(False)
+
+	#Generator yielding func(task) for each task, in order of completion
+	#Timings of each task are kept in self.timings as (task number, seconds)
+	def map_unordered(self, func, tasks):
+		self.timings = list()
+		timed = partial(_timed_task, func)
+		if self.pool is None:
+			results = map(timed, enumerate(tasks))
+		else:
+			results = self.pool.imap_unordered(timed, enumerate(tasks), chunksize=1)
+		for i, seconds, result in results:
+			self.timings.append((i, seconds))
+			yield(result)
+
+	#Returns list of results of func(task), in order of completion
+	def map(self, func, tasks):
+		return(list(self.map_unordered(func, tasks)))
+
+	#Wait for workers to finish and exit
+	def close(self):
+		if self.pool is not None:
+			self.pool.close()
+			self.pool.join()
+			self.pool = None
+
+	#Stop workers immediately
+	def terminate(self):
+		if self.pool is not None:
+			self.pool.terminate()
+			self.pool.join()
+			self.pool = None
+
+	#Returns a one-line summary of the task timings from the last map
+	def timing_report(self):
+		if not self.timings:
+			return("No tasks run.")
+		seconds = np.array([t[1] for t in self.timings])
+		slowest = self.timings[int(np.argmax(seconds))][0]
+		return("%s tasks on %s %s worker(s): mean %.3f sec, max %.3f sec (task %s), total %.3f sec."%(len(seconds), self.workers, self.backend, seconds.mean(), seconds.max(), slowest+1, seconds.sum()))
+
+#Function to call func on a task and time it (internal)
+#item is (task number, task)
+def _timed_task(func, item):
+	start = time.perf_counter()
+	result = func(item[1])
+	return(item[0], time.perf_counter() - start, result)
+
+#Function to split records into about n groups of consecutive records with similar total size
+#offsets are the cumulative sizes (e.g. byte offsets), with len(offsets) = number of records + 1
+#A record larger than one group's share is kept alone rather than split
+#Returns list of (first, last) record numbers, with last excluded
+def split_balanced(offsets, n):
+	offsets = np.asarray(offsets, dtype=np.int64)
+	nrec = len(offsets) - 1
+	if nrec < 1:
+		return([])
+	n = max(1, min(int(n), nrec))
+	targets = offsets[0] + ((offsets[-1] - offsets[0]) * np.arange(1, n)) // n
+	cuts = [int(c) for c in np.unique(np.searchsorted(offsets, targets)) if 0 < c < nrec]
+	bounds = [0] + cuts + [nrec]
+	return(list(zip(bounds[:-1], bounds[1:])))
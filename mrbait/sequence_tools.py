@@ -2,6 +2,7 @@
 
 import re
 import sys
+import numpy as np
 from itertools import product
 
 #Function to split character to IUPAC codes, assuing diploidy
@@ -191,37 +192,184 @@ def countSlidingWindow(seq, shift, width):
 		window_seq = "".join(i)
 		seqCounterSimple(window_seq)
 
-#Object for creating an iterable slidinw window sampling
-class slidingWindowGenerator():
-	#Need to come back and comment better...
+#Object holding prefix sums of character counts for a sequence (e.g. a locus consensus)
+#Counts for any range seq[x:y] are available in constant time
+class locusIndex():
+	'Prefix sums of variable, N, gap, GC, and masked (lower case) characters'
+	__slots__ = ["counts"]
+	#Rows of counts array
+	VAR, N, GAP, GC, MASK = range(5)
+
+	#Default constructor
+	def __init__(self, seq):
+		codes = np.frombuffer(seq.encode("ascii", "replace"), dtype=np.uint8)
+		self.counts = np.zeros((5, len(codes)+1), dtype=np.int32)
+		for i, table in enumerate(_COUNT_TABLES):
+			np.cumsum(table[codes], out=self.counts[i,1:])
+
+	def __len__(self):
+		return(self.counts.shape[1]-1)
+
+	#Returns array of the five counts for seq[x:y]
+	def range_counts(self, x, y):
+		return(self.counts[:,y] - self.counts[:,x])
+
+	#Returns counts of seq[x:y] as a dict, same as seqCounterSimple(simplifySeq(seq[x:y]))
+	def simple_counts(self, x, y):
+		c = self.range_counts(x, y)
+		return({"N":int(c[self.N]), "-":int(c[self.GAP]), "*":int(c[self.VAR])})
+
+	#Returns counts for flanking regions of seq[x:y], same as getFlankCounts(seq, x, y, dist)
+	def flank_counts(self, x, y, dist):
+		x2 = max(x-dist, 0)
+		y2 = min(y+dist, len(self))
+		c = self.range_counts(x2, x) + self.range_counts(y, y2)
+		return({"N":int(c[self.N]), "-":int(c[self.GAP]), "*":int(c[self.VAR])})
+
+	#Number of G/C bases in seq[x:y], same as gc_counts(seq[x:y])
+	def gc(self, x, y):
+		return(int(self.counts[self.GC,y] - self.counts[self.GC,x]))
+
+	#Number of masked bases in seq[x:y], same as misc_utils.n_lower_chars(seq[x:y])
+	def mask(self, x, y):
+		return(int(self.counts[self.MASK,y] - self.counts[self.MASK,x]))
+
+#Function to find target regions in a sequence using a sliding window
+#Windows pass if they have no more than var_max variable sites, numN Ns, and numG gaps
+#Targets are the unions of consecutive passing windows that are at least blen long
+#Gives the same regions as stepping a slidingWindow through the sequence:
+#	after a target is found the next window starts at target stop + shift,
+#	and a run of passing windows only counts at the end of the sequence if a
+#	window reaches the end
+#index is a locusIndex of the sequence
+#Returns list of (start, stop) tuples
+def slidingWindowTargets(index, shift, width, var_max, numN, numG, blen):
+	seqlen = len(index)
+	if seqlen == 0:
+		return([])
+	#Pass/fail for a window starting at every position, from cumulative counts
+	counts = index.counts
+	passed = np.ones(seqlen, dtype=bool)
+	full = max(seqlen - width + 1, 0) #windows that fit entirely in sequence
+	for cum, limit in zip(counts[[locusIndex.VAR, locusIndex.N, locusIndex.GAP]], (var_max, numN, numG)):
+		win = np.empty(seqlen, dtype=np.int32)
+		win[:full] = cum[width:] - cum[:full]
+		win[full:] = cum[seqlen] - cum[full:seqlen] #windows truncated at end of sequence
+		passed &= (win <= limit)
+
+	#Positions of passing and failing windows, for each offset modulo shift
+	phases = dict()
+	targets = list()
+	windows = slidingWindow(index, shift, width)
+	i = 0
+	while i < seqlen:
+		#Last window visited on this grid: the first one reaching the end of sequence,
+		#or the last start before the end if the grid skips over it
+		last, last_stop = windows.seek(i).final()
+		reaches_end = last_stop == seqlen
+		phase = i % shift
+		if phase not in phases:
+			grid = passed[phase::shift]
+			phases[phase] = (np.flatnonzero(grid)*shift + phase, np.flatnonzero(~grid)*shift + phase)
+		pos, neg = phases[phase]
+
+		#First passing window starts the region
+		k = np.searchsorted(pos, i)
+		if k == len(pos) or pos[k] > last:
+			break
+		start = int(pos[k])
+		#First failing window after it ends the region
+		k = np.searchsorted(neg, start)
+		if k == len(neg) or neg[k] > last:
+			if reaches_end and seqlen - start >= blen:
+				targets.append((start, seqlen))
+			break
+		fail = int(neg[k])
+		stop = fail - shift + width
+		if stop - start >= blen:
+			targets.append((start, stop))
+			i = stop + shift
+		else:
+			i = fail + shift
+	return(targets)
+
+#Lookup tables (indexed by ASCII code) of variable, N, gap, GC, and masked characters
+def _count_tables():
+	tables = np.zeros((5, 256), dtype=np.int32)
+	for c in "RYSWKMBDHV*":
+		tables[locusIndex.VAR, ord(c)] = 1
+		tables[locusIndex.VAR, ord(c.lower())] = 1
+	for c in "Nn":
+		tables[locusIndex.N, ord(c)] = 1
+	tables[locusIndex.GAP, ord("-")] = 1
+	for c in "GCgc":
+		tables[locusIndex.GC, ord(c)] = 1
+	for c in "abcdefghijklmnopqrstuvwxyz":
+		tables[locusIndex.MASK, ord(c)] = 1
+	return(tables)
+
+_COUNT_TABLES = _count_tables()
+
+#Object for iterating sliding windows over a sequence
+#Windows start every <shift> bases and are <width> long, the last window is
+#truncated at the end of the sequence and iteration stops once a window reaches the end
+#Each object keeps its own cursor, so several can be used at once (e.g. in threads)
+class slidingWindow():
+	'Sliding window iterator with seek() and batch (array of start, stop) mode'
+	__slots__ = ["seq", "seqlen", "shift", "width", "i"]
+
+	#Default constructor
+	#seq can be anything with a length (e.g. locusIndex) if only coordinates are needed
 	def __init__(self, seq, shift, width):
-		self.__seq = seq
-		self.__seqlen = len(self.__seq)
-		self.__shift = shift
-		self.__width = width
-		self.__i = 0
-
-	def __call__(self):
-		self.__seqlen
-		while self.__i < self.__seqlen:
-			#print("i is ", self.__i, " : Base is ", self.__seq[self.__i]) #debug print
-			if self.__i+self.__width > self.__seqlen:
-				j = self.__seqlen
-			else:
-				j = self.__i + self.__width
-			yield [self.__seq[self.__i:j], self.__i, j]
-			if j==self.__seqlen: break
-			self.__i += self.__shift
-
-	@classmethod
-	def setI(self, value):
-		self.__i = value
-
-	@classmethod
-	def getI(self):
-		return self.__i
-
-	def __getattr__(self, name):
-		return getattr(self.__class__, name)
-	def __setattr__(self, name, val):
-		return setattr(self.__class__, name, val)
+		self.seq = seq
+		self.seqlen = len(seq)
+		self.shift = shift
+		self.width = width
+		self.i = 0
+
+	def __iter__(self):
+		return(self)
+
+	#Yields [window sequence, start, stop]
+	def __next__(self):
+		if self.i >= self.seqlen:
+			raise StopIteration
+		i = self.i
+		j = min(i + self.width, self.seqlen)
+		#Window reaching end of sequence is the last one
+		self.i = self.seqlen if j == self.seqlen else i + self.shift
+		return([self.seq[i:j], i, j])
+
+	#Move cursor so the next window starts at position i
+	def seek(self, i):
+		self.i = i
+		return(self)
+
+	#Returns start of next window
+	def tell(self):
+		return(self.i)
+
+	#Returns (start, stop) of last window to be visited from the cursor, None if exhausted
+	def final(self):
+		if self.i >= self.seqlen:
+			return(None)
+		if self.i + self.width >= self.seqlen:
+			return(self.i, self.seqlen)
+		#First window reaching end of sequence, or last start before the end if stepped over
+		last = self.i + (-(-(self.seqlen - self.width - self.i) // self.shift) * self.shift)
+		if last >= self.seqlen:
+			last = self.i + ((self.seqlen - 1 - self.i) // self.shift) * self.shift
+		return(last, min(last + self.width, self.seqlen))
+
+	#Batch mode: returns (n x 2) array of window (start, stop) from the cursor and advances it
+	#Returns all remaining windows if num is None
+	def windows(self, num=None):
+		end = self.final()
+		if end is None:
+			return(np.empty((0, 2), dtype=np.int64))
+		starts = np.arange(self.i, end[0]+1, self.shift, dtype=np.int64)
+		if num is not None:
+			starts = starts[:num]
+		stops = np.minimum(starts + self.width, self.seqlen)
+		self.i = self.seqlen if stops[-1] == self.seqlen else int(starts[-1]) + self.shift
+		return(np.column_stack((starts, stops)))
@@ -1,201 +1,313 @@
 #!/usr/bin/python
 import os
+import re
 import sys
-import vcf
+import numpy as np
 from mrbait import misc_utils as utils
-from mrbait import alignment_tools as aln
+from mrbait import compress_tools
+from mrbait import aln_file_tools
 
-#Read VCF variant calls
-#Generator function, yields each locus
-def read_vcf(v):
+#Pattern to find AF (alternate allele frequencies) in the INFO field
+INFO_AF = re.compile(rb"(?:^|;)AF=([^;]*)")
 
+#Pattern separating VCF columns; as in PyVCF (not strict), runs of spaces are accepted as well as tabs
+FIELD_SEPARATOR = re.compile(rb"\t| +")
+
+#Pattern splitting a list of genotypes (tab separated) into alleles
+GT_SEPARATOR = re.compile(rb"[/|\t]")
+
+#Pattern matching subfields after the first (GT) in sample columns
+LATER_SUBFIELDS = re.compile(rb":[^\t ]*")
+
+#Pattern finding uncalled genotypes (all alleles missing) in a list of genotypes, each preceded and followed by a tab
+UNCALLED = re.compile(rb"\t\.(?:[/|]\.)*(?=\t)")
+
+#Pattern matching the last record of each run of records with the same CHROM, from the newline
+#before it to the end of the line, when the next line does not start with the same CHROM
+#(the lookahead and backreference consume the line without backtracking into it)
+CHROM_RUN_END = re.compile(rb"\n([^#\s][^\t \n]*)[\t ](?=([^\n]*))\2(?!\n\1[\t ])")
+
+#Pattern finding the ID of a ##contig header line
+CONTIG_ID = re.compile(rb"[<,]ID=([^,>]*)")
+
+#Patterns finding the #CHROM header line, and the first record line (from the newline before it)
+HEADER_LINE = re.compile(rb"\n#CHROM[^\n]*")
+FIRST_RECORD = re.compile(rb"\n[^#\s]")
+
+#IUPAC bases as bitmasks (A=1, C=2, G=4, T=8, either case), so merging bases is a bitwise OR
+#Gaps are 16, and anything else 0
+BASE_BITS = np.zeros(256, dtype=np.uint8)
+for code, bits in zip(b"ACMGRSVTWYHKDBN", range(1, 16)):
+	BASE_BITS[code] = BASE_BITS[code + 32] = bits
+BASE_BITS[ord("-")] = BASE_BITS[ord("*")] = 16
+
+#Uppercase IUPAC code for each bitmask; gaps merged with bases become N
+BITS_BASE = np.zeros(32, dtype=np.uint8)
+BITS_BASE[1:16] = np.frombuffer(b"ACMGRSVTWYHKDBN", dtype=np.uint8)
+BITS_BASE[16] = ord("-")
+BITS_BASE[17:] = ord("N")
+
+#Lookups for N or gap characters, lowercase characters, and lowercasing
+NGAP = np.zeros(256, dtype=bool)
+NGAP[[ord("N"), ord("n"), ord("-")]] = True
+LOWER_CASE = np.zeros(256, dtype=bool)
+LOWER_CASE[ord("a"):ord("z")+1] = True
+TO_LOWER = np.frombuffer(bytes(range(256)).lower(), dtype=np.uint8)
+
+############################# CLASSES ##################################
+
+class vcfBlock():
+	'Passing VCF records for one contig: positions, REF and ALT alleles, and ALT allele frequencies'
+	__slots__ = ["chrom", "pos", "ref", "alt", "aaf"]
+	#Default constructor
+	#pos is an array of 1-based positions, ref and alt are lists (alt of tuples, one per record)
+	#aaf is a (record x max ALT alleles) float array, padded with NaN
+	def __init__(self, chrom, pos, ref, alt, aaf):
+		self.chrom = chrom
+		self.pos = pos
+		self.ref = ref
+		self.alt = alt
+		self.aaf = aaf
+
+	def __len__(self):
+		return(len(self.pos))
+
+######################## STATIC FUNCTIONS ##############################
+
+#Read VCF variant calls (which may be gzip or bgzip compressed)
+#Only the fields used to build consensus sequences are parsed, and records with a FILTER other than PASS are skipped
+#Optionally reads only the byte range [start, end) of the uncompressed file, or between virtual offsets
+#of a bgzip file if virtual (see index_vcf), in which case samples (the number of sample columns in the header)
+#should be given
+#Generator function, yields a vcfBlock for each run of records with the same CHROM
+def read_vcf(v, start=0, end=None, samples=None, virtual=False):
+	if virtual:
+		lines = aln_file_tools.read_lines(v, end=compress_tools.virtual_span(v, start, end), voffset=start)
+	else:
+		lines = aln_file_tools.read_lines(v, start=start, end=end)
+	chrom = None
+	records = list()
+	for line in lines:
+		if not line or line[0] == 35: #"#"
+			if line.startswith(b"#CHROM"):
+				samples = max(0, len(FIELD_SEPARATOR.split(line)) - 9)
+			continue
+		fields = FIELD_SEPARATOR.split(line, 9)
+		if len(fields) < 8:
+			raise ValueError("Malformed VCF record (fewer than 8 columns): %s"%line.decode())
+		if fields[6] not in (b".", b"PASS"):
+			continue
+		if fields[0] != chrom:
+			if records:
+				yield(_vcf_block(chrom, records, samples))
+			chrom = fields[0]
+			records = list()
+		records.append(fields)
+	if records:
+		yield(_vcf_block(chrom, records, samples))
+
+#Read VCF records for contigs, from byte ranges found by index_vcf
+#Generator function, yields a vcfBlock for each run of records with the same CHROM
+def read_vcf_ranges(v, ranges, samples=None, virtual=False):
+	for start, end in ranges:
+		for block in read_vcf(v, start, end, samples, virtual):
+			yield(block)
+
+#Function to read the header of a VCF file, which ends before end (if known)
+#RETURNS: number of sample columns (None if there is no #CHROM line), and names of ##contig lines
+def read_vcf_header(v, end=None):
+	samples = None
+	contigs = list()
+	for line in aln_file_tools.read_lines(v, end=end):
+		if line.startswith(b"##contig="):
+			name = CONTIG_ID.search(line)
+			if name:
+				contigs.append(name.group(1).decode())
+		elif line.startswith(b"#CHROM"):
+			samples = max(0, len(FIELD_SEPARATOR.split(line)) - 9)
+			break
+		elif line and line[0] != 35:
+			break
+	return(samples, contigs)
+
+#Function to find the records of each contig in a VCF file (which may be gzip or bgzip compressed)
+#If the file has a tabix index (.tbi or .csi), records of each contig are found from it without
+#reading the file. Otherwise, runs of records with the same CHROM are found by CHROM_RUN_END,
+#one match per run, so the file is scanned in large blocks without parsing records
+#RETURNS: number of sample columns in the header (None if there is no #CHROM line),
+#dict of CHROM : list of (start, end) byte ranges of its runs, in order of first appearance,
+#and whether the ranges are virtual offsets (from a tabix index) rather than uncompressed offsets
+def index_vcf(v):
 	if not utils.fileCheck(v):
 		raise FileNotFoundError("Fatal exception, file %s not found."%v)
-
-	try:
-		vfh = vcf.Reader(filename=v)
-	except IOError as err:
-		print("I/O error({0}): {1}".format(err.errno, err.strerror))
-	except:
-		print("Unexpected error:", sys.exec_info()[0])
-
-	chrom = ""
-	recs = []
-	added = 0
-	for rec in vfh:
-		if not rec.FILTER:
-			if chrom:
-				if chrom == rec.CHROM:
-					recs.append(rec)
-					added = 1
+	if compress_tools.tabix_path(v) is not None:
+		names, spans = compress_tools.tabix_index(v)
+		#The header ends at the first record
+		first = min([span[0] for span in spans if span is not None], default=None)
+		samples, header_contigs = read_vcf_header(v, None if first is None else compress_tools.virtual_span(v, 0, first))
+		#.csi files may not name the sequences, which are then those of the header
+		if names is None:
+			if len(header_contigs) < len(spans):
+				raise ValueError("Tabix index of %s doesn't name its sequences, and the VCF header has too few ##contig lines"%v)
+			names = header_contigs
+		contigs = {name : [span] for name, span in zip(names, spans) if span is not None}
+		return(samples, contigs, True)
+	samples = None
+	contigs = dict()
+	last = None #end of last run, starting at the first record
+	#Blocks are searched from the newline before their first line, so one is added before the file
+	base = -1
+	rest = b"\n"
+	with compress_tools.open_input(v) as fh:
+		while True:
+			block = fh.read(compress_tools.BLOCKSIZE)
+			data = rest + block
+			#Only search whole lines, except at the end of the file
+			cut = data.rfind(b"\n") if block else len(data)
+			if block and cut <= 0:
+				rest = data
+				continue
+			data, rest = data[:cut], data[cut:]
+			if last is None:
+				header = HEADER_LINE.search(data)
+				if header:
+					samples = max(0, len(FIELD_SEPARATOR.split(header.group(0).strip())) - 9)
+				record = FIRST_RECORD.search(data)
+				if record:
+					last = max(0, base + record.start())
+			for run in CHROM_RUN_END.finditer(data):
+				chrom = run.group(1).decode()
+				end = base + run.end()
+				ranges = contigs.setdefault(chrom, list())
+				#Runs split at a block boundary (or by a blank line) are joined again
+				if ranges and ranges[-1][1] == last:
+					ranges[-1] = (ranges[-1][0], end)
 				else:
-					#print("YIELDING")
-					yield recs
-					chrom = rec.CHROM
-					recs = [rec]
-					added = 0
-			else:
-				chrom = rec.CHROM
-				recs.append(rec)
-				added = 1
-	if added == 0 and recs:
-		yield recs
+					ranges.append((last, end))
+				last = end
+			base += len(data)
+			if not block:
+				break
+	return(samples, contigs, False)
+
+#Function to build a vcfBlock from split VCF lines of one contig (internal)
+#samples is the number of samples in the header (None if unknown)
+def _vcf_block(chrom, records, samples=None):
+	pos = np.array([int(fields[1]) for fields in records], dtype=np.int64)
+	ref = [fields[3].decode() for fields in records]
+	alt = [tuple() if fields[4] == b"." else tuple(fields[4].decode().split(",")) for fields in records]
+	aaf = np.full((len(records), max([len(a) for a in alt] + [1])), np.nan)
+	for i, fields in enumerate(records):
+		aaf[i, :len(alt[i])] = alt_frequencies(fields, len(alt[i]), samples)
+	return(vcfBlock(chrom.decode(), pos, ref, alt, aaf))
+
+#Function to get frequencies of the n ALT alleles of a split VCF line
+#Uses AF from the INFO field when present, otherwise counts alleles in the GT calls,
+#where the denominator is all alleles of samples with at least one called allele
+#Only the first samples genotype columns are used, if given (columns past those in the header are ignored)
+def alt_frequencies(fields, n, samples=None):
+	if n == 0:
+		return(np.zeros(0))
+	af = INFO_AF.search(fields[7])
+	if af:
+		try:
+			values = [float(x) for x in af.group(1).split(b",")]
+			if len(values) == n:
+				return(np.array(values))
+		except ValueError:
+			pass
+	if len(fields) < 10:
+		return(np.full(n, np.nan))
+	keys = fields[8].split(b":")
+	if b"GT" not in keys:
+		return(np.full(n, np.nan))
+	gt = keys.index(b"GT")
+	if gt == 0:
+		calls = LATER_SUBFIELDS.sub(b"", fields[9]).split()[:samples]
+	else:
+		calls = [(s.split(b":") + [b"."]*gt)[gt] for s in FIELD_SEPARATOR.split(fields[9])[:samples]]
+	#Alleles are counted in the joined genotypes, leaving out uncalled samples
+	text = b"\t" + b"\t".join(calls) + b"\t"
+	uncalled = UNCALLED.findall(text)
+	if len(uncalled) == len(calls):
+		return(np.full(n, np.nan))
+	total = len(calls) + text.count(b"/") + text.count(b"|") - b"".join(uncalled).count(b".")
+	if n < 10:
+		#Allele numbers are single digits, so can be counted directly
+		counts = np.array([text.count(str(i).encode()) for i in range(1, n+1)])
+	else:
+		alleles = np.array(GT_SEPARATOR.split(text))
+		counts = np.array([np.count_nonzero(alleles == str(i).encode()) for i in range(1, n+1)])
+	return(counts / total)
+
 #NOTES:
 #If reference base from FASTA is N or gap, we try to call new consensus from VCF
 #N or - in VCF still have to pass threshold to be incoporated.
 #If called as gap, we overwrite FASTA reference at that position.
 #MASKING information is retained from FASTA reference and NOT considered in VCF
-#Function to return new consensus sequence given REF and VCF records
-def make_consensus_from_vcf(ref, chrom, records, thresh, altRef):
-	consensus = ""
-	for rec in records:
-		current_ref = ""
-		if consensus:
-			current_ref = consensus
-		else:
-			current_ref = ref
-		nucs = aln.get_iupac(current_ref[rec.POS-1].upper())
-		rec_alt = []
-		for x in rec.ALT:
-			rec_alt += str(x).upper()
-
-		cons = ""
-		chosen = 0
-
-		# print("current position:",rec.POS)
-		# print("VCF REF allele:",rec.REF)
-		# print("FASTA REF allele:",current_ref[rec.POS-1])
-		# print("ALT alleles:",rec_alt)
-
-		#If reference allele is N or gap:
-		if current_ref[rec.POS-1] in ["N", "n", "-"]:
-			#if altREF used, call new consensus from ALT alleles
-			if altRef:
-				#If ALT contains gap or N over threshold:
-				if "-" in rec_alt:
-					i = (rec_alt).index("-")
-					prop = rec.aaf[i]
-					if float(prop) >= float(thresh):
-						cons = "-"
-						chosen = 1
-				if "N" in rec_alt:
-					i = (rec_alt).index("N")
-					prop = rec.aaf[i]
-					if float(prop) >= float(thresh):
-						cons = "N"
-						chosen = 1
-
-				#If no gap is kept, need to make new consensus
-				#Add ALT alleles to list of observed nucs at this position
-				if chosen == 0:
-					nucs = rec_alt
-					#print(nucs)
-					temp = utils.listToSortUniqueString(nucs)
-					cons = aln.reverse_iupac(temp)
-					chosen = 1
-			else:
-				#if NOT altRef, retain N/gap
-				continue
-		#otherwise, make new consensus from all
+#Function to patch a consensus sequence (bytearray, or writable uint8 array) in place given VCF records (a vcfBlock)
+#Bases are merged as IUPAC bitmasks (see BASE_BITS), so each record is a few table lookups
+#Records at the same position are applied in file order, each seeing the result of the last
+#RETURNS: number of positions changed
+def patch_consensus(seq, records, thresh, altRef):
+	seq = np.frombuffer(seq, dtype=np.uint8) if not isinstance(seq, np.ndarray) else seq
+	keep = (records.pos >= 1) & (records.pos <= len(seq))
+	pos = records.pos[keep] - 1
+	if not len(pos):
+		return(0)
+	alt_bits, gap_freq, n_freq = _alt_tables(records)
+	alt_bits, gap_freq, n_freq = alt_bits[keep], gap_freq[keep], n_freq[keep]
+	before = seq[pos].copy()
+
+	#Records are applied in rounds, so positions are unique within each round
+	order = np.argsort(pos, kind="stable")
+	first = np.r_[True, pos[order][1:] != pos[order][:-1]]
+	starts = np.maximum.accumulate(np.where(first, np.arange(len(order)), 0))
+	rounds = np.empty(len(order), dtype=np.int64)
+	rounds[order] = np.arange(len(order)) - starts
+	for r in range(int(rounds.max()) + 1):
+		i = np.flatnonzero(rounds == r)
+		p = pos[i]
+		current = seq[p]
+		bits = BASE_BITS[current]
+		#Known bases: merge ALT alleles into the current base
+		new = np.where(bits > 0, BITS_BASE[bits | alt_bits[i]], current)
+		#N or gap: call from ALT alleles (if altRef), or gap/N if over threshold
+		ngap = NGAP[current]
+		if altRef:
+			called = BITS_BASE[alt_bits[i]]
+			called = np.where(gap_freq[i] >= thresh, ord("-"), called)
+			called = np.where(n_freq[i] >= thresh, ord("N"), called)
+			new = np.where(ngap, called, new)
 		else:
-			nucs += rec_alt
-			#print(nucs)
-			temp = utils.listToSortUniqueString(nucs)
-			cons = aln.reverse_iupac(temp)
-			chosen = 1
-			#print("\t\t\tWARNING: CHROM %s position %s (%s) doesn't match REF in VCF record (%s). "%(chrom, rec.POS, current_ref[rec.POS-1],rec.REF))
-
-		#Incorporate new consensus base
-		if chosen == 1 and cons:
-			#Retain masking info from FASTA reference
-			if current_ref[rec.POS-1].islower():
-				consensus = utils.stringSubstitute(current_ref, (rec.POS-1), cons.lower())
-			else:
-				consensus = utils.stringSubstitute(current_ref, (rec.POS-1), cons.upper())
-	#print("Reference:",ref)
-	#print("Consensus:",consensus)
-	return(consensus)
-
-#function to count number of loci in FASTA file (by headers)
-def countVCF(loci):
-	fh  = open(str(loci), 'r')
-	count=0
-	for l in fh:
-		line = l.strip()
-		if not line:
-			continue
-		if not line.startswith("#"):
-			count+=1
-	return(count)
-
-#Function to remove existing CHUNK files
-def removeChunks(dir_name):
-	test = os.listdir(dir_name)
-
-	for item in test:
-	    if item.endswith(".chunk"):
-	        os.remove(os.path.join(dir_name, item))
-
-#Function to chunk a VCF file
-def vcf_chunker(infile, chunks, wd):
-	chunks = int(chunks)
-	loci_count = countVCF(infile)
-	if loci_count < chunks:
-		chunks = loci_count
-	chunk_size = loci_count // chunks
-	removeChunks(wd) #clear any existing chunkfiles
-
-	files = list()
-	#write .loci file into chunk files
-	with open(infile) as file_object:
-		max_chunks = chunks
-		chunks = 1
-		record = 0
-
-		chunk_file = wd + "/." + str(chunks) + ".chunk"
-		out_object = open(chunk_file, "w")
-		files.append(chunk_file)
-
-		header = ""
-		hset = 0
-		for l in file_object:
-			line = l.strip()
-			if not line:
-				continue
-			#First, get header information
-			if hset == 0:
-				if line[0] == "#":
-					header +=str(line+"\n")
-				else:
-					record = 1
-					hset=1
-					out_object.write(header)
-					out = line + "\n"
-					out_object.write(out)
-			else:
-				#Write chunk_size alignments to each chunk
-				if chunks < max_chunks:
-					record += 1 #increment locus number
-				 	#If current chunk not full, add record to chunk
-					if record <= chunk_size:
-						out = line + "\n"
-						out_object.write(out)
-					#Otherwise, start new chunk
-					else:
-						record= 1
-						chunks = chunks + 1
-						out_object.close()
-						chunk_file = wd + "/." + str(chunks) + ".chunk"
-						out_object = open(chunk_file, "w")
-						out_object.write(header)
-						files.append(chunk_file)
-						out = line + "\n"
-						out_object.write(out)
-
-				#If last chunk, keep writing to final chunk file
-				else:
-					out = line + "\n"
-					out_object.write(out)
-		out_object.close()
-		file_object.close()
-	return(files)
+			new = np.where(ngap, current, new)
+		#Retain masking info from FASTA reference
+		new = np.where(LOWER_CASE[current], TO_LOWER[new], new)
+		#Unknown characters, and ALT alleles with no bases, leave the consensus as is
+		new = np.where(new == 0, current, new)
+		seq[p] = new
+	positions, first = np.unique(pos, return_index=True)
+	return(int(np.count_nonzero(seq[positions] != before[first])))
+
+#Function to get, for each record of a vcfBlock, the bitmask of bases in its ALT alleles,
+#and the frequencies of gap (- or *) and N ALT alleles (NaN if absent) (internal)
+def _alt_tables(records):
+	alt_bits = np.zeros(len(records), dtype=np.uint8)
+	gap_freq = np.full(len(records), np.nan)
+	n_freq = np.full(len(records), np.nan)
+	bits = dict() #bitmask of each distinct ALT allele
+	for i, alts in enumerate(records.alt):
+		for j, allele in enumerate(alts):
+			if allele not in bits:
+				upper = allele.upper()
+				bits[allele] = 0 if upper[:1] == "<" else int(np.bitwise_or.reduce(BASE_BITS[np.frombuffer(upper.encode(), dtype=np.uint8)]))
+			alt_bits[i] |= bits[allele]
+			if allele in ("-", "*"):
+				gap_freq[i] = records.aaf[i, j]
+			elif allele in ("N", "n"):
+				n_freq[i] = records.aaf[i, j]
+	return(alt_bits, gap_freq, n_freq)
+
+#Function to count records of a vcfBlock that fall outside a sequence of length seqlen
+def count_outside(records, seqlen):
+	return(int(np.count_nonzero((records.pos < 1) | (records.pos > seqlen))))
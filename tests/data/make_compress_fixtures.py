@@ -0,0 +1,57 @@
+#!/usr/bin/python
+
+"""
+Builds the BGZF/tabix fixtures used by tests/test_compress_tools.py
+
+records.vcf.gz is written in small BGZF blocks, so records span block boundaries,
+with a .gzi block index and a .tbi tabix index; records_csi.vcf.gz is the same file
+with a .csi index. Needs Biopython and pysam (only to rebuild the fixtures):
+
+	cd tests/data && python make_compress_fixtures.py
+
+"""
+
+import shutil
+import struct
+import random
+import pysam
+from Bio import bgzf
+
+CONTIGS = [("chr1", 5000), ("chr2", 3000), ("scaffold_3", 8000)]
+
+def vcf_text():
+	rng = random.Random(7)
+	lines = ["##fileformat=VCFv4.2"]
+	lines += ["##contig=<ID=%s,length=%s>"%(name, length) for name, length in CONTIGS]
+	lines.append("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\tS2")
+	for name, length in CONTIGS:
+		for pos in sorted(rng.sample(range(1, length), 40)):
+			ref, alt = rng.sample("ACGT", 2)
+			gts = [rng.choice(["0/0", "0/1", "1/1", "./."]) for i in range(2)]
+			lines.append("\t".join([name, str(pos), ".", ref, alt, "50", "PASS", ".", "GT"] + gts))
+	return("\n".join(lines) + "\n")
+
+def write_bgzf(text, out, block=400):
+	writer = bgzf.BgzfWriter(out, "wb")
+	data = text.encode()
+	for i in range(0, len(data), block):
+		writer.write(data[i:i+block])
+		writer.flush()
+	writer.close()
+
+#.gzi: number of blocks after the first, then (compressed, uncompressed) offset of each
+def write_gzi(infile):
+	with open(infile, "rb") as fh:
+		blocks = list(bgzf.BgzfBlocks(fh))
+	pairs = [(start, data_start) for start, raw_len, data_start, data_len in blocks if data_len][1:]
+	with open(infile + ".gzi", "wb") as fh:
+		fh.write(struct.pack("<Q", len(pairs)))
+		for pair in pairs:
+			fh.write(struct.pack("<QQ", *pair))
+
+if __name__ == "__main__":
+	write_bgzf(vcf_text(), "records.vcf.gz")
+	write_gzi("records.vcf.gz")
+	shutil.copy("records.vcf.gz", "records_csi.vcf.gz")
+	pysam.tabix_index("records.vcf.gz", preset="vcf", force=True)
+	pysam.tabix_index("records_csi.vcf.gz", preset="vcf", force=True, csi=True)
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from mrbait import compress_tools
+
+"""
+Checks of the BGZF block index (.gzi), and tabix (.tbi/.csi) index parsers in
+compress_tools against plain gzip reads of the fixtures in tests/data
+(see tests/data/make_compress_fixtures.py)
+
+"""
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+class compressToolsTest(unittest.TestCase):
+	#Copy fixtures to a temporary directory with indexes newer than the data,
+	#since a git checkout doesn't keep modification times
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		for name in os.listdir(DATA):
+			if ".vcf.gz" in name:
+				shutil.copy(os.path.join(DATA, name), self.tmp)
+		for name in os.listdir(self.tmp):
+			stamp = 2000000000 if name.endswith(compress_tools.TABIX_EXTS + (compress_tools.GZI_EXT,)) else 1000000000
+			os.utime(os.path.join(self.tmp, name), (stamp, stamp))
+		self.vcf = os.path.join(self.tmp, "records.vcf.gz")
+		self.csi = os.path.join(self.tmp, "records_csi.vcf.gz")
+		with gzip.open(self.vcf, "rb") as fh:
+			self.plain = fh.read()
+		compress_tools._bgzf_index.cache_clear()
+		compress_tools._tabix_index.cache_clear()
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def read(self, **kwargs):
+		with compress_tools.open_input(self.vcf, "rb", **kwargs) as fh:
+			return(fh.read())
+
+	#Byte range of the records of each contig in the uncompressed data
+	def contig_ranges(self):
+		ranges = dict()
+		offset = 0
+		for line in self.plain.splitlines(True):
+			if not line.startswith(b"#"):
+				chrom = line.split(b"\t", 1)[0].decode()
+				start, end = ranges.get(chrom, (offset, offset))
+				ranges[chrom] = (start, offset + len(line))
+			offset += len(line)
+		return(ranges)
+
+	def test_detects_bgzf(self):
+		self.assertTrue(compress_tools.is_gzip(self.vcf))
+		self.assertTrue(compress_tools.is_bgzf(self.vcf))
+		self.assertTrue(compress_tools.is_splittable(self.vcf))
+
+	def test_gzi_matches_block_scan(self):
+		saved = compress_tools.bgzf_index(self.vcf)
+		os.remove(self.vcf + compress_tools.GZI_EXT)
+		compress_tools._bgzf_index.cache_clear()
+		scanned = compress_tools.bgzf_index(self.vcf)
+		self.assertGreater(len(saved[0]), 2)
+		#The scan also lists the empty EOF block, at the end of the data, which .gzi files leave out
+		inside = scanned[1] < len(self.plain)
+		np.testing.assert_array_equal(saved[0], scanned[0][inside])
+		np.testing.assert_array_equal(saved[1], scanned[1][inside])
+
+	def test_open_at_offset(self):
+		coffsets, uoffsets = compress_tools.bgzf_index(self.vcf)
+		starts = set(int(u) for u in uoffsets) | set(int(u) + 1 for u in uoffsets) | set(int(u) - 1 for u in uoffsets[1:])
+		starts |= {0, 1, 37, len(self.plain) - 1, len(self.plain)}
+		for start in sorted(starts):
+			self.assertEqual(self.read(start=start), self.plain[start:], "start=%s"%start)
+			self.assertEqual(self.read(start=start, size=100), self.plain[start:start+100], "start=%s"%start)
+
+	def test_tabix_path(self):
+		self.assertEqual(compress_tools.tabix_path(self.vcf), self.vcf + ".tbi")
+		self.assertEqual(compress_tools.tabix_path(self.csi), self.csi + ".csi")
+		#A stale index is ignored
+		os.utime(self.vcf + ".tbi", (0, 0))
+		self.assertIsNone(compress_tools.tabix_path(self.vcf))
+
+	def test_tabix_spans(self):
+		ranges = self.contig_ranges()
+		for infile in (self.vcf, self.csi):
+			names, spans = compress_tools.tabix_index(infile)
+			self.assertEqual(names, ["chr1", "chr2", "scaffold_3"])
+			for name, span in zip(names, spans):
+				first, last = span
+				size = compress_tools.virtual_span(infile, first, last)
+				with compress_tools.open_input(infile, "rb", voffset=first, size=size) as fh:
+					records = fh.read()
+				start, end = ranges[name]
+				self.assertEqual(records, self.plain[start:end], "%s in %s"%(name, infile))
+
+if __name__ == "__main__":
+	unittest.main()
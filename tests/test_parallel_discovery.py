@@ -0,0 +1,98 @@
+#!/usr/bin/python
+
+import os
+import sys
+import random
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from mrbait import mrbait
+from mrbait import mrbait_menu
+from mrbait import manage_bait_db as m
+from mrbait import mrbait_corefuncs_parallel as pcore
+
+"""
+Stress test of the parallel loading, target discovery, and bait design steps:
+many more tasks than threads, small batches of rows, and long targets, so that
+workers keep reading the database while the database writer has a transaction
+larger than the SQLite page cache open.
+Results of each executor are checked against a serial (-T 1) run.
+
+"""
+
+THREADS = 4
+TASKS_PER_THREAD = 16
+CONTIGS = 1000
+
+#Function to write a random assembly, with scattered ambiguity codes and Ns
+def write_contigs(path, num, seed=1):
+	rand = random.Random(seed)
+	with open(path, "w") as fh:
+		for i in range(num):
+			seq = list()
+			for j in range(rand.randint(2000, 6000)):
+				draw = rand.random()
+				if draw < 0.002:
+					seq.append(rand.choice("RYSWKM"))
+				elif draw < 0.0025:
+					seq.append("N")
+				else:
+					seq.append(rand.choice("ACGT"))
+			fh.write(">contig_%s\n"%i)
+			seq = "".join(seq)
+			for start in range(0, len(seq), 60):
+				fh.write(seq[start:start+60] + "\n")
+
+class parallelDiscoveryTest(unittest.TestCase):
+	@classmethod
+	def setUpClass(cls):
+		cls.tmp = tempfile.mkdtemp()
+		cls.fasta = os.path.join(cls.tmp, "contigs.fasta")
+		write_contigs(cls.fasta, CONTIGS)
+		cls.serial = cls.discover("serial", 1)
+
+	@classmethod
+	def tearDownClass(cls):
+		shutil.rmtree(cls.tmp)
+
+	#Function to run steps 1, 2, and 4 of the pipeline as mrbait.main does
+	#Returns: regions and baits tables
+	@classmethod
+	def discover(cls, name, threads, executor="process"):
+		argv = ["mrbait", "-A", cls.fasta, "-o", name, "--db", os.path.join(cls.tmp, name + ".sqlite"),
+			"-T", str(threads), "-b", "80", "-v", "3", "-n", "1", "-g", "1", "-R", "-D", "100",
+			"--hacker", "executor=%s"%executor, "--hacker", "tasks_per_thread=%s"%TASKS_PER_THREAD,
+			"--hacker", "batch_size=20"]
+		with mock.patch.object(sys, "argv", argv):
+			params = mrbait_menu.parseArgs()
+		conn = m.create_connection(params.db)
+		pool = pcore.start_pool(params) if threads > 1 else None
+		try:
+			m.init_new_db(conn)
+			mrbait.loadAlignments(conn, params, pool)
+			mrbait.targetDiscovery(conn, params, pool)
+			mrbait.baitDiscovery(conn, params, pool)
+			if threads > 1:
+				assert len(m.getPassedLociRanges(conn, threads*TASKS_PER_THREAD)) > threads
+			regions = conn.execute("SELECT regid, locid, start, stop, sequence FROM regions ORDER BY regid").fetchall()
+			baits = conn.execute("SELECT baitid, regid, start, stop, sequence FROM baits ORDER BY baitid").fetchall()
+		finally:
+			pcore.stop_pool(pool)
+			conn.close()
+		return(regions, baits)
+
+	def check(self, executor):
+		regions, baits = self.discover(executor, THREADS, executor)
+		self.assertGreater(len(self.serial[0]), CONTIGS)
+		self.assertEqual(regions, self.serial[0])
+		self.assertEqual(baits, self.serial[1])
+
+	def test_process_executor(self):
+		self.check("process")
+
+	def test_thread_executor(self):
+		self.check("thread")
+
+if __name__ == "__main__":
+	unittest.main()